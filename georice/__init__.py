@@ -3,7 +3,8 @@
 from .imagery import GetSentinel, Geometry
 from .ricemap import Ricemap
 from .filtering import Filtering
-from .utils import load_config, show_config, save_config, set_sh, Dir, mosaic
+from .utils import load_config, show_config, save_config, set_sh, Dir, mosaic_parts
+from . import telemetry, jobqueue
 import os
 
 class Georice:
@@ -143,7 +144,8 @@ class Georice:
         self._get_tile_attr()
 
     def get_ricemap(self, name, period, orbit_path=None, orbit_number=None, inter=False, lzw=False, mask=False, nr=False,
-                    filtering=True):
+                    filtering=True, max_memory=None, datacube=False, update=False,
+                    sweep=None, telemetry_path=None, profile=False):
         """
          Georice - generation of classified rice map
         "no_data":0, "rice":1, "urban_tree":2, "water":3, "other":4
@@ -157,48 +159,100 @@ class Georice:
         lzv - use LZW compression; type: bool; default = False i.e. DEFLATE
         mask - generate and write rice, trees, water, other and nodata masks; type: bool; default = False
         nr - diable automatic reprojection to EPSG:4326, type: bool; default = True
-        filtering - Use SAR multi-temporal speckle filter; default = True
+        filtering - Use SAR multi-temporal speckle filter, not available for quantized scenes (config key quantized);
+                    default = True
+        max_memory - memory budget of the rice map processing, block size is chosen to fit in it; type: int (bytes)
+                     or str with K/M/G/T suffix i.e. '8G'; default = None i.e. default block size
+        datacube - keep the scenes in a chunked time series datacube per orbit (output/name/datacube) and read the rice
+                   map time series from it; default = False
+        update - incremental update of the rice map, the temporal statistics are kept as a per pixel running state and
+                 only the dates added since the last run with the same starting date are processed; default = False
+        sweep - threshold sweep: rice,trees,water triples (dB) separated by ';', values can be start:stop:step ranges
+                i.e. '4:6:0.5,-18,-18'. One rice map per triple and a class area summary (csv); default = None
+        telemetry_path - folder of the performance telemetry of the download, filtering and rice map stages (wall
+                         time, CPU, peak memory, bytes, requests): appended to telemetry.jsonl and written as Prometheus
+                         textfile georice_<name>.prom; default = None i.e. no telemetry
+        profile - with telemetry_path, cProfile each stage into the telemetry folder; default = False
         """
-        self.filter(inplace=True, rel_orbit_num=orbit_number, orbit_path=orbit_path)
-
-
-        if self._imagery.aoi.geometry.area >= load_config().get('max_area'):
-            geom = Geometry(self._imagery.aoi.geometry, self._imagery.aoi.crs, grid_leght=(10000, 10000))
-            copy = self._imagery.__copy__()
-
-            print(f'Area is larger than {self.config["max_area"]/1e6} km2. AOI will be processed in parts.')
-            n_parts = sum(1 for dummy in iter(geom))
-
-            for id, sub_aoi in enumerate(iter(geom)):
-                print(f'Starting to process part {id+1}/{n_parts}')
-                part = f'part{id}-'
-                grid = Geometry(sub_aoi[0], self._imagery.aoi.crs)
-                copy.aoi = grid
-                copy.download(tile_name=name, part=part)
+        if filtering:
+            # before any download, quantized scenes cannot be filtered
+            self._filtering.check_config()
+        with telemetry.session(telemetry_path, 'georice_' + name, {'tile': name}, profile):
+            self.filter(inplace=True, rel_orbit_num=orbit_number, orbit_path=orbit_path)
+
+
+            if self._imagery.aoi.geometry.area >= load_config().get('max_area'):
+                geom = Geometry(self._imagery.aoi.geometry, self._imagery.aoi.crs, grid_leght=(10000, 10000))
+                copy = self._imagery.__copy__()
+
+                print(f'Area is larger than {self.config["max_area"]/1e6} km2. AOI will be processed in parts.')
+                n_parts = sum(1 for dummy in iter(geom))
+
+                for id, sub_aoi in enumerate(iter(geom)):
+                    print(f'Starting to process part {id+1}/{n_parts}')
+                    part = f'part{id}-'
+                    grid = Geometry(sub_aoi[0], self._imagery.aoi.crs)
+                    copy.aoi = grid
+                    copy.download(tile_name=name, part=part)
+                    if filtering:
+                        self._filtering.process(name, orbit_path)
+                        self._ricemap.ricemap_get(name, orbit_number, period, orbit_path, inter, lzw, mask, nr,
+                                                  part=part, folder=f'scenes{os.sep}filtered', max_memory=max_memory,
+                                                  datacube=datacube, update=update, sweep=sweep)
+                    else:
+                        self._ricemap.ricemap_get(name, orbit_number, period, orbit_path, inter, lzw, mask, nr,
+                                                  part=part, max_memory=max_memory, datacube=datacube, update=update,
+                                                  sweep=sweep)
+                    self._get_tile_attr()
+                    self.__getattribute__(name).scenes.delete()
+                print(f'')
+                mosaic_parts(self.__getattribute__(name).ricemaps.file_paths(),
+                             [f'part{id}-{name}' for id in range(n_parts)], name,
+                             os.path.join(self.config['output'], name, 'ricemaps'))
+            else:
+                print('Downloading scenes')
+                self._imagery.download(tile_name=name)
+                print('Downloading finished')
                 if filtering:
                     self._filtering.process(name, orbit_path)
-                    self._ricemap.ricemap_get(name, orbit_number, period, orbit_path, inter, lzw, mask, nr, part=part,
-                                              folder=f'scenes{os.sep}filtered')
+                    self._ricemap.ricemap_get(name, orbit_number, period, orbit_path, inter, lzw, mask, nr,
+                                              folder=f'scenes{os.sep}filtered', max_memory=max_memory,
+                                              datacube=datacube, update=update, sweep=sweep)
                 else:
-                    self._ricemap.ricemap_get(name, orbit_number, period, orbit_path, inter, lzw, mask, nr, part=part)
+                    self._ricemap.ricemap_get(name, orbit_number, period, orbit_path, inter, lzw, mask, nr,
+                                              max_memory=max_memory, datacube=datacube, update=update, sweep=sweep)
                 self._get_tile_attr()
                 self.__getattribute__(name).scenes.delete()
-            print(f'')
-            mosaic(self.__getattribute__(name).ricemaps.file_paths())
-        else:
-            print('Downloading scenes')
-            self._imagery.download(tile_name=name)
-            print('Downloading finished')
-            if filtering:
-                self._filtering.process(name, orbit_path)
-                self._ricemap.ricemap_get(name, orbit_number, period, orbit_path, inter, lzw, mask, nr,
-                                          folder=f'scenes{os.sep}filtered')
-            else:
-                self._ricemap.ricemap_get(name, orbit_number, period, orbit_path, inter, lzw, mask, nr)
-            self._get_tile_attr()
-            self.__getattribute__(name).scenes.delete()
 
-        print(f'Rice map was downloaded into {self.config["output"]}{os.sep}{name}{os.sep}ricemaps')
+            print(f'Rice map was downloaded into {self.config["output"]}{os.sep}{name}{os.sep}ricemaps')
+
+    def submit_ricemap(self, name, period, orbit_path=None, orbit_number=None, inter=False, lzw=False, mask=False,
+                       nr=False, filtering=True, max_memory=None, datacube=False, update=False, sweep=None,
+                       queue_path=None, workers=0):
+        """
+        Distributed generation of rice map: same parameters as get_ricemap, the AOI parts (the whole AOI if smaller
+        than max_area) become jobs of a queue on the shared storage, run by worker processes of one or several nodes
+        (georice worker) sharing the output folder: download, filtering and rice map of each part in its own tile
+        folder (part<n>-name), then the merge of the part products into the tile ricemaps folder.
+        A job whose worker crashed is leased again by another worker (see georice.jobqueue.JobQueue).
+        queue_path - folder of the queue (queue.sqlite); default = output folder
+        workers - number of local worker processes run until the queue is finished; default = 0 i.e. only submit
+        Returns the batch name.
+        """
+        if filtering:
+            self._filtering.check_config()
+        self.filter(inplace=True, rel_orbit_num=orbit_number, orbit_path=orbit_path)
+        batch = jobqueue.submit_ricemap(self._imagery, name, period, orbit_path, orbit_number, filtering, queue_path,
+                                        inter=inter, lzw=lzw, mask=mask, nr=nr, max_memory=max_memory,
+                                        datacube=datacube, update=update, sweep=sweep)
+        if workers > 0:
+            jobqueue.run_workers(workers, queue_path, sh_config=self._imagery.SHConfig)
+            with jobqueue.JobQueue(queue_path or self.config['output']) as queue:
+                jobs = queue.jobs(batch)
+            for job in jobs:
+                print(f'- {job["name"]}: {job["status"]}' + (f' ({job["error"]})' if job['error'] else ''))
+            self._get_tile_attr()
+        return batch
 
 
 
@@ -0,0 +1,112 @@
+import os
+import sys
+import queue
+import traceback
+import time
+import psutil
+from multiprocessing import cpu_count
+from . import engine
+from .catalog import Catalog
+
+
+def plan_jobs(scene_path, output_path):
+    """
+    One rice map job per orbit direction / orbit number found in the scene folder, over the whole period found there.
+    The scene folder catalog (see catalog.Catalog) is synced once, each job gets its selected scenes.
+    """
+    with Catalog.open(scene_path) as catalog:
+        catalog.sync()
+        combinations, (starting_date, ending_date) = catalog.combinations()
+        jobs = []
+        for direction, orbit in combinations:
+            try:
+                scenes = engine.select_scenes(scene_path, orbit, direction, starting_date, ending_date,
+                                              catalog=catalog)
+            except ValueError:
+                continue
+            jobs.append({'name': f'{direction}_{orbit}_{starting_date}_{ending_date}', 'scenes': scenes,
+                         'starting_date': starting_date, 'ending_date': ending_date, 'output_path': output_path})
+    return jobs
+
+
+def _run_job(job, options, log_path, results):
+    # job process: the engine output goes to the job log, the outcome to the scheduler
+    error = None
+    with open(log_path, 'w', buffering=1) as log:
+        sys.stdout = sys.stderr = log
+        try:
+            engine.ricemap(job['scenes'], job['starting_date'], job['ending_date'], job['output_path'], **options)
+        except BaseException as exception:
+            traceback.print_exc()
+            error = repr(exception)
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    results.put((job['name'], error))
+    if error is not None:
+        sys.exit(1)
+
+
+def run_jobs(jobs, max_jobs=None, cpus=None, max_memory=None, log_path=None, **options):
+    """
+    Run rice map jobs concurrently under a global CPU and memory budget.
+    max_jobs - maximum number of concurrent jobs, default as many as the CPU budget allows
+    cpus - number of processing units shared by the running jobs, default all
+    max_memory - memory shared by the running jobs (bytes or K/M/G/T string), default the available memory
+    log_path - folder of the job logs (engine output of each job), default output_path/logs of each job
+    options - engine.ricemap parameters common to all jobs
+    Each job runs in its own process with cpus / concurrent jobs processing units and max_memory / concurrent jobs
+    memory budget. Returns the summary of each job: name, status, wall time (s) and peak memory (bytes, job process
+    and its processing units).
+    """
+    cpus = cpu_count() if cpus is None else max(1, int(cpus))
+    max_memory = psutil.virtual_memory().available if max_memory is None else engine.parse_memory(max_memory)
+    concurrent = max(1, min(len(jobs), cpus, cpus if max_jobs is None else int(max_jobs)))
+    options = dict(options, threads=max(1, cpus // concurrent), max_memory=max_memory // concurrent)
+
+    print(f'Batch: {len(jobs)} job(s), {concurrent} concurrent, {options["threads"]} processing unit(s) and '
+          f'{options["max_memory"] / 1024**3:.3f}G per job')
+    context = engine.pool_context()
+    results = context.Queue()
+    pending, running, summary = list(jobs), {}, {}
+    start_time = time.time()
+    try:
+        while pending or running:
+            while pending and len(running) < concurrent:
+                job = pending.pop(0)
+                logs = os.path.join(job['output_path'], 'logs') if log_path is None else log_path
+                os.makedirs(logs, exist_ok=True)
+                worker = context.Process(target=_run_job, args=(job, options, os.path.join(logs, job['name'] + '.log'),
+                                                               results))
+                worker.start()
+                monitor = engine.MemoryMonitor(psutil.Process(worker.pid), 0.5)
+                monitor.start()
+                running[job['name']] = (worker, monitor, time.time())
+                print(f'- {job["name"]}: started')
+            try:
+                name, error = results.get(timeout=1)
+            except queue.Empty:
+                # job process gone without reporting (killed, crashed interpreter)
+                dead = [n for n, (worker, _, _) in running.items() if not worker.is_alive()]
+                if not dead:
+                    continue
+                name, error = dead[0], f'exit code {running[dead[0]][0].exitcode}'
+            if name not in running:
+                continue
+            worker, monitor, job_start = running.pop(name)
+            worker.join()
+            monitor.stop()
+            summary[name] = {'status': 'ok' if error is None else 'failed', 'error': error,
+                             'wall_time': time.time() - job_start, 'peak_memory': monitor.get_peak_memory()}
+            print(f'- {name}: {summary[name]["status"]}' + ('' if error is None else f' ({error})'))
+    finally:
+        for worker, monitor, _ in running.values():
+            worker.terminate()
+            monitor.stop()
+
+    print()
+    print(f'{"job":40s} {"status":8s} {"wall (s)":>10s} {"peak memory (G)":>16s}')
+    for job in jobs:
+        s = summary[job['name']]
+        print(f'{job["name"]:40s} {s["status"]:8s} {s["wall_time"]:10.1f} {s["peak_memory"] / 1024**3:16.3f}')
+    print(f'Batch completed in {time.time() - start_time:.1f}s '
+          f'({sum(s["wall_time"] for s in summary.values()):.1f}s of job time)')
+    return [dict(summary[job['name']], name=job['name']) for job in jobs]
@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import numba
+import psutil
+import numpy as np
+from datetime import datetime
+from pyproj import CRS
+from rasterio import open as rio_open, Env, __gdal_version__
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from . import Georice, engine, telemetry
+from .codecs import parse_codec, rasterio_options, quantize, quantized_lut
+from .standin import StandIn
+from .utils import load_config, save_config
+
+
+DEFAULT_CODECS = ['none', 'lzw', 'deflate', 'zstd:1', 'zstd:9', 'lerc:0.0001', 'lerc_zstd:0.0001']
+
+
+def benchmark_codecs(sample, codecs=DEFAULT_CODECS, size=2048, repeat=3, threads=1, block_size=512):
+    """
+    Measure the codec profiles (see georice.codecs) on a sample raster (first band, upper left size x size window).
+    Each profile writes the sample as tiled GeoTIFF and reads it back, repeat times, the best times are kept:
+    encode / decode MB/s are uncompressed megabytes per second, the file is read back from the page cache so decode
+    is the decompression throughput. threads - compression / decompression threads (GDAL NUM_THREADS)
+    Returns one dict per profile: codec, bytes (file size), ratio (uncompressed / file size), encode_mbs, decode_mbs
+    and max_error (largest absolute difference over the valid pixels, lossy profiles)
+    """
+    for codec in codecs:
+        parse_codec(codec)
+    with rio_open(sample, 'r') as dataset:
+        window = Window(0, 0, min(size, dataset.width), min(size, dataset.height))
+        data = dataset.read(1, window=window)
+        profile = {'driver': 'GTiff', 'dtype': data.dtype, 'nodata': dataset.nodata, 'width': data.shape[1],
+                   'height': data.shape[0], 'count': 1, 'crs': dataset.crs,
+                   'transform': dataset.window_transform(window), 'tiled': True, 'blockxsize': block_size,
+                   'blockysize': block_size, 'num_threads': threads}
+    valid = np.ones(data.shape, dtype=bool) if dataset.nodata is None else data != dataset.nodata
+    if np.issubdtype(data.dtype, np.floating):
+        valid &= np.isfinite(data)
+    megabytes = data.nbytes / 1024 ** 2
+    results = []
+    with tempfile.TemporaryDirectory() as folder, Env(GDAL_NUM_THREADS=str(threads)):
+        path = os.path.join(folder, 'sample.tif')
+        for codec in codecs:
+            options = rasterio_options(codec, data.dtype)
+            encode, decode = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                with rio_open(path, 'w', **profile, **options) as dest:
+                    dest.write(data, 1)
+                encode.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                with rio_open(path, 'r') as src:
+                    decoded = src.read(1)
+                decode.append(time.perf_counter() - start)
+            error = np.abs(decoded[valid].astype(np.float64) - data[valid])
+            results.append({'codec': codec, 'bytes': os.path.getsize(path),
+                            'ratio': data.nbytes / os.path.getsize(path),
+                            'encode_mbs': megabytes / min(encode), 'decode_mbs': megabytes / min(decode),
+                            'max_error': float(error.max()) if error.size > 0 else 0.0})
+            os.remove(path)
+    return results
+
+
+KERNELS = ['statistics', 'morphology', 'loading', 'write']
+# backscatter (dB) of the synthetic classes: rice is flooded (low) in the first half of the season then grows
+SYNTHETIC_CLASSES_DB = {'rice': (-22., -13.), 'trees': (-11., -11.), 'water': (-24., -24.), 'other': (-19., -17.)}
+
+
+def synthetic_cube(height, width, depth, nodata_fraction=0.1, seed=0, patch_size=64, looks=50):
+    """
+    Seeded synthetic VH backscatter time series: (depth, height, width) float32 linear cube and the dates (days since
+    day 1 of year 0, 12 days apart). The area is made of patch_size square patches of the SYNTHETIC_CLASSES_DB classes
+    with the residual speckle of the filtered scenes (gamma, looks); nodata_fraction of the pixels (columns along the
+    swath edge) have no data (0) at all dates.
+    """
+    rng = np.random.default_rng(seed)
+    cells = rng.integers(0, len(SYNTHETIC_CLASSES_DB), (-(-height // patch_size), -(-width // patch_size)))
+    classes = np.repeat(np.repeat(cells, patch_size, axis=0), patch_size, axis=1)[:height, :width]
+    start = np.array([db[0] for db in SYNTHETIC_CLASSES_DB.values()], dtype=np.float32)[classes]
+    stop = np.array([db[1] for db in SYNTHETIC_CLASSES_DB.values()], dtype=np.float32)[classes]
+    edge = int(round(min(max(nodata_fraction, 0.), 1.) * width))
+    cube = np.empty((depth, height, width), dtype=np.float32)
+    for t in range(depth):
+        season = max(0., 2. * t / max(depth - 1, 1) - 1.)
+        cube[t] = 10 ** ((start + (stop - start) * season) / 10)
+        cube[t] *= rng.gamma(looks, 1 / looks, (height, width)).astype(np.float32)
+        cube[t, :, :edge] = 0
+    time_0 = int(engine.date_to_jd_from_year_0(2020, 1, 1)) + 12 * np.arange(depth)
+    return cube, time_0
+
+
+def _measure(kernel, repeat, monitor):
+    """best wall time of repeat runs and peak memory (process and child processes) over the runs"""
+    base = engine.memory_usage(monitor.process)
+    monitor.reset()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        kernel()
+        times.append(time.perf_counter() - start)
+    # last sample, the kernel may be shorter than the polling delay
+    peak = max(monitor.get_peak_memory(), engine.memory_usage(monitor.process))
+    return min(times), peak, max(0, peak - base)
+
+
+def _revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _host():
+    return {'node': platform.node(), 'machine': platform.machine(), 'processor': platform.processor(),
+            'cpus': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'numba': numba.__version__, 'gdal': __gdal_version__}
+
+
+def _append_history(path, record, measure):
+    """
+    Append the run record to the history file (JSON lines), each result gets 'change': measure relative change from
+    the last run of the same host and parameters (None without one)
+    """
+    previous = next((r for r in reversed(load_history(path))
+                     if r['parameters'] == record['parameters'] and r['host'] == record['host']), None)
+    for name, result in record['results'].items():
+        before = None if previous is None else previous['results'].get(name)
+        result['change'] = None if before is None else result[measure] / before[measure] - 1
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a') as jsonl:
+        jsonl.write(json.dumps(record) + '\n')
+
+
+def load_history(path):
+    """Records of a kernel benchmark history file (JSON lines, see benchmark_kernels), [] if there is none"""
+    if path is None or not os.path.exists(path):
+        return []
+    with open(path) as history:
+        return [json.loads(line) for line in history if line.strip() != '']
+
+
+def benchmark_kernels(height=2048, width=2048, depth=30, nodata_fraction=0.1, kernels=KERNELS, threads=None, repeat=3,
+                      seed=0, block_size=None, compressor='deflate', scene_codec='lzw', quantized=False, history=None):
+    """
+    Measure the processing hot paths (see georice.engine) on a synthetic cube (see synthetic_cube), offline:
+    - statistics: global_statistics of the whole cube (numba, threads in this process, where a run splits the blocks
+      between worker processes)
+    - morphology: rice_mapping of the statistics (thresholds and small components removal, threads)
+    - loading: RasterReader reads of the cube blocks (block_size, default engine BLOCK_SIZE) from single date scenes
+      (scene_codec, striped as the downloaded scenes), the scenes are in the page cache: decode throughput
+    - write: saveToGTiff of the rice map and of the 4 statistics (compressor, engine tiling)
+    With quantized, the cube holds the uint16 codes of quantized scenes (see georice.codecs): the statistics decode
+    them in the kernel, the scenes are uint16 and loaded as is.
+    Each kernel runs repeat times, the best time is kept (the kernels are compiled / loaded first). Pixels / s count
+    the pixels of the area (a whole time series for the statistics and loading), MB / s the uncompressed bytes the
+    kernel consumes (cube, statistics) or produces (products). peak_memory is the process (and child processes) peak
+    during the kernel, memory_increase the part above the memory in use before it.
+    Returns the run record {'date', 'revision', 'host', 'parameters', 'results': {kernel: {...}}}; with history (path)
+    it is appended as a JSON line and each result gets 'change': pixels / s relative change from the last run of the
+    same host and parameters (None without one).
+    """
+    for kernel in kernels:
+        if kernel not in KERNELS:
+            raise ValueError(f'unknown kernel "{kernel}", expected one of: {", ".join(KERNELS)}')
+    threads = engine.NUMBER_OF_THREADS if threads is None else max(1, threads)
+    block_size = engine.BLOCK_SIZE if block_size is None else block_size
+    parameters = {'height': height, 'width': width, 'depth': depth, 'nodata_fraction': nodata_fraction,
+                  'threads': threads, 'repeat': repeat, 'seed': seed, 'block_size': block_size,
+                  'compressor': compressor, 'scene_codec': scene_codec, 'quantized': quantized}
+    record = {'date': datetime.now().isoformat(timespec='seconds'), 'revision': _revision(), 'host': _host(),
+              'parameters': parameters, 'results': {}}
+    
+    cube, time_0 = synthetic_cube(height, width, depth, nodata_fraction, seed)
+    lut = None
+    if quantized:
+        cube, lut = quantize(cube), quantized_lut()
+    stats = [np.empty((height, width), dtype=np.float32) for _ in range(4)]
+    pixels = height * width
+    numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+    engine.warm_up(quantized=quantized)
+    # statistics are needed by the morphology and write kernels
+    engine.global_statistics(cube, time_0, *stats, lut)
+    thresholds = (engine.RICE_THRESHOLD_DB, engine.urban_trees_threshold_dB, engine.water_threshold_dB)
+    ricemap = engine.rice_mapping(*stats, *thresholds, threads)
+    
+    monitor = engine.MemoryMonitor(psutil.Process(), 0.01)
+    monitor.start()
+    with tempfile.TemporaryDirectory() as folder:
+        for kernel in kernels:
+            if kernel == 'statistics':
+                run, size = lambda: engine.global_statistics(cube, time_0, *stats, lut), cube.nbytes
+            elif kernel == 'morphology':
+                run, size = lambda: engine.rice_mapping(*stats, *thresholds, threads), 4 * stats[0].nbytes
+            elif kernel == 'loading':
+                paths = _write_scenes(cube, folder, scene_codec)
+                run, size = lambda: _load_blocks(paths, cube.shape, block_size, cube.dtype), cube.nbytes
+            else:
+                run = lambda: _write_products(ricemap, stats, folder, compressor)
+                size = ricemap.nbytes + 4 * stats[0].nbytes
+            seconds, peak, increase = _measure(run, repeat, monitor)
+            record['results'][kernel] = {'seconds': seconds, 'pixels_per_s': pixels / seconds,
+                                         'mb_per_s': size / 1024 ** 2 / seconds, 'peak_memory': peak,
+                                         'memory_increase': increase}
+    monitor.stop()
+    
+    if history is not None:
+        _append_history(history, record, 'pixels_per_s')
+    return record
+
+
+def _write_scenes(cube, folder, codec):
+    """single date scenes of the cube, as written by the download (striped, codec profile), returns their paths"""
+    depth, height, width = cube.shape
+    profile = {'driver': 'GTiff', 'dtype': cube.dtype.name, 'nodata': 0, 'width': width, 'height': height, 'count': 1,
+               'crs': 'EPSG:32648', 'transform': Affine(10, 0, 500000, 0, -10, 1500000)}
+    paths = []
+    for t in range(depth):
+        paths.append(os.path.join(folder, f'scene_{t:03d}.tif'))
+        with rio_open(paths[-1], 'w', **profile, **rasterio_options(codec, cube.dtype)) as dest:
+            dest.write(cube[t], 1)
+    return paths
+
+
+def _load_blocks(paths, shape, block_size, dtype=np.float32):
+    depth, height, width = shape
+    reader = engine.RasterReader(paths)
+    buffer = np.empty((depth, block_size, block_size), dtype=dtype)
+    try:
+        for y in range(0, height, block_size):
+            for x in range(0, width, block_size):
+                window = Window(x, y, min(block_size, width - x), min(block_size, height - y))
+                reader.read(window, buffer[:, :window.height, :window.width])
+    finally:
+        reader.close()
+
+
+def _write_products(ricemap, stats, folder, compressor):
+    projection = CRS.from_epsg(32648).to_wkt()
+    transform = [500000, 10, 0, 1500000, 0, -10]
+    size = engine.TIFF_BLOCK_SIZE
+    options = ['TILED=YES', f'BLOCKXSIZE={size}', f'BLOCKYSIZE={size}'] if size >= 16 else ['TILED=NO']
+    engine.saveToGTiff(ricemap, os.path.join(folder, 'ricemap.tif'), projection, transform, nodata=0,
+                       compressor=compressor, extra_options=options)
+    for name, data in zip(['mean', 'max_increase', 'min', 'max'], stats):
+        engine.saveToGTiff(data, os.path.join(folder, f'{name}.tif'), projection, transform,
+                           compressor=compressor, extra_options=options)
+
+
+def benchmark_download(bbox=(500000, 1500000, 505000, 1505000), epsg=32648, period=('20200101', '20201231'),
+                       orbit='018', direction='DES', latency=0.2, jitter=0.1, bandwidth=20 * 1024 ** 2,
+                       throttle_rate=0.05, retry_after=1000, failure_rate=0.01, seed=0, quantized=False, history=None):
+    """
+    End to end measure of Georice.find_scenes + Georice.get_ricemap (no speckle filtering) against the local Sentinel
+    Hub stand-in (see georice.standin) with the given network conditions: latency (+ jitter) per request (s),
+    bandwidth (bytes / s), throttle_rate (429, retry_after ms) and failure_rate (503) of the Process API requests.
+    With quantized, the scenes are downloaded, stored and processed as uint16 codes (see georice.codecs).
+    The tile is processed in a temporary output folder, the configured one is restored afterwards.
+    Returns the run record {'date', 'revision', 'host', 'parameters', 'results': {'end_to_end': {...}}}: scenes,
+    seconds, scenes_per_min (end to end), download_scenes_per_min (download stage only), the wall seconds of the
+    stages (see georice.telemetry), the requests / throttled / failed answers and MB served by the stand-in. With
+    history (path) it is appended as a JSON line, 'change' being the scenes_per_min relative change from the last run
+    of the same host and parameters.
+    """
+    parameters = {'bbox': list(bbox), 'epsg': epsg, 'period': list(period), 'orbit': orbit, 'direction': direction,
+                  'latency': latency, 'jitter': jitter, 'bandwidth': bandwidth, 'throttle_rate': throttle_rate,
+                  'retry_after': retry_after, 'failure_rate': failure_rate, 'seed': seed, 'quantized': quantized}
+    record = {'date': datetime.now().isoformat(timespec='seconds'), 'revision': _revision(), 'host': _host(),
+              'parameters': parameters, 'results': {}}
+    config = load_config()
+    standin = StandIn(orbit, 'DESCENDING' if direction == 'DES' else 'ASCENDING', latency=latency, jitter=jitter,
+                      bandwidth=bandwidth, throttle_rate=throttle_rate, retry_after=retry_after,
+                      failure_rate=failure_rate, seed=seed)
+    with standin, tempfile.TemporaryDirectory() as folder:
+        save_config({'output': folder, 'quantized': quantized})
+        try:
+            georice = Georice()
+            standin.configure(georice._imagery.SHConfig)
+            with telemetry.session(name='benchmark_download') as session:
+                start = time.perf_counter()
+                georice.find_scenes(bbox, epsg, period, info=False)
+                georice.get_ricemap('Benchmark', period, direction, orbit, filtering=False)
+                seconds = time.perf_counter() - start
+        finally:
+            save_config({'output': config['output'], 'quantized': config.get('quantized', False)})
+    scenes = len(georice._imagery._scenes)
+    stages = {}
+    for stage in session.records:
+        stages[stage['stage']] = stages.get(stage['stage'], 0) + stage['wall_s']
+    record['results']['end_to_end'] = {
+        'scenes': scenes, 'seconds': seconds, 'scenes_per_min': 60 * scenes / seconds,
+        'download_scenes_per_min': 60 * scenes / stages['download'] if stages.get('download') else None,
+        'stages': stages, 'requests': standin.counters['requests'], 'throttled': standin.counters['throttled'],
+        'failed': standin.counters['failed'], 'mb': standin.counters['bytes'] / 1024 ** 2}
+    if history is not None:
+        _append_history(history, record, 'scenes_per_min')
+    return record
@@ -0,0 +1,137 @@
+import os
+import sqlite3
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from rasterio import open as rio_open
+
+
+class Catalog:
+    """
+    Persistent index of the Sentinel-1 scenes of a folder (SQLite file catalog.sqlite in the folder).
+
+    Scene files are named satellite_tile_polarisation_direction_orbit_YYYYMMDD_txxxxxx[...].tif (see
+    GetSentinel.scene_name); each one is a row: file, tile, satellite, polar, direction, orbit, date (YYYYMMDD), txxx
+    (txxxxxx flag), mtime, size, width and height. The writers add their scenes as they write them (add), sync
+    reconciles the index with the folder listing only when the folder changed since the last sync (folder mtime), so
+    the scene selection is an indexed query instead of parsing every file name.
+    """
+
+    FILE = 'catalog.sqlite'
+    VERSION = 1
+    THREADS = 8
+    COLUMNS = ['file', 'tile', 'satellite', 'polar', 'direction', 'orbit', 'date', 'txxx', 'mtime', 'size', 'width',
+               'height']
+
+    def __init__(self, folder, path=None):
+        self.folder = folder
+        self.connection = sqlite3.connect(os.path.join(folder, self.FILE) if path is None else path, timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        # the journal file is kept, so the writes do not change the folder mtime (see sync)
+        self.connection.execute('PRAGMA journal_mode=PERSIST')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS scenes (file TEXT PRIMARY KEY, tile TEXT, '
+                                    'satellite TEXT, polar TEXT, direction TEXT, orbit TEXT, date TEXT, '
+                                    'txxx INTEGER, mtime REAL, size INTEGER, width INTEGER, height INTEGER)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS selection ON scenes (polar, orbit, direction, date)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (self.VERSION,))
+
+    @classmethod
+    def open(cls, folder):
+        """Catalog of the folder, an in-memory one (built by sync) if the folder catalog cannot be written"""
+        try:
+            return cls(folder)
+        except sqlite3.Error:
+            return cls(folder, ':memory:')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def parse(file):
+        """Catalog fields of a scene file name (tile ... txxx), None if it is not a scene"""
+        if not (file.startswith('S1') and file.endswith('.tif')):
+            return None
+        parts = file[:-len('.tif')].split('_')
+        if len(parts) < 6:
+            return None
+        try:
+            date = datetime.strptime(parts[5][:8], '%Y%m%d').strftime('%Y%m%d')
+        except ValueError:
+            return None
+        return {'tile': parts[1], 'satellite': parts[0], 'polar': parts[2].upper(), 'direction': parts[3],
+                'orbit': parts[4], 'date': date, 'txxx': int('txxxxxx' in file)}
+
+    def _row(self, file, stat, shape=None):
+        fields = self.parse(file)
+        if fields is None:
+            return None
+        if shape is None:
+            try:
+                with rio_open(os.path.join(self.folder, file)) as dataset:
+                    shape = dataset.height, dataset.width
+            except Exception:
+                shape = None, None
+        return dict(fields, file=file, mtime=stat.st_mtime, size=stat.st_size, height=shape[0], width=shape[1])
+
+    def _upsert(self, rows):
+        with self.connection:
+            self.connection.executemany(f'INSERT OR REPLACE INTO scenes ({", ".join(self.COLUMNS)}) VALUES '
+                                        f'({", ".join(":" + c for c in self.COLUMNS)})', rows)
+
+    def add(self, file, shape=None):
+        """Add (or refresh) a scene of the folder just written, shape (height, width) if known"""
+        row = self._row(file, os.stat(os.path.join(self.folder, file)), shape)
+        if row is not None:
+            self._upsert([row])
+
+    def sync(self, force=False):
+        """
+        Reconcile the catalog with the folder: new or changed scene files (mtime, size) are added, missing ones
+        removed. Skipped if the folder did not change since the last sync (unless force). Returns the number of
+        scenes added / refreshed and removed.
+        """
+        # taken before listing, a change during the listing is caught by the next sync
+        folder_mtime = os.stat(self.folder).st_mtime_ns
+        known = self.connection.execute("SELECT value FROM meta WHERE key = 'folder_mtime'").fetchone()
+        if not force and known is not None and known[0] == folder_mtime:
+            return 0, 0
+        indexed = {row['file']: (row['mtime'], row['size']) for row in
+                   self.connection.execute('SELECT file, mtime, size FROM scenes')}
+        changed, present = [], set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if self.parse(entry.name) is None or not entry.is_file():
+                    continue
+                present.add(entry.name)
+                stat = entry.stat()
+                if indexed.get(entry.name) != (stat.st_mtime, stat.st_size):
+                    changed.append((entry.name, stat))
+        # raster headers of the new scenes are read concurrently
+        with ThreadPoolExecutor(self.THREADS) as executor:
+            rows = list(executor.map(lambda scene: self._row(*scene), changed))
+        removed = [(file,) for file in indexed if file not in present]
+        self._upsert(rows)
+        with self.connection:
+            self.connection.executemany('DELETE FROM scenes WHERE file = ?', removed)
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('folder_mtime', ?)",
+                                    (folder_mtime,))
+        return len(rows), len(removed)
+
+    def select(self, orbit, direction, starting_date, ending_date, polar='VH'):
+        """Scenes (rows) of an orbit / direction / polarisation within [starting_date, ending_date] (YYYYMMDD)"""
+        return self.connection.execute('SELECT * FROM scenes WHERE polar = ? AND orbit = ? AND direction = ? AND '
+                                       'date BETWEEN ? AND ? ORDER BY date', (polar.upper(), orbit, direction,
+                                                                              starting_date, ending_date)).fetchall()
+
+    def combinations(self, polar='VH'):
+        """(direction, orbit) combinations of the scenes of a polarisation, and the (first, last) date of all scenes"""
+        combinations = [tuple(row) for row in self.connection.execute(
+            'SELECT DISTINCT direction, orbit FROM scenes WHERE polar = ? ORDER BY direction, orbit', (polar.upper(),))]
+        return combinations, tuple(self.connection.execute('SELECT MIN(date), MAX(date) FROM scenes').fetchone())
@@ -3,9 +3,9 @@
 import click
 import json
 import os
-import subprocess
 
 from georice.utils import set_sh, show_sh, load_config, show_config
+from georice.ricemap import Ricemap
 
 
 @click.group()
@@ -108,28 +108,22 @@ def imagery(bbox, geopath, epsg, period, tile):
 @click.option('--all', '-a', 'a', is_flag=True, required=False,
               help='Generate rice maps for all combinations of orbit number, '
                    'direction a period found at scene directory')
-def ricemap(tile, a):
+@click.option('--jobs', '-j', 'jobs', type=int, default=None, required=False,
+              help='--all: maximum number of rice maps generated concurrently')
+@click.option('--cpus', '-c', 'cpus', type=int, default=None, required=False,
+              help='--all: number of processing units shared by the concurrent rice maps, default all')
+@click.option('--max_memory', '-mm', 'max_memory', type=str, default=None, required=False,
+              help='--all: memory shared by the concurrent rice maps (bytes or K/M/G/T suffix i.e. 32G), '
+                   'default the available memory')
+def ricemap(tile, a, jobs, cpus, max_memory):
     """
     Generate rice map from Sentinel imagery
     Tile - tile name used for downolad of scenes
     """
     if a:
-        scene_path = os.path.join(load_config()['output'], tile, 'scenes')
-        period, orb_num, orbit_path = set(), set(), set()
-        with os.scandir(scene_path) as files:
-            for file in files:
-                if file.is_file():
-                    parsed = file.name.split('_')
-                    period.add(parsed[5])
-                    orb_num.add(parsed[4])
-                    orbit_path.add(parsed[3])
-        for orbit in orbit_path:
-            for num in orb_num:
-                command = ['ricemap.py', scene_path, num, min(period), max(period),
-                           config['output'], '-d', orbit]
-                subprocess.run(' '.join(command), shell=True)
-                click.echo(f'Ricemap for orbit path/orbit number/period: {orbit}/{num}/{min(period)}/{max(period)} '
-                           f'saved at folder: {os.path.join(load_config()["output"], tile)}')
+        summary = Ricemap().ricemap_all(tile, max_jobs=jobs, cpus=cpus, max_memory=max_memory)
+        click.echo(f'{sum(job["status"] == "ok" for job in summary)}/{len(summary)} rice maps saved at folder: '
+                   f'{os.path.join(load_config()["output"], tile)}')
 
 
 @ricemap.command('get')
@@ -145,24 +139,212 @@ def ricemap(tile, a):
               help='write output tiff products using LZW compression instead of DEFLATE (compatibility with ENVI/IDL)')
 @click.option('--mask', '-m', 'mask', is_flag=True, required=False,
               help='generate and write rice, trees, water, other and nodata masks')
+@click.option('--multiband', '-mb', 'multiband', is_flag=True, required=False,
+              help='with --mask, write the 5 class masks as one 5 bands product')
 @click.option('--noreproject', '-nr', 'nr', is_flag=True, required=False,
               help='diable automatic reprojection to EPSG:4326')
-def get(orbit_number, starting_date, ending_date, tile, orbit_path, inter, lzw, mask, nr):
+@click.option('--cog', 'cog', is_flag=True, required=False,
+              help='write cloud optimized geotiffs with internal overviews')
+@click.option('--telemetry', '-tm', 'telemetry_path', type=str, default=None, required=False,
+              help='folder of the per stage performance telemetry (JSON lines and Prometheus textfile)')
+@click.option('--profile', 'profile', is_flag=True, required=False,
+              help='with --telemetry, profile each stage (cProfile)')
+@click.option('--codec', 'codec', type=str, default=None, required=False,
+              help="codec profile of the products, name or name:parameter i.e. 'zstd:9' or 'lerc:0.001', default the "
+                   "config key codec, else deflate")
+@click.option('--max_memory', '-mm', 'max_memory', type=str, default=None, required=False,
+              help='memory budget (bytes or K/M/G/T suffix i.e. 8G), block size is chosen to fit in it')
+@click.option('--datacube', '-dc', 'datacube', is_flag=True, required=False,
+              help='read the time series from the tile datacube, appending the missing dates')
+@click.option('--update', '-u', 'update', is_flag=True, required=False,
+              help='incremental update, only the dates added since the last run are processed')
+@click.option('--sweep', '-sw', 'sweep', type=str, default=None, required=False,
+              help="threshold sweep, rice,trees,water triples (dB) separated by ';', values can be start:stop:step "
+                   "ranges i.e. '4:6:0.5,-18,-18'")
+def get(orbit_number, starting_date, ending_date, tile, orbit_path, inter, lzw, mask, multiband, nr, cog,
+        telemetry_path, profile, codec, max_memory, datacube, update, sweep):
     """
     Generate rice map for specyfic parameters.
     NOTE: starting_date / ending_date => YYYYMMDD, inclusive
     """
-    scene_path = os.path.join(load_config()['output'], tile, 'scenes')
-    command = ['ricemap.py', scene_path, orbit_number, starting_date, ending_date, load_config()['output']]
-    if orbit_path:
-        command.append('-d ' + orbit_path)
-    if inter:
-        command.append('-i')
-    if lzw:
-        command.append('-lzw')
-    if mask:
-        command.append('-m')
-    if nr:
-        command.append('-nr')
-    subprocess.run(' '.join(command), shell=True)
+    Ricemap().ricemap_get(tile, orbit_number, (starting_date, ending_date), orbit_path, inter, lzw, mask, nr,
+                          max_memory=max_memory, datacube=datacube, update=update, sweep=sweep,
+                          multiband_masks=multiband, cog=cog, codec=codec, telemetry_path=telemetry_path,
+                          profile=profile)
     click.echo(f'Rice map saved into folder: {os.path.join(load_config()["output"], tile)}')
+
+
+@main.command('worker')
+@click.option('--queue', '-q', 'queue_path', type=str, default=None, required=False,
+              help='folder of the job queue (queue.sqlite), default the output folder')
+@click.option('--workers', '-w', 'workers', type=int, default=1, required=False,
+              help='number of worker processes on this node')
+@click.option('--lease', '-l', 'lease', type=float, default=120., required=False,
+              help='lease of a job (s), renewed while it runs; a job of a crashed worker is leased again after it')
+@click.option('--polling', '-p', 'polling_delay', type=float, default=5., required=False,
+              help='delay (s) between the polls of the queue when no job can be leased')
+def worker(queue_path, workers, lease, polling_delay):
+    """
+    Run the rice map jobs submitted to the queue (see Georice.submit_ricemap) until none is pending or leased, the
+    nodes share the output folder
+    """
+    from .jobqueue import work, run_workers
+
+    if workers > 1:
+        run_workers(workers, queue_path, lease=lease, polling_delay=polling_delay)
+    else:
+        done, failed = work(queue_path, lease=lease, polling_delay=polling_delay)
+        click.echo(f'Worker: {done} job(s) done, {failed} failed')
+
+
+@main.command('queue')
+@click.option('--queue', '-q', 'queue_path', type=str, default=None, required=False,
+              help='folder of the job queue (queue.sqlite), default the output folder')
+@click.option('--batch', '-b', 'batch', type=str, default=None, required=False, help='jobs of this batch only')
+def queue(queue_path, batch):
+    """Show the jobs of the queue: batch, name, status, worker, leases, error"""
+    from .jobqueue import JobQueue
+
+    with JobQueue(queue_path or load_config()['output']) as jobs:
+        for job in jobs.jobs(batch):
+            click.echo(f'{job["batch"]:30s} {job["name"]:24s} {job["status"]:8s} {job["worker"] or "":24s} '
+                       f'{job["attempts"]:2d} {job["error"] or ""}')
+
+
+@main.group('benchmark')
+def benchmark():
+    """Benchmarks of the georice writers, processing kernels and download"""
+    pass
+
+
+@benchmark.command('codecs')
+@click.argument('sample', required=False, default=None)
+@click.option('--tile', '-t', 'tile', type=str, default='Tile', required=False,
+              help='Tile name, without sample the first scene of the tile is used')
+@click.option('--codec', '-c', 'codecs', type=str, multiple=True, required=False,
+              help="codec profile to measure (repeatable), name or name:parameter i.e. 'zstd:9' or 'lerc:0.001', "
+                   "default a set of common profiles")
+@click.option('--size', '-s', 'size', type=int, default=2048, required=False,
+              help='side of the sample window (pixels), default 2048')
+@click.option('--repeat', '-r', 'repeat', type=int, default=3, required=False,
+              help='measures per profile, the best one is kept')
+@click.option('--threads', '-th', 'threads', type=int, default=1, required=False,
+              help='compression / decompression threads')
+def codecs_benchmark(sample, tile, codecs, size, repeat, threads):
+    """
+    Encode / decode throughput (MB/s) and compression ratio of codec profiles on a sample raster
+    """
+    from .benchmark import benchmark_codecs, DEFAULT_CODECS
+
+    if sample is None:
+        scene_path = os.path.join(load_config()['output'], tile, 'scenes')
+        scenes = sorted(f for f in os.listdir(scene_path) if f.endswith('.tif')) if os.path.isdir(scene_path) else []
+        if len(scenes) == 0:
+            click.echo(f'Command aborted. No sample given and no scene found in folder {scene_path}')
+            return
+        sample = os.path.join(scene_path, scenes[0])
+    click.echo(f'Sample: {sample}')
+    click.echo(f'{"codec":<20}{"ratio":>8}{"encode MB/s":>14}{"decode MB/s":>14}{"max error":>12}')
+    for result in benchmark_codecs(sample, list(codecs) or DEFAULT_CODECS, size, repeat, threads):
+        click.echo(f'{result["codec"]:<20}{result["ratio"]:>8.2f}{result["encode_mbs"]:>14.1f}'
+                   f'{result["decode_mbs"]:>14.1f}{result["max_error"]:>12.3g}')
+
+
+@benchmark.command('kernels')
+@click.option('--size', '-s', 'size', type=str, default='2048', required=False,
+              help='synthetic area, side or HEIGHTxWIDTH (pixels), default 2048')
+@click.option('--depth', '-d', 'depth', type=int, default=30, required=False,
+              help='number of dates of the synthetic time series, default 30')
+@click.option('--nodata', '-n', 'nodata_fraction', type=float, default=0.1, required=False,
+              help='fraction of the pixels without data, default 0.1')
+@click.option('--kernel', '-k', 'kernels', type=click.Choice(['statistics', 'morphology', 'loading', 'write']),
+              multiple=True, required=False, help='kernel to measure (repeatable), default all')
+@click.option('--threads', '-th', 'threads', type=int, default=None, required=False,
+              help='processing threads, default host dependant')
+@click.option('--repeat', '-r', 'repeat', type=int, default=3, required=False,
+              help='measures per kernel, the best one is kept')
+@click.option('--seed', 'seed', type=int, default=0, required=False, help='seed of the synthetic data')
+@click.option('--quantized', '-q', 'quantized', is_flag=True,
+              help='uint16 codes of quantized scenes instead of float32 backscatter')
+@click.option('--history', '-hi', 'history', type=str, default=None, required=False,
+              help='history file (JSON lines) the run is appended to, and compared with the last run of the same '
+                   'host and parameters')
+@click.option('--max-slowdown', 'max_slowdown', type=float, default=None, required=False,
+              help='with --history, exit with status 1 if a kernel is slower than the last run by more than this '
+                   'fraction (i.e. 0.1)')
+def kernels_benchmark(size, depth, nodata_fraction, kernels, threads, repeat, seed, quantized, history, max_slowdown):
+    """
+    Throughput (pixels/s, MB/s) and peak memory of the processing kernels on a synthetic time series, offline
+    """
+    from .benchmark import benchmark_kernels, KERNELS
+
+    height, _, width = size.lower().partition('x')
+    height, width = int(height), int(width or height)
+    record = benchmark_kernels(height, width, depth, nodata_fraction, list(kernels) or KERNELS, threads, repeat, seed,
+                               quantized=quantized, history=history)
+    click.echo(f'Synthetic cube: {depth} x {height} x {width}, nodata {nodata_fraction:g}'
+               f'{", quantized" if quantized else ""}, threads {record["parameters"]["threads"]}, '
+               f'revision {record["revision"]}')
+    click.echo(f'{"kernel":<12}{"seconds":>10}{"Mpixels/s":>12}{"MB/s":>10}{"peak GB":>10}{"+GB":>8}{"change":>9}')
+    regressions = []
+    for kernel, result in record['results'].items():
+        change = result.get('change')
+        click.echo(f'{kernel:<12}{result["seconds"]:>10.3f}{result["pixels_per_s"] / 1e6:>12.2f}'
+                   f'{result["mb_per_s"]:>10.1f}{result["peak_memory"] / 1024 ** 3:>10.3f}'
+                   f'{result["memory_increase"] / 1024 ** 3:>8.3f}{"" if change is None else f"{change:+.1%}":>9}')
+        if max_slowdown is not None and change is not None and change < -max_slowdown:
+            regressions.append(kernel)
+    if len(regressions) > 0:
+        click.echo(f'Regression: {", ".join(regressions)} slower than the last run by more than {max_slowdown:.0%}')
+        click.get_current_context().exit(1)
+
+
+@benchmark.command('download')
+@click.option('--bbox', '-b', 'bbox', type=str, default='500000,1500000,505000,1505000', required=False,
+              help='area of interest x0,y0,x1,y1, default a 5 km square')
+@click.option('--epsg', '-e', 'epsg', type=int, default=32648, required=False, help='EPSG code of the bbox')
+@click.option('--period', '-p', 'period', type=(str, str), default=('20200101', '20201231'), required=False,
+              help='period of the scenes YYYYMMDD YYYYMMDD, default the year 2020')
+@click.option('--latency', '-l', 'latency', type=float, default=0.2, required=False,
+              help='latency of each request (seconds), default 0.2')
+@click.option('--jitter', '-j', 'jitter', type=float, default=0.1, required=False,
+              help='random extra latency (seconds), default 0.1')
+@click.option('--bandwidth', '-bw', 'bandwidth', type=float, default=20, required=False,
+              help='bandwidth of the responses (MB/s), 0 unlimited, default 20')
+@click.option('--throttle', '-t', 'throttle_rate', type=float, default=0.05, required=False,
+              help='fraction of the Process API requests answered 429 (rate limit), default 0.05')
+@click.option('--retry-after', 'retry_after', type=int, default=1000, required=False,
+              help='Retry-After of the 429 answers (ms), default 1000')
+@click.option('--failures', '-f', 'failure_rate', type=float, default=0.01, required=False,
+              help='fraction of the Process API requests answered 503, default 0.01')
+@click.option('--quantized', '-q', 'quantized', is_flag=True,
+              help='download, store and process the scenes as uint16 codes (config key quantized)')
+@click.option('--history', '-hi', 'history', type=str, default=None, required=False,
+              help='history file (JSON lines) the run is appended to, and compared with the last run of the same '
+                   'host and parameters')
+@click.option('--max-slowdown', 'max_slowdown', type=float, default=None, required=False,
+              help='with --history, exit with status 1 if scenes/min dropped from the last run by more than this '
+                   'fraction (i.e. 0.1)')
+def download_benchmark(bbox, epsg, period, latency, jitter, bandwidth, throttle_rate, retry_after, failure_rate,
+                       quantized, history, max_slowdown):
+    """
+    End to end scenes/min of the scene search, download and rice map processing against a local Sentinel Hub
+    stand-in with simulated network conditions (no speckle filtering), offline
+    """
+    from .benchmark import benchmark_download
+
+    record = benchmark_download(tuple(float(v) for v in bbox.split(',')), epsg, period, latency=latency,
+                                jitter=jitter, bandwidth=bandwidth * 1024 ** 2 or None, throttle_rate=throttle_rate,
+                                retry_after=retry_after, failure_rate=failure_rate, quantized=quantized,
+                                history=history)
+    result = record['results']['end_to_end']
+    click.echo(f'Scenes: {result["scenes"]}, {result["seconds"]:.1f}s => {result["scenes_per_min"]:.1f} scenes/min '
+               f'end to end, {result["download_scenes_per_min"] or 0:.1f} scenes/min download')
+    click.echo(f'Requests: {result["requests"]} ({result["throttled"]} throttled, {result["failed"]} failed), '
+               f'{result["mb"]:.1f} MB')
+    click.echo('Stages: ' + ', '.join(f'{stage} {seconds:.1f}s' for stage, seconds in result['stages'].items()))
+    if result['change'] is not None:
+        click.echo(f'Change from the last run: {result["change"]:+.1%}')
+        if max_slowdown is not None and result['change'] < -max_slowdown:
+            click.echo(f'Regression: slower than the last run by more than {max_slowdown:.0%}')
+            click.get_current_context().exit(1)
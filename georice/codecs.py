@@ -0,0 +1,104 @@
+import numpy as np
+
+
+# codec profile names, a profile is 'name' or 'name:parameter' i.e. 'zstd:9', 'lerc:0.001'
+# - deflate / zstd: parameter is the compression level
+# - lerc, lerc_deflate, lerc_zstd: parameter is the max error of floating point data (default 0, lossless)
+# - jpeg / webp: parameter is the quality
+CODECS = ['none', 'deflate', 'lzw', 'zstd', 'lerc', 'lerc_deflate', 'lerc_zstd', 'jpeg', 'webp']
+LEVEL_OPTIONS = {'deflate': 'ZLEVEL', 'zstd': 'ZSTD_LEVEL', 'jpeg': 'JPEG_QUALITY', 'webp': 'WEBP_LEVEL'}
+# lossless codec used instead of lerc for integer data (lerc does not handle sub-byte data, and the max error is
+# meant for backscatter)
+LERC_INTEGER_CODECS = {'lerc': 'zstd', 'lerc_zstd': 'zstd', 'lerc_deflate': 'deflate'}
+
+
+def parse_codec(profile, parameter=None):
+    """
+    Split a codec profile ('name' or 'name:parameter') into (name, parameter), parameter is None if not set.
+    An explicit parameter (i.e. a compression level) is used when the profile has none.
+    """
+    name, _, value = str(profile).lower().partition(':')
+    if name not in CODECS:
+        raise ValueError(f'unknown codec "{name}", expected one of: {", ".join(CODECS)}')
+    if value != '':
+        parameter = float(value)
+    if parameter is not None and name not in ['lerc', 'lerc_deflate', 'lerc_zstd']:
+        parameter = int(parameter)
+    return name, parameter
+
+
+def gdal_options(profile, dtype, parameter=None, nbits=None):
+    """
+    GeoTIFF creation options (GDAL 'KEY=VALUE' strings) of a codec profile for the given data type.
+    Predictor: floating point (3) for float data, horizontal differencing (2) for integer data, none for sub-byte data
+    (nbits) and lossy codecs. lerc codecs only apply to float data, integer data use their lossless counterpart.
+    """
+    name, parameter = parse_codec(profile, parameter)
+    if name == 'none':
+        return []
+    floating = np.issubdtype(np.dtype(dtype), np.floating)
+    if name in LERC_INTEGER_CODECS and (not floating or nbits is not None):
+        name, parameter = LERC_INTEGER_CODECS[name], None
+    options = ['COMPRESS=' + name.upper()]
+    if name in ['deflate', 'lzw', 'zstd'] and nbits is None:
+        options.append('PREDICTOR=3' if floating else 'PREDICTOR=2')
+    if name.startswith('lerc'):
+        options.append('MAX_Z_ERROR=' + repr(float(parameter or 0)))
+    elif parameter is not None and name in LEVEL_OPTIONS:
+        options.append(LEVEL_OPTIONS[name] + '=' + str(parameter))
+    return options
+
+
+def rasterio_options(profile, dtype, parameter=None, nbits=None):
+    """Creation options of a codec profile as rasterio keywords (see gdal_options)"""
+    return dict((key.lower(), value) for key, value in
+                (option.split('=', 1) for option in gdal_options(profile, dtype, parameter, nbits)))
+
+
+# quantized scenes: uint16 codes of the backscatter in dB, code = round((dB - QUANTIZED_DB_MIN) * QUANTIZED_DB_SCALE)
+# + 1 clipped to [1, 65535] (-60 dB to +71 dB by 0.002 dB steps), 0 is nodata (backscatter <= 0 or not a number).
+# Decoded values within [-60 dB, +71 dB] are within half a step (0.001 dB, relative error 0.023 %) of the float32 ones;
+# values out of it are clipped: lower ones are decoded as -60 dB (1e-6), higher ones (and +inf) as +71 dB.
+QUANTIZED_DTYPE = 'uint16'
+QUANTIZED_NODATA = 0
+QUANTIZED_DB_MIN = -60.
+QUANTIZED_DB_SCALE = 500.
+QUANTIZED_MAX_DB_ERROR = 0.5 / QUANTIZED_DB_SCALE
+
+
+def quantized_lut():
+    """float32 linear backscatter of each uint16 code (0 for nodata), the decoding table of the quantized scenes"""
+    codes = np.arange(65536, dtype=np.float64)
+    lut = (10 ** ((QUANTIZED_DB_MIN + (codes - 1) / QUANTIZED_DB_SCALE) / 10)).astype(np.float32)
+    lut[QUANTIZED_NODATA] = 0
+    return lut
+
+
+def quantize(values):
+    """uint16 codes of linear backscatter values (see quantized_lut)"""
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        codes = np.rint((10 * np.log10(values) - QUANTIZED_DB_MIN) * QUANTIZED_DB_SCALE) + 1
+    codes = np.clip(np.nan_to_num(codes, nan=0, posinf=65535, neginf=1), 1, 65535)
+    return np.where(values > 0, codes, QUANTIZED_NODATA).astype(np.uint16)
+
+
+def quantized_evalscript(band):
+    """Process API evalscript returning the uint16 codes of a band (see quantize), computed by the service"""
+    return '''//VERSION=3
+                    function setup() {
+                      return {
+                        input: ["BAND"],
+                        output: { id:"default", bands: 1, sampleType: SampleType.UINT16}
+                      }
+                    }
+
+                    function evaluatePixel(samples) {
+                      var v = samples.BAND;
+                      if (!(v > 0)) {
+                        return [NODATA];
+                      }
+                      var code = Math.round((10 * Math.log(v) / Math.LN10 - (DB_MIN)) * DB_SCALE) + 1;
+                      return [Math.min(65535, Math.max(1, code))];
+                    }'''.replace('BAND', band).replace('NODATA', str(QUANTIZED_NODATA)) \
+        .replace('DB_MIN', repr(QUANTIZED_DB_MIN)).replace('DB_SCALE', repr(QUANTIZED_DB_SCALE))
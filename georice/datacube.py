@@ -0,0 +1,158 @@
+import os
+import json
+import numpy as np
+from rasterio import open as rio_open
+from rasterio.windows import Window
+from .codecs import quantized_lut, QUANTIZED_DTYPE
+
+
+class Datacube:
+    """
+    On-disk chunked time series of single band rasters sharing the same grid (one tile / orbit / polarisation).
+
+    The grid is split into chunk_size x chunk_size chunks. Each chunk is a raw float32 file holding the chunk planes of
+    all dates one after another, i.e. an array of shape (dates, chunk_size, chunk_size):
+    - the whole time series of a chunk is one contiguous, memory-mappable read
+    - a new date is appended at the end of every chunk file
+    Edge chunks are padded with nodata. index.json describes the grid and holds the date index (YYYYMMDD, in append
+    order) and the source raster (file name) of each date; it is rewritten once all chunks of a new date are written,
+    so an interrupted append is simply dropped. The planes of a date whose source changed are rewritten in place.
+    """
+
+    INDEX = 'index.json'
+    DTYPE = np.float32
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, self.INDEX), 'r') as index_file:
+            index = json.load(index_file)
+        self.width = index['width']
+        self.height = index['height']
+        self.chunk_size = index['chunk_size']
+        self.nodata = index['nodata']
+        self.projection = index['projection']
+        self.transform = index['transform']
+        self.dates = index['dates']
+        self.sources = index['sources']
+
+    @classmethod
+    def create(cls, path, width, height, chunk_size, nodata=None, projection=None, transform=None):
+        """Create an empty datacube at path, returns the opened datacube"""
+        os.makedirs(path, exist_ok=True)
+        index = {'width': width, 'height': height, 'chunk_size': chunk_size, 'nodata': nodata,
+                 'projection': projection, 'transform': transform, 'dates': [], 'sources': []}
+        with open(os.path.join(path, cls.INDEX), 'w') as index_file:
+            json.dump(index, index_file, indent=2)
+        return cls(path)
+
+    @classmethod
+    def from_raster(cls, path, raster_path, chunk_size):
+        """Open the datacube at path, or create it with the grid of the given raster"""
+        if os.path.isfile(os.path.join(path, cls.INDEX)):
+            return cls(path)
+        with rio_open(raster_path, 'r') as dataset:
+            return cls.create(path, dataset.width, dataset.height, chunk_size, dataset.nodata,
+                              dataset.crs.to_wkt() if dataset.crs is not None else None,
+                              list(dataset.transform.to_gdal()))
+
+    def _save_index(self):
+        index = {'width': self.width, 'height': self.height, 'chunk_size': self.chunk_size, 'nodata': self.nodata,
+                 'projection': self.projection, 'transform': self.transform, 'dates': self.dates,
+                 'sources': self.sources}
+        index_path = os.path.join(self.path, self.INDEX)
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(index, index_file, indent=2)
+        os.replace(index_path + '.tmp', index_path)
+
+    def _chunk_file(self, cy, cx):
+        return os.path.join(self.path, f'chunk_{cy}_{cx}.bin')
+
+    @property
+    def chunks(self):
+        """number of chunks (rows, columns)"""
+        return -(-self.height // self.chunk_size), -(-self.width // self.chunk_size)
+
+    def append(self, date, raster_path):
+        """
+        Append the raster of the given date (YYYYMMDD) to the datacube.
+        Returns False if the date is already in the datacube (see replace)
+        """
+        if date in self.dates:
+            return False
+        self._write_planes(raster_path, len(self.dates))
+        self.dates.append(date)
+        self.sources.append(os.path.basename(raster_path))
+        self._save_index()
+        return True
+
+    def replace(self, date, raster_path):
+        """
+        Rewrite the planes of a date (YYYYMMDD) of the datacube with the given raster, i.e. a newer scene of the date.
+        Returns False if the date planes already come from this raster (same file name)
+        """
+        position = self.dates.index(date)
+        if self.sources[position] == os.path.basename(raster_path):
+            return False
+        # the date source is unknown until all its planes are rewritten, so an interrupted replace is done again
+        self.sources[position] = None
+        self._save_index()
+        self._write_planes(raster_path, position)
+        self.sources[position] = os.path.basename(raster_path)
+        self._save_index()
+        return True
+
+    def _write_planes(self, raster_path, position):
+        # write the planes of a raster at the given date position of every chunk file, at the end for a new date
+        size = self.chunk_size
+        plane_bytes = size * size * np.dtype(self.DTYPE).itemsize
+        fill = np.nan if self.nodata is None else self.nodata
+        appended = position == len(self.dates)
+        with rio_open(raster_path, 'r') as dataset:
+            # quantized scenes (see georice.codecs) are stored decoded
+            lut = quantized_lut() if dataset.dtypes[0] == QUANTIZED_DTYPE else None
+            if dataset.width != self.width or dataset.height != self.height:
+                raise ValueError(f'{raster_path} grid ({dataset.width}x{dataset.height}) does not match the datacube '
+                                 f'grid ({self.width}x{self.height})')
+            for cy in range(self.chunks[0]):
+                y0 = cy * size
+                rows = dataset.read(1, window=Window(0, y0, self.width, min(size, self.height - y0)))
+                if lut is not None:
+                    rows = lut[rows]
+                for cx in range(self.chunks[1]):
+                    x0 = cx * size
+                    plane = np.full((size, size), fill, dtype=self.DTYPE)
+                    plane[:rows.shape[0], :min(size, self.width - x0)] = rows[:, x0:x0 + size]
+                    with open(self._chunk_file(cy, cx), 'ab' if appended else 'r+b') as chunk_file:
+                        if appended:
+                            # drop the planes of an interrupted append
+                            chunk_file.truncate(position * plane_bytes)
+                        else:
+                            chunk_file.seek(position * plane_bytes)
+                        chunk_file.write(plane.tobytes())
+
+    def indices(self, dates):
+        """positions of the given dates (YYYYMMDD) in the datacube"""
+        return [self.dates.index(date) for date in dates]
+
+    def read(self, window, out, indices=None):
+        """
+        Read the time series of a window into out (dates, height, width).
+        indices - positions of the dates to read, default all dates; a contiguous increasing range of dates is read
+                  with one sequential read per chunk
+        """
+        indices = list(range(len(self.dates))) if indices is None else list(indices)
+        if len(indices) > 0 and indices == list(range(indices[0], indices[-1] + 1)):
+            indices = slice(indices[0], indices[-1] + 1)
+        size = self.chunk_size
+        x0, y0 = int(window.col_off), int(window.row_off)
+        x1, y1 = x0 + int(window.width), y0 + int(window.height)
+        for cy in range(y0 // size, -(-y1 // size)):
+            for cx in range(x0 // size, -(-x1 // size)):
+                cube = np.memmap(self._chunk_file(cy, cx), dtype=self.DTYPE, mode='r',
+                                 shape=(len(self.dates), size, size))
+                wy0, wy1 = max(y0, cy * size), min(y1, (cy + 1) * size)
+                wx0, wx1 = max(x0, cx * size), min(x1, (cx + 1) * size)
+                out[:, wy0 - y0:wy1 - y0, wx0 - x0:wx1 - x0] = \
+                    cube[indices, wy0 - cy * size:wy1 - cy * size, wx0 - cx * size:wx1 - cx * size]
+                del cube
+        return out
@@ -0,0 +1,2064 @@
+# coding: utf-8
+
+# Rice mapping engine: selection of the filtered Sentinel-1 scenes and computation of the rice map and its products.
+# Used by the georice package and the bin/ricemap.py command line script.
+
+import os
+import sys
+import datetime as dt
+import numpy as np
+import rasterio as rio
+import time
+import math
+import psutil
+import numba
+import gc
+import signal
+import queue
+import json
+import itertools
+import threading
+import subprocess
+import tempfile
+import hashlib
+
+from osgeo import gdal, osr, gdal_array
+from rasterio.windows import Window
+from multiprocessing import cpu_count, process, shared_memory, get_context, get_all_start_methods
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
+from collections import OrderedDict
+from platform import system
+from .datacube import Datacube
+from .catalog import Catalog
+from .codecs import gdal_options, parse_codec, quantize, quantized_lut, QUANTIZED_DTYPE
+from . import telemetry
+
+THREAD_POOL = None
+SHARED_MEMORY = None
+RASTER_READER = None
+
+# ctrl+c handler installed for the duration of a run (main thread only)
+def signal_handler(sig, frame):
+    shutdown(terminate=True)
+    sys.exit(11)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# georice related constants
+
+# Threshold values for rice mapping classification
+RICE_THRESHOLD_DB = 5.
+urban_trees_threshold_dB = -18.
+water_threshold_dB = -18.
+
+# Morphological cleanup of the classification masks: objects / holes smaller than these sizes (pixels, 8-connectivity)
+# are removed / filled
+OBJECTS_THRESHOLD = 20
+HOLES_THRESHOLD = 20
+
+# ----------------------------------------------------------------------------------------------------------------------
+# data processing tweaks
+
+# Block size when writing geotiff:
+# - HAS TO BE a multiple of 16 (WARNING: no checks done, bad values will raise a gdal error)
+# - this also represents the MINIMUM block size that can be processed
+TIFF_BLOCK_SIZE = 1024
+
+# Tile size of the morphological cleanup: masks are cleaned tile by tile in parallel, components crossing tile borders
+# are merged afterwards => memory usage of the cleanup only depends on this size (and number of threads)
+MORPHOLOGY_TILE_SIZE = TIFF_BLOCK_SIZE
+
+# Margin (pixels) read around each block when building the rice map block by block (streaming mode)
+# => objects / holes smaller than the thresholds cannot extend further, so the morphological cleanup of a block
+#    with this margin gives exactly the same result as on the whole scene
+MORPHOLOGY_HALO = OBJECTS_THRESHOLD + HOLES_THRESHOLD
+
+# Maximum block size to be processed at once
+# => lowering this allows to reduce memory usage for large timescales
+# => input rasters data will be processed in chunks of BLOCK_SIZE x BLOCK_SIZE pixels
+# => more efficient if multiple of TIFF_BLOCK_SIZE (but not mandatory)
+BLOCK_SIZE = TIFF_BLOCK_SIZE * 4
+
+# Input rasters reading: each raster is opened once and kept in a cache of at most RASTER_CACHE_SIZE opened rasters,
+# the dates of a block are read concurrently by READ_THREADS threads (gdal releases the GIL while reading)
+RASTER_CACHE_SIZE = 256
+READ_THREADS = 8
+
+# Number of data cube buffers (-pf): with 2 or more, the next blocks are read ahead by a prefetch thread while the
+# current one is processed (each buffer costs one more data cube in memory)
+PREFETCH_BUFFERS = 1
+
+# Incremental update (-u): capacity of the per pixel candidate lists of the running state (see RunningState), pixels
+# overflowing them fall back to a full recomputation of their block
+# => 12 keeps noisy 60 dates time series within the lists (~200 bytes of state per pixel)
+STATE_CAPACITY = 12
+
+# Memory planning (--max-memory): rough memory usage estimates, used to choose the block size fitting a memory budget
+# - each processing unit (child process: python & numba runtime, scratch lines)
+WORKER_MEMORY_OVERHEAD = 64 * 1024**2
+# - per pixel of the morphological cleanup tiles (labels & union-find parents)
+MORPHOLOGY_BYTES_PER_PIXEL = 6
+# - per pixel of the rice map building: statistics, rice map, masks & temporaries (whole scene, or one block in
+#   streaming mode)
+SCENE_BYTES_PER_PIXEL = 24
+
+# ----------------------------------------------------------------------------------------------------------------------
+# runtime constants, AVOID modifications here...
+
+# number of parallel processing units
+NUMBER_OF_THREADS = max(4, cpu_count() // 2 if cpu_count() < 16 else cpu_count() // 4)
+
+# Each processed block is divided into sub-chunks of lines treated in parallel
+# => this value is a hint to choose the most optimal number of sub-chunks  
+# => if the block height allows it, this will be NUMBER_OF_THREADS x DATA_CHUNKS_MULTIPLIER
+# => else block height / NUMBER_OF_THREADS
+DATA_CHUNKS_MULTIPLIER = 128
+
+# disable python garbage collector overhead
+DISABLE_GARBAGE_COLLECTOR = False
+
+# nodata / math constants
+INF_NEG_FLOAT32 = np.float32(-np.inf)
+INF_POS_FLOAT32 = np.float32(np.inf)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# ----------------------------------------------------------------------------------------------------------------------
+# utility functions & classes
+
+#--- Memory / threads
+
+# process local view on the shared processing buffer (set up once per process by init_worker)
+SHARED_BUFFER = None
+SHARED_BLOCK_SIZE = None
+SHARED_TIME = None
+# item type of the data cube: float32 backscatter, or uint16 codes of quantized scenes decoded by the statistics kernel
+# through SHARED_LUT (see georice.codecs)
+SHARED_DTYPE = np.dtype(np.float32)
+SHARED_LUT = None
+# seasonal windows: (t0, t1) ranges of the time scale, the statistics of each one are computed from the same cube
+SHARED_WINDOWS = None
+
+# processing units start from a fresh server process (forkserver, spawn where not available) instead of being forked
+# from this one: the numba threading layer started by the kernels of this process must not be inherited by a fork
+# => workers import this module once (forkserver preload) and load their kernels from the on-disk cache
+def pool_context():
+    if 'forkserver' in get_all_start_methods():
+        context = get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return get_context('spawn')
+
+def starmap(pool, methods, params, chunksize=1):
+    # run in the calling process when no pool is available (single thread mode)
+    if pool is None:
+        return [methods(*p) for p in params]
+    return pool.starmap(methods, params, chunksize)
+
+# size (bytes, 64 bytes aligned) of the data cube and of one slot of the processing buffer (data cube & float32
+# statistics of each window)
+def cube_size(block_size, depth, dtype=np.float32):
+    return -(-depth * block_size * block_size * np.dtype(dtype).itemsize // 64) * 64
+
+def slot_size(block_size, depth, dtype=np.float32, windows=1):
+    return cube_size(block_size, depth, dtype) + -(-4 * windows * block_size * block_size * 4 // 64) * 64
+
+# views on the slot of the processing buffer (bytes) for a block of height x width pixels:
+# - data cube (depth, height, width) of the given item type: each date is a contiguous plane
+# - statistics (4 x windows, height, width): temporal mean, max increase, min and max of each window
+def block_views(buffer, block_size, depth, height, width, slot=0, dtype=np.float32, windows=1):
+    start = slot * slot_size(block_size, depth, dtype, windows)
+    cube = buffer[start:start + depth*height*width*np.dtype(dtype).itemsize].view(dtype).reshape(depth, height, width)
+    offset = start + cube_size(block_size, depth, dtype)
+    stats = buffer[offset:offset + 4*windows*height*width*4].view(np.float32).reshape(4*windows, height, width)
+    return cube, stats
+
+# attach a pool worker to the shared processing buffer, called once when the worker starts
+def init_worker(buffer_name, buffer_size, block_size, time_0, dtype=np.float32, windows=None):
+    global SHARED_MEMORY, SHARED_BUFFER, SHARED_BLOCK_SIZE, SHARED_TIME, SHARED_DTYPE, SHARED_LUT, SHARED_WINDOWS
+    # ctrl+c is handled by the parent process, which tears down the whole pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the pool already provides one processing unit per process
+    numba.set_num_threads(1)
+    SHARED_MEMORY = shared_memory.SharedMemory(name=buffer_name)
+    SHARED_BUFFER = np.ndarray(buffer_size, dtype=np.uint8, buffer=SHARED_MEMORY.buf)
+    SHARED_BLOCK_SIZE, SHARED_TIME = block_size, time_0
+    SHARED_DTYPE = np.dtype(dtype)
+    SHARED_LUT = quantized_lut() if SHARED_DTYPE == QUANTIZED_DTYPE else None
+    SHARED_WINDOWS = windows or [(0, len(time_0))]
+    # statistics kernel ready before the first block (loaded from the on-disk cache once compiled by a previous run)
+    warm_up(morphology=False, quantized=SHARED_LUT is not None)
+
+# temporal statistics of the lines [l0, l1[ of the block loaded in the given buffer slot, for each window
+# => read in place from the shared cube (the dates of the window) and written in place into the shared statistics
+def block_statistics(slot, l0, l1, height, width):
+    cube, stats = block_views(SHARED_BUFFER, SHARED_BLOCK_SIZE, len(SHARED_TIME), height, width, slot, SHARED_DTYPE,
+                              len(SHARED_WINDOWS))
+    for w, (t0, t1) in enumerate(SHARED_WINDOWS):
+        global_statistics(cube[t0:t1, l0:l1], SHARED_TIME[t0:t1], *stats[4*w:4*w+4, l0:l1], SHARED_LUT)
+
+# stop processing units, close input rasters and release the shared data cube
+def shutdown(terminate=False):
+    global THREAD_POOL, SHARED_MEMORY, SHARED_BUFFER, RASTER_READER
+    if THREAD_POOL is not None:
+        if terminate:
+            THREAD_POOL.terminate()
+        else:
+            THREAD_POOL.close()
+        THREAD_POOL.join()
+        THREAD_POOL = None
+    if RASTER_READER is not None:
+        RASTER_READER.close()
+        RASTER_READER = None
+    if SHARED_MEMORY is not None:
+        SHARED_BUFFER = None
+        try:
+            SHARED_MEMORY.close()
+        except BufferError:
+            # numpy views on the buffer are still alive, the mapping is released on exit
+            pass
+        SHARED_MEMORY.unlink()
+        SHARED_MEMORY = None
+
+# compute total process memory usage, accounting for memory shared with all child processes
+def memory_usage(process):
+    try:
+        if system() == 'Windows':
+            mem = process.memory_full_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    mem += child.memory_full_info().uss
+                except:
+                    pass
+        else:
+            mem = process.memory_full_info().pss
+            for child in process.children(recursive=True):
+                try:
+                    mem += child.memory_full_info().uss
+                except:
+                    pass
+        return mem
+    except:
+        # maybe OS does not allow to query this information ?...
+        return 0
+
+# memory monitor thread
+class MemoryMonitor(Thread):    
+    def __init__(self, process, polling_delay):
+        self.event = Event()
+        self.polling_delay = polling_delay
+        self.process = process
+        self.memory = 0
+        Thread.__init__(self)
+        self.setDaemon(True)
+    
+    def stop(self):
+        self.event.set()
+    
+    def run(self):
+        while not self.event.is_set():
+            self.memory = max(self.memory, memory_usage(self.process))
+            time.sleep(self.polling_delay)
+    
+    def reset(self):
+        self.memory = 0
+    
+    def get_peak_memory(self):
+        return self.memory
+    
+    def get_peak_memory_gb(self):
+        return self.memory / 1024**3
+
+#--- Raster reading
+
+# reader of a time stack of single band rasters
+# => rasters are opened once and kept in a bounded LRU cache, all dates of a window are read concurrently
+class RasterReader:
+    def __init__(self, paths, cache_size=RASTER_CACHE_SIZE, threads=READ_THREADS):
+        self.paths = list(paths)
+        self.cache_size = max(1, cache_size)
+        self.datasets = OrderedDict()
+        self.busy = {}
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max(1, threads))
+        self._lut = None
+    
+    # opened dataset of the i-th raster, marked busy until released
+    def acquire(self, i):
+        with self.lock:
+            ds = self.datasets.get(i)
+            if ds is not None:
+                self.datasets.move_to_end(i)
+                self.busy[i] = self.busy.get(i, 0) + 1
+                return ds
+        ds = rio.open(self.paths[i])
+        with self.lock:
+            if i in self.datasets:
+                # opened meanwhile by another thread
+                ds.close()
+                ds = self.datasets[i]
+                self.datasets.move_to_end(i)
+            else:
+                self.datasets[i] = ds
+            self.busy[i] = self.busy.get(i, 0) + 1
+            # close least recently used rasters not being read
+            for j in [j for j in self.datasets if self.busy.get(j, 0) == 0][:max(0, len(self.datasets) - self.cache_size)]:
+                self.datasets.pop(j).close()
+        return ds
+    
+    def release(self, i):
+        with self.lock:
+            self.busy[i] -= 1
+    
+    # quantized scenes (uint16) are read as is into a uint16 cube and decoded into a float32 one, float32 scenes are
+    # quantized into a uint16 cube (see georice.codecs)
+    def read_date(self, i, window, out):
+        ds = self.acquire(i)
+        try:
+            if out.dtype == QUANTIZED_DTYPE and ds.dtypes[0] != QUANTIZED_DTYPE:
+                out[:] = quantize(ds.read(1, window=window))
+            elif out.dtype != QUANTIZED_DTYPE and ds.dtypes[0] == QUANTIZED_DTYPE:
+                out[:] = self.lut()[ds.read(1, window=window)]
+            else:
+                ds.read(1, window=window, out=out)
+        finally:
+            self.release(i)
+    
+    def lut(self):
+        with self.lock:
+            if self._lut is None:
+                self._lut = quantized_lut()
+            return self._lut
+    
+    # read the window of all dates (or of the dates at the given indices) into out (dates, height, width)
+    def read(self, window, out, indices=None):
+        indices = range(len(self.paths)) if indices is None else indices
+        for future in [self.executor.submit(self.read_date, i, window, out[k]) for k, i in enumerate(indices)]:
+            future.result()
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for ds in self.datasets.values():
+                ds.close()
+            self.datasets.clear()
+
+# read-ahead of the blocks data cubes: a prefetch thread reads the blocks into the free slots of the processing buffer
+# while the blocks already loaded are processed
+# => io_stall: time the processing waited for data, compute_stall: time the prefetch waited for a free slot
+class BlockPrefetcher(Thread):
+    def __init__(self, reader, buffer, block_size, depth, blocks, buffers, dtype=np.float32, windows=1):
+        self.reader = reader
+        self.buffer = buffer
+        self.block_size = block_size
+        self.depth = depth
+        self.dtype = dtype
+        self.windows = windows
+        self.blocks = blocks
+        self.free = queue.Queue()
+        for slot in range(max(1, buffers)):
+            self.free.put(slot)
+        self.ready = queue.Queue()
+        self.io_stall = 0.
+        self.compute_stall = 0.
+        Thread.__init__(self)
+        self.setDaemon(True)
+    
+    # blocks: (x, y, width, height, runs), only the runs of rows [(r0, r1), ...] are read, one after another
+    def run(self):
+        try:
+            for x_pos, y_pos, width, height, runs in self.blocks:
+                t0 = time.time()
+                slot = self.free.get()
+                self.compute_stall += time.time() - t0
+                rows = sum(r1 - r0 for r0, r1 in runs)
+                cube, _ = block_views(self.buffer, self.block_size, self.depth, rows, width, slot, self.dtype,
+                                      self.windows)
+                offset = 0
+                for r0, r1 in runs:
+                    self.reader.read(Window(x_pos, y_pos + r0, width, r1 - r0), cube[:, offset:offset + r1 - r0])
+                    offset += r1 - r0
+                self.ready.put((slot, None))
+        except Exception as e:
+            self.ready.put((None, e))
+    
+    # slot of the next loaded block (in blocks order)
+    def get(self):
+        t0 = time.time()
+        slot, error = self.ready.get()
+        self.io_stall += time.time() - t0
+        if error is not None:
+            raise error
+        return slot
+    
+    # the block in this slot has been processed
+    def release(self, slot):
+        self.free.put(slot)
+
+# reader of the time series stored in a datacube (see georice.datacube), same interface as RasterReader
+# => the time series of a window is one sequential read per datacube chunk instead of one read per date
+class DatacubeReader:
+    def __init__(self, datacube, dates):
+        self.datacube = datacube
+        self.indices = datacube.indices(dates)
+    
+    # read the window of the selected dates (or of the selected dates at the given indices) into out (dates, height, width)
+    def read(self, window, out, indices=None):
+        self.datacube.read(window, out, self.indices if indices is None else [self.indices[i] for i in indices])
+    
+    def close(self):
+        pass
+
+#--- AOI coverage
+
+# statistics of a pixel without data (see global_statistics): mean, max increase, min, max
+EMPTY_STATISTICS = np.array([0, 0, -np.inf, np.inf], dtype=np.float32)
+
+# runs [(r0, r1), ...] of the rows of a block window of the AOI coverage mask (bool) having pixels inside the AOI
+def covered_runs(covered):
+    rows = np.flatnonzero(covered.any(axis=1))
+    if len(rows) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) > 1)
+    starts = [rows[0]] + list(rows[breaks + 1])
+    ends = list(rows[breaks] + 1) + [rows[-1] + 1]
+    return [(int(r0), int(r1)) for r0, r1 in zip(starts, ends)]
+
+# block statistics (4 x windows, height, width) into out from the statistics of its covered rows stacked run
+# after run, the pixels outside the AOI get the statistics of a pixel without data (of each window)
+def expand_statistics(stats, runs, covered, out):
+    offset = 0
+    for r0, r1 in runs:
+        out[:, r0:r1] = stats[:, offset:offset + r1 - r0]
+        offset += r1 - r0
+    out[:, ~covered] = np.tile(EMPTY_STATISTICS, len(out) // 4)[:, None]
+    return out
+
+#--- Incremental update
+
+# name of the datacube / running state of the scenes of a tile (AOI part prefix included) / orbit / direction found in
+# scenes_path: two scene folders of a tile (i.e. scenes and scenes/filtered) never share their data
+def scenes_key(scenes_path, output_path, tile, orbit, direction):
+    folder = os.path.relpath(os.path.abspath(scenes_path), os.path.abspath(output_path))
+    if folder.split(os.sep)[0] == os.pardir:
+        # folder outside of the output folder
+        folder = hashlib.sha1(os.path.abspath(scenes_path).encode()).hexdigest()[:12]
+    return '_'.join([tile, folder.replace(os.sep, '-'), orbit, direction, 'vh'])
+
+# per pixel running state of the temporal statistics, stored as memory mapped .npy files (one per field) and a json
+# index of the folded dates and scenes, so new dates are folded in and the statistics re-derived at the cost of the new
+# dates only
+# - count, sum, min, max of the values
+# - minimum of the 1st half of the time series and its date
+# - records: values lower than all the previous ones, not yet in the 1st half (rank, value, date) => the next 1st half
+#   minima, the 1st half grows by one value every 2 values
+# - staircase: values greater than all the following ones (value, date), the max increase is the first one located at
+#   least 20 days after the 1st half minimum
+# - dirty: candidate list overflow or infinite value, the statistics of the pixel are recomputed from the time series
+#   (and the state of its block folded again from it)
+# dates are stored as days since the 1st folded date (int16)
+class RunningState:
+    FIELDS = [('count', np.int32, False), ('total', np.float64, False), ('min', np.float32, False),
+              ('max', np.float32, False), ('half_min', np.float32, False), ('half_min_time', np.int16, False),
+              ('records', np.uint8, False), ('record_rank', np.int16, True), ('record_value', np.float32, True),
+              ('record_time', np.int16, True), ('stairs', np.uint8, False), ('stair_value', np.float32, True),
+              ('stair_time', np.int16, True), ('dirty', np.bool_, False)]
+    # value of the fields without any date folded
+    INITIAL = {'min': INF_NEG_FLOAT32, 'max': INF_POS_FLOAT32}
+    
+    def __init__(self, path, mode='r+'):
+        self.path = path
+        with open(os.path.join(path, 'state.json'), 'r') as f:
+            index = json.load(f)
+        self.shape, self.capacity, self.time_origin = index['shape'], index['capacity'], index['time_origin']
+        self.dates, self.sources, self.complete = index['dates'], index['sources'], index['complete']
+        self.fields = [np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode=mode) for name, _, _ in self.FIELDS]
+    
+    # empty state (no date folded) for a raster of the given shape
+    @classmethod
+    def create(cls, path, shape, time_origin, capacity=STATE_CAPACITY):
+        os.makedirs(path, exist_ok=True)
+        for name, dtype, listed in cls.FIELDS:
+            field = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype,
+                                              shape=tuple(([capacity] if listed else []) + list(shape)))
+            field[...] = cls.INITIAL.get(name, 0)
+            field.flush()
+            del field
+        with open(os.path.join(path, 'state.json'), 'w') as f:
+            json.dump({'shape': list(shape), 'capacity': capacity, 'time_origin': int(time_origin), 'dates': [],
+                       'sources': [], 'complete': True}, f)
+        return cls(path)
+    
+    # existing state folding the beginning of the given dates from the same scenes (file names), else None
+    @classmethod
+    def open(cls, path, shape, dates, sources):
+        try:
+            state = cls(path)
+        except (IOError, ValueError, KeyError):
+            return None
+        if not state.complete or state.shape != list(shape) or state.dates != dates[:len(state.dates)] \
+                or state.sources != sources[:len(state.sources)]:
+            return None
+        return state
+    
+    # fields of the pixels [y0, y1[ x [x0, x1[, in fold_statistics / state_statistics order
+    def block(self, y0, y1, x0, x1):
+        return [np.asarray(f[..., y0:y1, x0:x1]) for f in self.fields]
+    
+    # reset block fields (see block) to the state without any date folded
+    @classmethod
+    def clear(cls, fields):
+        for (name, _, _), field in zip(cls.FIELDS, fields):
+            field[...] = cls.INITIAL.get(name, 0)
+    
+    def save(self, dates, sources, complete=True):
+        for f in self.fields:
+            f.flush()
+        self.dates, self.sources, self.complete = list(dates), list(sources), complete
+        with open(os.path.join(self.path, 'state.json.tmp'), 'w') as f:
+            json.dump({'shape': self.shape, 'capacity': self.capacity, 'time_origin': self.time_origin,
+                       'dates': self.dates, 'sources': self.sources, 'complete': complete}, f)
+        os.replace(os.path.join(self.path, 'state.json.tmp'), os.path.join(self.path, 'state.json'))
+    
+    def close(self):
+        self.fields = []
+
+#--- Memory planning
+
+# parse a memory size: bytes, or with a K/M/G/T suffix (e.g. 512M, 8G)
+def parse_memory(value):
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+# expected memory usage (bytes) of a run processing blocks of block_size x block_size pixels, on top of base
+def expected_memory(block_size, depth, threads, full_shape, streaming, base=0, buffers=1, dtype=np.float32,
+                    coverage=False, windows=1):
+    height, width = min(block_size, full_shape[0]), min(block_size, full_shape[1])
+    # shared processing buffer: data cube (of the given item type) & float32 block statistics of each window, for each
+    # slot
+    mem = buffers * (depth * np.dtype(dtype).itemsize + 4 * 4 * windows) * height * width
+    # AOI coverage: block statistics expanded from the covered rows
+    if coverage:
+        mem += 4 * 4 * windows * height * width
+    # processing units (the calling process is used in single thread mode)
+    if threads > 1:
+        mem += threads * WORKER_MEMORY_OVERHEAD
+    # morphological cleanup, one tile (and its halo) per thread
+    mem += threads * (MORPHOLOGY_TILE_SIZE + 2)**2 * MORPHOLOGY_BYTES_PER_PIXEL
+    # rice map building: whole scene, or one block and its margin at a time in streaming mode (the statistics of every
+    # window)
+    scene_bytes = SCENE_BYTES_PER_PIXEL + 4 * 4 * (windows - 1)
+    if streaming:
+        mem += (height + 2*MORPHOLOGY_HALO) * (width + 2*MORPHOLOGY_HALO) * scene_bytes
+    else:
+        mem += full_shape[0] * full_shape[1] * scene_bytes
+    return base + mem
+
+# number of line chunks a block of block_size lines is divided into, processed in parallel by the processing units:
+# threads x DATA_CHUNKS_MULTIPLIER if the block height allows it, one chunk in single thread mode
+def data_chunks(block_size, threads):
+    if threads <= 1:
+        return 1
+    return int(max(1, min(block_size // threads, threads * DATA_CHUNKS_MULTIPLIER)))
+
+# choose the largest block size (multiple of TIFF_BLOCK_SIZE) fitting in the memory budget, and lower the number of
+# processing units if even the smallest block does not fit
+# => the budget is capped to the memory currently available, returns (block size, threads, chunks per block, budget)
+def plan_blocks(max_memory, depth, threads, full_shape, streaming, base=0, buffers=1, dtype=np.float32,
+                coverage=False, windows=1):
+    budget = min(max_memory, base + psutil.virtual_memory().available)
+    largest = -(-max(full_shape) // TIFF_BLOCK_SIZE) * TIFF_BLOCK_SIZE
+    for t in range(max(1, threads), 0, -1):
+        for block_size in range(largest, TIFF_BLOCK_SIZE - 1, -TIFF_BLOCK_SIZE):
+            if expected_memory(block_size, depth, t, full_shape, streaming, base, buffers, dtype, coverage,
+                               windows) <= budget:
+                return block_size, t, data_chunks(block_size, t), budget
+    # nothing fits, use the smallest possible footprint
+    return TIFF_BLOCK_SIZE, 1, data_chunks(TIFF_BLOCK_SIZE, 1), budget
+
+#--- GeoTIFF
+
+def get_geotiff_infos(path):
+    tmp_map = gdal.Open(path, gdal.GA_ReadOnly)
+    metadata = tmp_map.GetMetadata()
+    gcps = tmp_map.GetGCPs()
+    projection = tmp_map.GetProjection()
+    transform = list(tmp_map.GetGeoTransform())
+    tmp_band = tmp_map.GetRasterBand(1)
+    nodata = tmp_band.GetNoDataValue()
+    compression = tmp_map.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION', None)
+    blocksize = tmp_band.GetBlockSize()
+    width, height = tmp_band.XSize, tmp_band.YSize
+    epsg = osr.SpatialReference(wkt=projection).GetAttrValue('AUTHORITY', 1)
+    tmp_band = None
+    tmp_map = None
+    return width, height, nodata, projection, transform, compression, blocksize, metadata, gcps, epsg
+
+# geotiff creation options for the given data type, compression and extra options
+# - compressor: codec profile, 'name' or 'name:parameter' i.e. 'zstd:9', 'lerc:0.001' (see codecs.gdal_options for
+#   the predictor choice per data type), comp_level: parameter of a profile without one
+def gtiffOptions(dtype, compressor=None, comp_level=None, extra_options=[]):
+    extra_opt = extra_options
+    if compressor is not None and type(compressor) is str and compressor.lower() != 'none':
+        nbits = next((int(option[len('NBITS='):]) for option in extra_options if option.startswith('NBITS=')), None)
+        extra_opt = gdal_options(compressor, dtype, comp_level, nbits) + ['NUM_THREADS=' + str(min(4, cpu_count()))] + extra_opt
+    return extra_opt
+
+# create a new (empty) geotiff, returns the opened gdal dataset
+def newGTiff(dstFilePath, dshape, gdal_dtype, projection, transform, nodata, metadata, gcps, options, bands=1):
+    driver = gdal.GetDriverByName("GTiff")
+    dst_ds = driver.Create(dstFilePath, dshape[1], dshape[0], bands, gdal_dtype, options=options)
+    if metadata is not None:
+        dst_ds.SetMetadata(metadata)
+    if gcps is not None and len(gcps) > 0:
+        dst_ds.SetGCPs(gcps)
+    for band in range(bands):
+        dst_ds.GetRasterBand(band + 1).SetNoDataValue(nodata)
+    if projection is not None:
+        dst_ds.SetProjection(projection)
+    if transform is not None:
+        dst_ds.SetGeoTransform(transform)
+    return dst_ds
+
+# save geotiff gdal helper
+def saveToGTiff(
+                npArray,
+                dstFilePath,
+                projection=None,
+                transform=None,
+                dstSRS=None,
+                dtype=None,
+                nodata=-np.inf,
+                metadata=None,
+                gcps=None,
+                compressor=None,  # deflate, lzw, zstd, jpeg, webp
+                comp_level=None,  # compression level
+                extra_options=[], # Extra geotiff options like TILED, BLOCKXSIZE, BLOCKYSIZE, NBITS, ... 
+                pos=[],           # Upper-left position of data (Warning: if set, disables dstSRS)
+                cog=False,        # add internal overviews, cloud optimized layout if ghost_area (ignored if pos is set)
+                resampling='AVERAGE', # overviews resampling: MODE for classes, AVERAGE for backscatter
+                ghost_area=True
+                ):
+    # disable reprojection if data are saved in partial mode
+    if pos is None or len(pos) == 0:
+        pos = [0, 0]
+        dshape = npArray.shape
+    else:
+        dstSRS = None
+        dshape = pos[2]
+    
+    if dtype is None:
+        dtype = npArray.dtype.type
+    nodata = np.float64(-np.inf if nodata is None else nodata)
+    gdal_dtype = gdal_array.NumericTypeCodeToGDALTypeCode(dtype)
+    extra_opt = gtiffOptions(dtype, compressor, comp_level, extra_options)
+    
+    # Perform data reprojection if asked (only in full raster mode)
+    if not (dstSRS is None or projection is None or transform is None):
+        # https://stackoverflow.com/a/48706963
+        org = gdal_array.OpenArray(npArray)
+        org.SetProjection(projection)
+        org.SetGeoTransform(transform)
+        org.GetRasterBand(1).SetNoDataValue(nodata)
+        if gcps is not None and len(gcps) > 0:
+            org.SetGCPs(gcps)
+        dest = gdal.Warp('', org, dstSRS=dstSRS, format="VRT", outputType=gdal_dtype)
+        projection = dest.GetProjection()
+        transform = dest.GetGeoTransform()
+        npArray = dest.ReadAsArray()
+        dshape = npArray.shape
+        gcps = dest.GetGCPs()
+    
+    dst_ds = newGTiff(dstFilePath, dshape, gdal_dtype, projection, transform, nodata, metadata, gcps, extra_opt)
+    dst_ds.GetRasterBand(1).WriteArray(npArray, pos[0], pos[1])
+    dst_ds.FlushCache()
+    dst_ds = None
+    if cog and pos == [0, 0]:
+        cogGTiff(dstFilePath, dtype, resampling, compressor, comp_level, extra_options, ghost_area)
+
+# create an empty geotiff of the given shape, to be filled block by block with updateGTiff
+# => tiles are only allocated when written (SPARSE_OK), so each block is compressed & written once
+def createGTiff(dstFilePath, shape, dtype, projection=None, transform=None, nodata=-np.inf, metadata=None, gcps=None,
+                compressor=None, comp_level=None, extra_options=[]):
+    nodata = np.float64(-np.inf if nodata is None else nodata)
+    gdal_dtype = gdal_array.NumericTypeCodeToGDALTypeCode(dtype)
+    extra_opt = gtiffOptions(dtype, compressor, comp_level, ['SPARSE_OK=TRUE'] + extra_options)
+    dst_ds = newGTiff(dstFilePath, shape, gdal_dtype, projection, transform, nodata, metadata, gcps, extra_opt)
+    dst_ds.FlushCache()
+    dst_ds = None
+
+# temporary file path, next to the final product
+def tmpFile(path):
+    return os.path.join(os.path.dirname(path), 'tmp_' + os.path.basename(path))
+
+# reproject a geotiff file to a new geotiff (gdal warps it chunk by chunk, the raster is never fully loaded)
+def warpGTiff(srcFilePath, dstFilePath, dstSRS, dtype, compressor=None, comp_level=None, extra_options=[]):
+    extra_opt = gtiffOptions(dtype, compressor, comp_level, extra_options)
+    dst_ds = gdal.Warp(dstFilePath, srcFilePath, dstSRS=dstSRS, format="GTiff", creationOptions=extra_opt,
+                       multithread=True)
+    dst_ds.FlushCache()
+    dst_ds = None
+
+# overview factors of a raster (2, 4, 8, ...), down to the one fitting in a single block
+def overviewLevels(shape, block_size=None):
+    block_size = TIFF_BLOCK_SIZE if block_size is None else block_size
+    levels = []
+    while max(shape) > block_size * (levels[-1] if levels else 1):
+        levels.append(2 * levels[-1] if levels else 2)
+    return levels
+
+# add internal overviews to a geotiff (resampling: MODE for classes, AVERAGE for backscatter), computed with threads
+# - ghost_area: the geotiff is then rewritten as a cloud optimized geotiff: headers (with the gdal ghost area
+#   describing the layout) first, then the overviews from the smallest one, then the full resolution tiles, so a
+#   reader gets any overview with a few ranged reads, without touching the full resolution data
+# - otherwise the overviews are only appended to the geotiff (no rewrite, same overviews, data first layout)
+def cogGTiff(dstFilePath, dtype, resampling, compressor=None, comp_level=None, extra_options=[], ghost_area=True,
+             threads=1):
+    # gdal overview computation threads, per caller thread (products are processed concurrently)
+    gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', str(threads))
+    try:
+        dst_ds = gdal.Open(dstFilePath, gdal.GA_Update)
+        levels = overviewLevels([dst_ds.RasterYSize, dst_ds.RasterXSize])
+        if len(levels) > 0:
+            dst_ds.BuildOverviews(resampling, levels)
+        dst_ds.FlushCache()
+        dst_ds = None
+    finally:
+        gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', None)
+    if ghost_area:
+        tmp_path = tmpFile(dstFilePath)
+        os.replace(dstFilePath, tmp_path)
+        src_ds = gdal.Open(tmp_path, gdal.GA_ReadOnly)
+        extra_opt = gtiffOptions(dtype, compressor, comp_level, ['COPY_SRC_OVERVIEWS=YES'] + extra_options)
+        dst_ds = gdal.GetDriverByName("GTiff").CreateCopy(dstFilePath, src_ds, options=extra_opt)
+        dst_ds.FlushCache()
+        dst_ds, src_ds = None, None
+        os.remove(tmp_path)
+
+# cogGTiff of products [(path, dtype, resampling, extra options)], concurrently: one product per thread at a time,
+# the threads left shared by the overview computation of each product
+def cogProducts(products, compressor, geotiff_options, ghost_area=True, threads=1):
+    workers = max(1, min(threads, len(products)))
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(cogGTiff, path, dtype, resampling, compressor, None, extra_options + geotiff_options,
+                                   ghost_area, max(1, threads // workers))
+                   for path, dtype, resampling, extra_options in products]
+        for future in futures:
+            future.result()
+
+# partial update of geotiff
+def updateGTiff(npArray, dstFilePath, pos=[]):
+    dst_ds = gdal.Open(dstFilePath, gdal.GA_Update)
+    if pos is None or len(pos) == 0:
+        pos = [0, 0]
+    dst_ds.GetRasterBand(1).WriteArray(npArray, pos[0], pos[1])
+    dst_ds.FlushCache()
+    dst_ds = None
+
+# writer of the products of a run in the native grid, block by block
+# - products are created empty (sparse) and kept opened until closed, each block is compressed & written once
+# - the blocks of all products are written concurrently (one product per thread at a time, gdal releases the GIL)
+# - the 5 class masks of a rice map block are derived in one pass (class_masks), as 1 bit products or as one 5 bands
+#   1 bit product
+class ProductWriter:
+    def __init__(self, shape, projection, transform, compressor, geotiff_options, threads=1):
+        self.shape, self.projection, self.transform = shape, projection, transform
+        self.compressor, self.geotiff_options = compressor, geotiff_options
+        self.datasets = OrderedDict()
+        self.executor = ThreadPoolExecutor(max(1, threads))
+        self.masks = {}
+    
+    def create(self, path, dtype, nodata=None, extra_options=[], descriptions=None):
+        nodata = np.float64(-np.inf if nodata is None else nodata)
+        options = gtiffOptions(dtype, self.compressor, None, ['SPARSE_OK=TRUE'] + extra_options + self.geotiff_options)
+        bands = 1 if descriptions is None else len(descriptions)
+        dataset = newGTiff(path, self.shape, gdal_array.NumericTypeCodeToGDALTypeCode(dtype), self.projection,
+                           self.transform, nodata, None, None, options, bands)
+        for band, description in enumerate(descriptions or []):
+            dataset.GetRasterBand(band + 1).SetDescription(description)
+        self.datasets[path] = dataset
+    
+    def _write(self, path, data, x, y):
+        dataset = self.datasets[path]
+        if data.ndim == 2:
+            dataset.GetRasterBand(1).WriteArray(data, x, y)
+        else:
+            for band in range(data.shape[0]):
+                dataset.GetRasterBand(band + 1).WriteArray(data[band], x, y)
+    
+    # write the blocks {path: array (height, width) or (bands, height, width)} at the upper-left position x, y
+    def write(self, blocks, x, y):
+        for future in [self.executor.submit(self._write, path, data, x, y) for path, data in blocks.items()]:
+            future.result()
+    
+    # blocks of a rice map and of its masks (list of 5 masks paths, or a single 5 bands product path), to be written
+    def class_blocks(self, ricemap, ricemap_path, mask_paths):
+        blocks = {ricemap_path: ricemap}
+        if len(mask_paths) > 0:
+            # masks buffer of the rice map, reused by its next blocks
+            masks = self.masks.get(ricemap_path)
+            if masks is None or masks.shape[1:] != ricemap.shape:
+                masks = self.masks[ricemap_path] = np.empty((5,) + ricemap.shape, dtype=np.uint8)
+            class_masks(ricemap, masks)
+            if len(mask_paths) == 1:
+                blocks[mask_paths[0]] = masks
+            else:
+                blocks.update(zip(mask_paths, masks))
+        return blocks
+    
+    def _close(self, path):
+        dataset = self.datasets.pop(path)
+        dataset.FlushCache()
+        dataset = None
+    
+    # flush & close the given products (default all), concurrently
+    def close(self, paths=None):
+        list(self.executor.map(self._close, list(self.datasets) if paths is None else paths))
+        if len(self.datasets) == 0:
+            self.executor.shutdown()
+
+# reprojection of native grid products to a target SRS, solved once and applied to all the products of a run
+# - the solution is the gdal warp (nearest neighbour, default approximation error threshold) of a raster of the source
+#   pixel indices: its output grid is the one gdal.Warp chooses for the native grid, and each output pixel holds the
+#   source pixel gdal.Warp picks for it, so the products are the gdal.Warp ones
+# - the index rasters are kept compressed in memory (/vsimem), each product is then read on the source window of an
+#   output strip and gathered: the products are never fully loaded nor warped again
+class Reprojection:
+    def __init__(self, shape, projection, transform, dst_srs):
+        self.src_shape = shape
+        # source pixel index + 1 (0: no source pixel), written strip by strip
+        name = '/vsimem/georice_reprojection_%d_%d' % (os.getpid(), id(self))
+        self.src_path, self.path = name + '_src.tif', name + '.tif'
+        options = ['TILED=YES', 'BLOCKXSIZE=' + str(TIFF_BLOCK_SIZE), 'BLOCKYSIZE=' + str(TIFF_BLOCK_SIZE)]
+        options = gtiffOptions(np.uint32, 'deflate', None, options)
+        src = newGTiff(self.src_path, shape, gdal.GDT_UInt32, projection, transform, 0, None, None, options)
+        for y0 in range(0, shape[0], TIFF_BLOCK_SIZE):
+            y1 = min(shape[0], y0 + TIFF_BLOCK_SIZE)
+            index = np.arange(y0 * shape[1] + 1, y1 * shape[1] + 1, dtype=np.uint32).reshape(y1 - y0, shape[1])
+            src.GetRasterBand(1).WriteArray(index, 0, y0)
+        src.FlushCache()
+        src = None
+        grid = gdal.Warp(self.path, self.src_path, dstSRS=dst_srs, format='GTiff', creationOptions=options,
+                         multithread=True)
+        self.projection, self.transform = grid.GetProjection(), list(grid.GetGeoTransform())
+        self.shape = [grid.RasterYSize, grid.RasterXSize]
+        grid.FlushCache()
+        grid = None
+        gdal.Unlink(self.src_path)
+        self.grid = gdal.Open(self.path, gdal.GA_ReadOnly)
+    
+    # source pixel (row, column) of each pixel of the output lines [y0, y1[, -1 outside of the source raster
+    def mapping(self, y0, y1):
+        index = self.grid.GetRasterBand(1).ReadAsArray(0, y0, self.shape[1], y1 - y0).astype(np.int64) - 1
+        inside = index >= 0
+        return np.where(inside, index // self.src_shape[1], -1), np.where(inside, index % self.src_shape[1], -1)
+    
+    # reproject native products [(source path, output path, dtype, nodata, extra options, band descriptions)]
+    # => outputs keep the source nodata (also outside of the source raster), strips are written concurrently
+    def warp(self, products, compressor, geotiff_options, threads=1):
+        writer = ProductWriter(self.shape, self.projection, self.transform, compressor, geotiff_options, threads)
+        for _, f_out, dtype, nodata, options, descriptions in products:
+            writer.create(f_out, dtype, nodata, options, descriptions)
+        sources = [rio.open(f) for f, _, _, _, _, _ in products]
+        
+        def gather(i, rows, cols, inside, window):
+            _, f_out, dtype, nodata, _, _ = products[i]
+            out = np.full((sources[i].count,) + rows.shape, -np.inf if nodata is None else nodata, dtype=dtype)
+            if window is not None:
+                data = sources[i].read(window=window)
+                out[:, inside] = data[:, rows[inside] - window.row_off, cols[inside] - window.col_off]
+            return f_out, out if out.shape[0] > 1 else out[0]
+        
+        with ThreadPoolExecutor(max(1, threads)) as executor:
+            for y0 in range(0, self.shape[0], TIFF_BLOCK_SIZE):
+                y1 = min(self.shape[0], y0 + TIFF_BLOCK_SIZE)
+                rows, cols = self.mapping(y0, y1)
+                inside = rows >= 0
+                window = None
+                if inside.any():
+                    r, c = rows[inside], cols[inside]
+                    window = Window(c.min(), r.min(), c.max() - c.min() + 1, r.max() - r.min() + 1)
+                blocks = dict(executor.map(lambda i: gather(i, rows, cols, inside, window), range(len(products))))
+                writer.write(blocks, 0, y0)
+        for source in sources:
+            source.close()
+        writer.close()
+    
+    def close(self):
+        self.grid = None
+        gdal.Unlink(self.path)
+
+#--- dates
+
+# gregorian date to julian helper (https://gist.github.com/jiffyclub/1294443)
+def date_to_jd(year,month,day):
+    if month == 1 or month == 2:
+        yearp = year - 1
+        monthp = month + 12
+    else:
+        yearp = year
+        monthp = month
+    
+    # this checks where we are in relation to October 15, 1582, the beginning
+    # of the Gregorian calendar.
+    if ((year < 1582) or
+        (year == 1582 and month < 10) or
+        (year == 1582 and month == 10 and day < 15)):
+        # before start of Gregorian calendar
+        B = 0
+    else:
+        # after start of Gregorian calendar
+        A = math.trunc(yearp / 100.)
+        B = 2 - A + math.trunc(A / 4.)
+    
+    if yearp < 0:
+        C = math.trunc((365.25 * yearp) - 0.75)
+    else:
+        C = math.trunc(365.25 * yearp)
+    
+    D = math.trunc(30.6001 * (monthp + 1))
+    jd = B + C + D + day + 1720994.5
+    return jd
+
+YEAR_0 = date_to_jd(0, 1, 1)
+
+# helper function to emulate matlab julian day from first day of year 0
+def date_to_jd_from_year_0(datetime64_or_year, month=None, day=None):
+    global YEAR_0
+    if type(datetime64_or_year) is dt.date:
+        return date_to_jd(datetime64_or_year.year, datetime64_or_year.month, datetime64_or_year.day) - YEAR_0
+    elif type(datetime64_or_year) is np.datetime64:
+        dd = dt.datetime.utcfromtimestamp(datetime64_or_year.astype(object)/1e9)
+        return date_to_jd(dd.year, dd.month, dd.day) - YEAR_0
+    else:
+        return date_to_jd(datetime64_or_year, month, day) - YEAR_0
+
+# ----------------------------------------------------------------------------------------------------------------------
+# ----------------------------------------------------------------------------------------------------------------------
+# processing functions
+
+# Tiled equivalent of skimage remove_small_objects (value=True) / remove_small_holes (value=False) with connectivity=2:
+# the 8-connected components of pixels equal to value and smaller than threshold are switched to (not value) in out.
+# - each tile is labelled in parallel together with a 1 pixel halo overlapping its neighbours
+# - the halo pixels carry both the tile label and the neighbour label, components crossing tile borders are merged
+#   with a union-find over all tile labels, and their sizes summed
+# - tiles are labelled again to write the result, so no whole scene label image is ever allocated
+def remove_small_components(ma, value, threshold, out, tile_size=None, threads=None):
+    tile_size = MORPHOLOGY_TILE_SIZE if tile_size is None else tile_size
+    threads = NUMBER_OF_THREADS if threads is None else threads
+    h, w = ma.shape
+    ys, xs = list(range(0, h, tile_size)) + [h], list(range(0, w, tile_size)) + [w]
+    tiles = [(ty, tx, ys[ty], ys[ty+1], xs[tx], xs[tx+1]) for ty in range(len(ys)-1) for tx in range(len(xs)-1)]
+    windows = [(max(0, y0-1), min(h, y1+1), max(0, x0-1), min(w, x1+1)) for _, _, y0, y1, x0, x1 in tiles]
+    
+    # 1st pass: label the tiles, keep the core component sizes and the labels found on the tile borders
+    def label_tile(i):
+        _, _, y0, y1, x0, x1 = tiles[i]
+        wy0, wy1, wx0, wx1 = windows[i]
+        labels = np.zeros((wy1-wy0, wx1-wx0), dtype=np.int32)
+        n = label_components(ma[wy0:wy1, wx0:wx1], value, labels)
+        sizes = component_sizes(labels[y0-wy0:y1-wy0, x0-wx0:x1-wx0], n)
+        return n, sizes, labels[0].copy(), labels[y0-wy0:y1-wy0, 0].copy(), labels[y1-wy0-1].copy(), labels[y0-wy0:y1-wy0, x1-wx0-1].copy()
+    
+    with ThreadPoolExecutor(max(1, threads)) as executor:
+        results = list(executor.map(label_tile, range(len(tiles))))
+        
+        # tile labels => global labels (0 stays background)
+        offsets = np.cumsum([0] + [r[0] for r in results])
+        sizes = np.zeros(offsets[-1] + 1, dtype=np.int64)
+        bottom_rows = np.zeros((len(ys)-1, w), dtype=np.int64)
+        right_cols = np.zeros((len(xs)-1, h), dtype=np.int64)
+        for i, (ty, tx, y0, y1, x0, x1) in enumerate(tiles):
+            n, tile_sizes, _, _, bottom, right = results[i]
+            wy0, wy1, wx0, wx1 = windows[i]
+            sizes[offsets[i]+1:offsets[i]+n+1] = tile_sizes[1:]
+            bottom_rows[ty, x0:x1] = to_global(bottom[x0-wx0:x1-wx0], offsets[i])
+            right_cols[tx, y0:y1] = to_global(right, offsets[i])
+        
+        # merge components crossing tile borders: the top halo line (corners included) and the left halo column of a
+        # tile are the bottom line / right column of the tiles above / on the left
+        parent = np.arange(len(sizes), dtype=np.int64)
+        for i, (ty, tx, y0, y1, x0, x1) in enumerate(tiles):
+            _, _, top, left, _, _ = results[i]
+            wy0, wy1, wx0, wx1 = windows[i]
+            if ty > 0:
+                union_labels(parent, to_global(top, offsets[i]), bottom_rows[ty-1, wx0:wx1])
+            if tx > 0:
+                union_labels(parent, to_global(left, offsets[i]), right_cols[tx-1, y0:y1])
+        roots = find_roots(parent)
+        keep = (np.bincount(roots, weights=sizes, minlength=len(sizes)) >= threshold)[roots]
+        del results, bottom_rows, right_cols, parent, roots, sizes
+        
+        # 2nd pass: label the tiles again and switch the pixels of the small components
+        def clean_tile(i):
+            _, _, y0, y1, x0, x1 = tiles[i]
+            wy0, wy1, wx0, wx1 = windows[i]
+            labels = np.zeros((wy1-wy0, wx1-wx0), dtype=np.int32)
+            label_components(ma[wy0:wy1, wx0:wx1], value, labels)
+            clean_components(ma[y0:y1, x0:x1], labels[y0-wy0:y1-wy0, x0-wx0:x1-wx0], keep, offsets[i], value, out[y0:y1, x0:x1])
+        
+        list(executor.map(clean_tile, range(len(tiles))))
+    return out
+
+# remove small objects then fill small holes of a mask (whole scene semantics, computed tile by tile)
+def clean_mask(ma, objects_threshold, holes_threshold, threads=None):
+    objects = remove_small_components(ma, True, objects_threshold, np.empty_like(ma), threads=threads)
+    return remove_small_components(objects, False, holes_threshold, ma, threads=threads)
+
+def rice_mapping(temporal_mean, temporal_max_increase, temporal_min, temporal_max, rice_threshold_dB, trees_threshold_dB,
+                 water_threshold_dB, threads=None):
+    # Define the classes
+    class_type={"no_data":0, "rice":1, "urban_tree":2, "water":3, "other":4}
+    
+    holes_threshold = HOLES_THRESHOLD
+    objects_threshold = OBJECTS_THRESHOLD
+    
+    ricemap = np.full(temporal_mean.shape, class_type["no_data"], dtype=np.uint8)
+    
+    # Apply threshold to the 0 value => no data
+    ma = clean_mask(temporal_mean > 0, objects_threshold, holes_threshold, threads)
+    ricemap[ma] = class_type["other"]
+    
+    # Apply threshold to the temporal maximum increase => Rice
+    ma = clean_mask(temporal_max_increase > 10**(rice_threshold_dB/10.), objects_threshold, holes_threshold, threads)
+    ricemap[ma] = class_type["rice"]
+    
+    # Apply threshold to the temporal minimum value => Urban or forest
+    ma = clean_mask(temporal_min > 10**(trees_threshold_dB/10.), objects_threshold, holes_threshold, threads)
+    ricemap[ma] = class_type["urban_tree"]
+    
+    # Apply threshold to the temporal max value => Water
+    ma = clean_mask(temporal_max < 10**(water_threshold_dB/10.), objects_threshold, holes_threshold, threads)
+    ricemap[ma] = class_type["water"]
+    
+    return ricemap
+
+# parse rice/trees/water threshold triples (dB) of a sweep: 'rice,trees,water' triples separated by ';', each value being
+# a number or an inclusive start:stop:step range (a triple with ranges expands to all its combinations)
+# e.g. '4:6:0.5,-18,-19:-17:1;3,-18,-18'
+def parse_sweep(value):
+    triples = []
+    for triple in value.split(';'):
+        axes = []
+        for v in triple.split(','):
+            if ':' in v:
+                start, stop, step = [float(x) for x in v.split(':')]
+                axes.append([round(float(x), 6) for x in np.arange(start, stop + step / 2, step)])
+            else:
+                axes.append([float(v)])
+        if len(axes) != 3:
+            raise ValueError("bad threshold triple '%s', expected rice,trees,water"%triple)
+        triples += list(itertools.product(*axes))
+    return triples
+
+# parse seasonal windows: 'starting_date:ending_date' periods (YYYYMMDD, inclusive) separated by ',' or ';'
+# e.g. '20200101:20200630,20200701:20201231'
+def parse_windows(value):
+    windows = []
+    for window in value.replace(';', ',').split(','):
+        period = window.strip().split(':')
+        if len(period) != 2:
+            raise ValueError("bad window '%s', expected starting_date:ending_date"%window)
+        for date in period:
+            dt.datetime.strptime(date, '%Y%m%d')
+        windows.append(tuple(period))
+    return windows
+
+# area (km2) of a pixel of the given grid, None if the grid is not projected
+def pixel_area_km2(projection, transform):
+    srs = osr.SpatialReference(wkt=projection)
+    if not srs.IsProjected():
+        return None
+    return abs(transform[1]*transform[5] - transform[2]*transform[4]) * srs.GetLinearUnits()**2 / 1e6
+
+# ----------------------------------------------------------------------------------------------------------------------
+# numba processing functions
+
+# 8-connected components labelling of the pixels equal to value (two passes with union-find)
+# => labels are numbered 1..n by order of first occurrence (so labelling the same data twice gives the same labels)
+@numba.jit(nopython=True, nogil=True, cache=True)
+def label_components(ma, value, labels):
+    h, w = ma.shape
+    parent = np.zeros(h * ((w + 1) // 2) + 1, dtype=np.int32)
+    n = 0
+    for y in range(h):
+        for x in range(w):
+            if ma[y, x] != value:
+                continue
+            current = 0
+            # already visited neighbours: left, top-left, top, top-right
+            for dy, dx in ((0, -1), (-1, -1), (-1, 0), (-1, 1)):
+                yy, xx = y + dy, x + dx
+                if yy < 0 or xx < 0 or xx >= w or labels[yy, xx] == 0:
+                    continue
+                other = labels[yy, xx]
+                while parent[other] != other:
+                    other = parent[other]
+                if current == 0:
+                    current = other
+                elif other != current:
+                    # keep the oldest label as root
+                    if other < current:
+                        parent[current] = other
+                        current = other
+                    else:
+                        parent[other] = current
+            if current == 0:
+                n += 1
+                parent[n] = n
+                current = n
+            labels[y, x] = current
+    # resolve provisional labels to consecutive final labels
+    final = np.zeros(n + 1, dtype=np.int32)
+    count = 0
+    for i in range(1, n + 1):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        if root == i:
+            count += 1
+            final[i] = count
+        else:
+            final[i] = final[root]
+    for y in range(h):
+        for x in range(w):
+            labels[y, x] = final[labels[y, x]]
+    return count
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def component_sizes(labels, n):
+    sizes = np.zeros(n + 1, dtype=np.int64)
+    h, w = labels.shape
+    for y in range(h):
+        for x in range(w):
+            sizes[labels[y, x]] += 1
+    return sizes
+
+# tile labels to global labels, background stays 0
+@numba.jit(nopython=True, nogil=True, cache=True)
+def to_global(labels, offset):
+    out = np.zeros(labels.shape[0], dtype=np.int64)
+    for i in range(labels.shape[0]):
+        if labels[i] > 0:
+            out[i] = labels[i] + offset
+    return out
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def union_labels(parent, a, b):
+    for i in range(a.shape[0]):
+        if a[i] == 0 or b[i] == 0:
+            continue
+        ra, rb = a[i], b[i]
+        while parent[ra] != ra:
+            ra = parent[ra]
+        while parent[rb] != rb:
+            rb = parent[rb]
+        if ra < rb:
+            parent[rb] = ra
+        elif rb < ra:
+            parent[ra] = rb
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def find_roots(parent):
+    roots = np.empty_like(parent)
+    for i in range(parent.shape[0]):
+        # parents always have a lower index, so they are already resolved
+        roots[i] = i if parent[i] == i else roots[parent[i]]
+    return roots
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def clean_components(ma, labels, keep, offset, value, out):
+    h, w = ma.shape
+    for y in range(h):
+        for x in range(w):
+            label = labels[y, x]
+            if label > 0 and not keep[label + offset]:
+                out[y, x] = not value
+            else:
+                out[y, x] = ma[y, x]
+
+# class masks of a rice map block in one pass: out[c] = (ricemap == c), c in 0..4
+@numba.jit(nopython=True, nogil=True, cache=True)
+def class_masks(ricemap, out):
+    h, w = ricemap.shape
+    for c in range(out.shape[0]):
+        for y in range(h):
+            for x in range(w):
+                out[c, y, x] = 0
+    for y in range(h):
+        for x in range(w):
+            c = ricemap[y, x]
+            if c < out.shape[0]:
+                out[c, y, x] = 1
+
+# Temporal statistics of a (dates, lines, columns) cube, written into the caller provided (lines, columns) buffers.
+# Only values > 0.0013 (-29dB) are considered; for each pixel:
+# - mean: mean of the finite values (0 if no value, nan if no finite value)
+# - min / max: minimum / maximum, initialized with the 1st value then updated by finite values only
+#              (-inf / +inf if no value)
+# - max increase: max of the values located at least 20 days after the minimum of the 1st half of the time series,
+#                 divided by this minimum (0 if less than 2 values or no value after the minimum)
+# Lines are processed in parallel, the time series of a line is gathered into a (dates, columns) scratch buffer then
+# scanned date by date, only per line scratch buffers are allocated.
+# With lut, vh holds the uint16 codes of quantized scenes, decoded as they are gathered (lut: float32 value of each
+# code, see georice.codecs): the values within [-60 dB, +71 dB] are within 0.001 dB of the float32 ones, so are the mean,
+# min and max (0.023 %) and the max increase (0.002 dB, 0.046 %). Lower values are clipped to -60 dB, still below the
+# -29dB floor (ignored either way); higher values and +inf are clipped to +71 dB, which changes the min, max, mean and
+# max increase of their pixels. Pixels whose statistics are that close to a classification threshold may change class,
+# as may the statistics of pixels with values that close to the -29dB floor or with 1st half minima that close to each
+# other (another date for the minimum).
+@numba.jit(nopython=True, nogil=True, fastmath=False, parallel=True, cache=True)
+def global_statistics(vh, time_0, out_mean, out_incr, out_min, out_max, lut=None):
+    depth, h, w = vh.shape
+    for y in numba.prange(h):
+        # time series of the line gathered (and decoded) once into a contiguous scratch buffer
+        line = np.empty((depth, w), dtype=np.float32)
+        for t in range(depth):
+            for x in range(w):
+                line[t, x] = vh[t, y, x] if lut is None else lut[vh[t, y, x]]
+        line_statistics(line, time_0, out_mean[y], out_incr[y], out_min[y], out_max[y])
+
+# temporal statistics (see global_statistics) of the (dates, columns) time series of a line
+@numba.jit(nopython=True, nogil=True, fastmath=False, cache=True)
+def line_statistics(line, time_0, out_mean, out_incr, out_min, out_max):
+    depth, w = line.shape
+    cnt = np.zeros(w, dtype=np.int64)
+    cnt_finite = np.zeros(w, dtype=np.int64)
+    total = np.zeros(w, dtype=np.float64)
+    vmin = np.full(w, INF_NEG_FLOAT32, dtype=np.float32)
+    vmax = np.full(w, INF_POS_FLOAT32, dtype=np.float32)
+    
+    # count, sum, min and max of the values >= -29dB
+    for t in range(depth):
+        for x in range(w):
+            v = line[t, x]
+            if v > 0.0013:
+                finite = not (np.isinf(v) or np.isnan(v))
+                if cnt[x] == 0:
+                    vmin[x], vmax[x] = v, v
+                elif finite:
+                    if v < vmin[x]:
+                        vmin[x] = v
+                    if v > vmax[x]:
+                        vmax[x] = v
+                if finite:
+                    total[x] += v
+                    cnt_finite[x] += 1
+                cnt[x] += 1
+    
+    # minimum of the 1st half of the time series and its date
+    rank = np.zeros(w, dtype=np.int64)
+    half_min = np.zeros(w, dtype=np.float32)
+    half_min_time = np.zeros(w, dtype=time_0.dtype)
+    for t in range(depth):
+        for x in range(w):
+            v = line[t, x]
+            if v > 0.0013:
+                if rank[x] < cnt[x] // 2:
+                    if rank[x] == 0 or (v < half_min[x] and not (np.isinf(v) or np.isnan(v))):
+                        half_min[x], half_min_time[x] = v, time_0[t]
+                rank[x] += 1
+    
+    # the max is located at least 20 days after the min
+    found = np.zeros(w, dtype=np.bool_)
+    incr_max = np.zeros(w, dtype=np.float32)
+    for t in range(depth):
+        for x in range(w):
+            v = line[t, x]
+            if v > 0.0013 and cnt[x] > 1 and time_0[t] >= half_min_time[x] + 20:
+                if not found[x]:
+                    incr_max[x], found[x] = v, True
+                elif v > incr_max[x] and not (np.isinf(v) or np.isnan(v)):
+                    incr_max[x] = v
+    
+    for x in range(w):
+        if cnt[x] == 0:
+            out_mean[x] = 0
+        elif cnt_finite[x] == 0:
+            out_mean[x] = np.nan
+        else:
+            out_mean[x] = total[x] / cnt_finite[x]
+        out_incr[x] = incr_max[x] / half_min[x] if found[x] else 0
+        out_min[x] = vmin[x]
+        out_max[x] = vmax[x]
+
+# Fold the (dates, lines, columns) cube of new dates (days since the state origin, later than the folded ones) into the
+# running state of the same lines / columns (see RunningState); gives exactly the global_statistics definitions.
+@numba.jit(nopython=True, nogil=True, fastmath=False, parallel=True, cache=True)
+def fold_statistics(vh, times, cnt, total, vmin, vmax, half_min, half_min_time, records, record_rank, record_value,
+                    record_time, stairs, stair_value, stair_time, dirty):
+    depth, h, w = vh.shape
+    capacity = record_rank.shape[0]
+    for y in numba.prange(h):
+        for x in range(w):
+            for t in range(depth):
+                v = vh[t, y, x]
+                if dirty[y, x] or not v > 0.0013:
+                    continue
+                if np.isinf(v):
+                    # first value / ignored value semantics of infinite values are not tracked
+                    dirty[y, x] = True
+                    continue
+                rank = cnt[y, x]
+                
+                # values lower than all previous ones become the 1st half minimum when the 1st half reaches them
+                if rank == 0 or v < vmin[y, x]:
+                    n = records[y, x]
+                    if n == capacity:
+                        dirty[y, x] = True
+                        continue
+                    record_rank[n, y, x], record_value[n, y, x], record_time[n, y, x] = rank, v, times[t]
+                    records[y, x] = n + 1
+                
+                # values greater than all the following ones, dropping the ones before the max increase window
+                n = stairs[y, x]
+                while n > 0 and stair_value[n - 1, y, x] <= v:
+                    n -= 1
+                if n == capacity and rank > 1:
+                    first = 0
+                    while first < n and stair_time[first, y, x] < half_min_time[y, x] + 20:
+                        first += 1
+                    for i in range(first, n):
+                        stair_value[i - first, y, x], stair_time[i - first, y, x] = stair_value[i, y, x], stair_time[i, y, x]
+                    n -= first
+                if n == capacity:
+                    dirty[y, x] = True
+                    continue
+                stair_value[n, y, x], stair_time[n, y, x] = v, times[t]
+                stairs[y, x] = n + 1
+                
+                if rank == 0:
+                    vmin[y, x], vmax[y, x] = v, v
+                else:
+                    if v < vmin[y, x]:
+                        vmin[y, x] = v
+                    if v > vmax[y, x]:
+                        vmax[y, x] = v
+                total[y, x] += v
+                cnt[y, x] = rank + 1
+                
+                # the 1st half grows by one value every 2 values
+                if (rank + 1) % 2 == 0 and records[y, x] > 0 and record_rank[0, y, x] == (rank + 1) // 2 - 1:
+                    half_min[y, x], half_min_time[y, x] = record_value[0, y, x], record_time[0, y, x]
+                    n = records[y, x] - 1
+                    for i in range(n):
+                        record_rank[i, y, x] = record_rank[i + 1, y, x]
+                        record_value[i, y, x] = record_value[i + 1, y, x]
+                        record_time[i, y, x] = record_time[i + 1, y, x]
+                    records[y, x] = n
+
+# Running state (see RunningState) of the same lines / columns built at once from the whole (dates, lines, columns) time
+# series, for a cleared state: the candidate lists are the ones left at the end of the time series (the ones a fold
+# overflowed along the way may fit), the staircase without the values before the max increase window. Pixels whose
+# lists still overflow or having infinite values are left dirty.
+@numba.jit(nopython=True, nogil=True, fastmath=False, parallel=True, cache=True)
+def build_state(vh, times, cnt, total, vmin, vmax, half_min, half_min_time, records, record_rank, record_value,
+                record_time, stairs, stair_value, stair_time, dirty):
+    depth, h, w = vh.shape
+    capacity = record_rank.shape[0]
+    for y in numba.prange(h):
+        for x in range(w):
+            count = 0
+            for t in range(depth):
+                v = vh[t, y, x]
+                if v > 0.0013:
+                    if np.isinf(v):
+                        dirty[y, x] = True
+                    count += 1
+            if dirty[y, x]:
+                continue
+            
+            # values lower than all previous ones: the 1st half minimum, then the records after the 1st half
+            rank, n = 0, 0
+            for t in range(depth):
+                v = vh[t, y, x]
+                if not v > 0.0013:
+                    continue
+                if rank == 0 or v < vmin[y, x]:
+                    if rank < count // 2:
+                        half_min[y, x], half_min_time[y, x] = v, times[t]
+                    elif n < capacity:
+                        record_rank[n, y, x], record_value[n, y, x], record_time[n, y, x] = rank, v, times[t]
+                        n += 1
+                    else:
+                        dirty[y, x] = True
+                        break
+                if rank == 0:
+                    vmin[y, x], vmax[y, x] = v, v
+                else:
+                    if v < vmin[y, x]:
+                        vmin[y, x] = v
+                    if v > vmax[y, x]:
+                        vmax[y, x] = v
+                total[y, x] += v
+                rank += 1
+            if dirty[y, x]:
+                continue
+            cnt[y, x], records[y, x] = count, n
+            
+            # values greater than all the following ones (from the last one), down to the max increase window start
+            n, top = 0, INF_NEG_FLOAT32
+            for t in range(depth - 1, -1, -1):
+                v = vh[t, y, x]
+                if not v > 0.0013 or v <= top:
+                    continue
+                if count > 1 and times[t] < half_min_time[y, x] + 20:
+                    break
+                if n == capacity:
+                    dirty[y, x] = True
+                    break
+                stair_value[n, y, x], stair_time[n, y, x], top = v, times[t], v
+                n += 1
+            # in time order
+            for i in range(n // 2):
+                stair_value[i, y, x], stair_value[n - 1 - i, y, x] = stair_value[n - 1 - i, y, x], stair_value[i, y, x]
+                stair_time[i, y, x], stair_time[n - 1 - i, y, x] = stair_time[n - 1 - i, y, x], stair_time[i, y, x]
+            stairs[y, x] = n
+
+# Temporal statistics (see global_statistics) derived from the running state, dirty pixels are left untouched
+@numba.jit(nopython=True, nogil=True, fastmath=False, parallel=True, cache=True)
+def state_statistics(cnt, total, vmin, vmax, half_min, half_min_time, records, record_rank, record_value, record_time,
+                     stairs, stair_value, stair_time, dirty, out_mean, out_incr, out_min, out_max):
+    h, w = cnt.shape
+    for y in numba.prange(h):
+        for x in range(w):
+            if dirty[y, x]:
+                continue
+            out_mean[y, x] = total[y, x] / cnt[y, x] if cnt[y, x] > 0 else 0
+            out_incr[y, x] = 0
+            if cnt[y, x] > 1:
+                for i in range(stairs[y, x]):
+                    if stair_time[i, y, x] >= half_min_time[y, x] + 20:
+                        out_incr[y, x] = stair_value[i, y, x] / half_min[y, x]
+                        break
+            out_min[y, x] = vmin[y, x]
+            out_max[y, x] = vmax[y, x]
+
+#--- kernels compilation
+
+# numba kernels are cached on disk (cache=True, in __pycache__ next to this file or in NUMBA_CACHE_DIR) => they are
+# compiled by the first run only, later runs and pool workers load them
+KERNELS = [label_components, component_sizes, to_global, union_labels, find_roots, clean_components, class_masks,
+           global_statistics, line_statistics, fold_statistics, build_state, state_statistics]
+
+# compile (or load from the on-disk cache) the kernels for the argument types of a run, before any data is processed
+# - parallel kernels are compiled for contiguous and strided views without being run (no numba threads are started
+#   before the pool processes are forked)
+# - the morphology kernels are run on a tiny mask, with one tile and with several tiles
+# returns (seconds, number of kernels compiled, number of kernels loaded from the cache)
+def warm_up(update=False, morphology=True, quantized=False):
+    start = time.time()
+    hits = sum(sum(k.stats.cache_hits.values()) for k in KERNELS)
+    misses = sum(sum(k.stats.cache_misses.values()) for k in KERNELS)
+    
+    cube = numba.typeof(np.zeros((2, 2, 2), dtype=np.float32))
+    plane = numba.typeof(np.zeros((2, 2), dtype=np.float32))
+    for layout in ['C', 'A']:
+        global_statistics.compile((cube.copy(layout=layout), numba.typeof(np.array([0, 1])), plane, plane, plane, plane,
+                                   numba.types.none))
+        if quantized:
+            codes = numba.typeof(np.zeros((2, 2, 2), dtype=QUANTIZED_DTYPE)).copy(layout=layout)
+            global_statistics.compile((codes, numba.typeof(np.array([0, 1])), plane, plane, plane, plane,
+                                       numba.typeof(np.zeros(2, dtype=np.float32))))
+    if update:
+        times = numba.typeof(np.zeros(2, dtype=np.int16))
+        fields = [numba.typeof(np.zeros(([STATE_CAPACITY] if listed else []) + [2, 2], dtype=dtype))
+                  for _, dtype, listed in RunningState.FIELDS]
+        for layout in ['C', 'A']:
+            block_state = tuple(f.copy(layout=layout) for f in fields)
+            fold_statistics.compile((cube, times) + block_state)
+            build_state.compile((cube, times) + block_state)
+            state_statistics.compile(block_state + (plane, plane, plane, plane))
+    if morphology:
+        ricemap = numba.typeof(np.zeros((2, 2), dtype=np.uint8))
+        for layout in ['C', 'A']:
+            class_masks.compile((ricemap.copy(layout=layout), numba.typeof(np.zeros((5, 2, 2), dtype=np.uint8))))
+        ma = np.eye(4, dtype=bool)
+        for tile_size in [4, 2]:
+            for value in [True, False]:
+                remove_small_components(ma, value, 2, np.empty_like(ma), tile_size, 1)
+    
+    hits = sum(sum(k.stats.cache_hits.values()) for k in KERNELS) - hits
+    misses = sum(sum(k.stats.cache_misses.values()) for k in KERNELS) - misses
+    return time.time() - start, misses, hits
+
+# startup cost of the kernels in fresh processes, cold (empty on-disk cache: everything is compiled) then warm (loaded
+# from the cache filled by the cold start), the user cache is left untouched
+# returns {'cold'|'warm': {'wall', 'import', 'kernels', 'compiled', 'cached'}} (seconds / number of kernels)
+def startup_timing(update=True):
+    code = ("import time, json; t = time.time(); from georice import engine; i = time.time() - t; "
+            "k, compiled, cached = engine.warm_up(update=%r); "
+            "print(json.dumps({'import': i, 'kernels': k, 'compiled': compiled, 'cached': cached}))"%update)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    report = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir,
+                   PYTHONPATH=os.pathsep.join([package_root] + ([os.environ['PYTHONPATH']] if 'PYTHONPATH' in os.environ else [])))
+        for start in ['cold', 'warm']:
+            t = time.time()
+            output = subprocess.run([sys.executable, '-c', code], env=env, check=True, stdout=subprocess.PIPE,
+                                    universal_newlines=True).stdout
+            report[start] = dict(json.loads(output.strip().split('\n')[-1]), wall=time.time() - t)
+    
+    print()
+    print("Kernels startup (fresh process):")
+    for start in ['cold', 'warm']:
+        r = report[start]
+        print("- %s: %.3fs (import %.3fs, kernels %.3fs: %d compiled, %d loaded from cache)"
+              %(start, r['wall'], r['import'], r['kernels'], r['compiled'], r['cached']))
+    print("- Saved per process start: %.3fs"%(report['cold']['wall'] - report['warm']['wall']))
+    print()
+    return report
+
+# ----------------------------------------------------------------------------------------------------------------------
+# ----------------------------------------------------------------------------------------------------------------------
+# scenes selection & rice mapping
+
+# (path, date) of the VH scenes of data_path of an orbit / direction within [starting_date, ending_date] (YYYYMMDD),
+# sorted by date, selected with an indexed query of the folder catalog (see catalog.Catalog, synced first, or the given
+# synced catalog). One scene per date: the last modified one ('txxx' / 'nontxxx' modes), else (1) the txxxxxx one
+# (2) the last modified one
+def select_scenes(data_path, orbit, direction, starting_date, ending_date, txxx_mode='all', catalog=None):
+    date_start = dt.datetime.strptime(starting_date, '%Y%m%d').date()
+    date_end = dt.datetime.strptime(ending_date, '%Y%m%d').date()
+    
+    print()
+    print("- Orbit: " + orbit)
+    print("- Direction: " + direction)
+    print("- From " + date_start.strftime("%d, %b %Y") + " to " + date_end.strftime("%d, %b %Y"))
+    
+    if catalog is None:
+        if not os.path.isdir(data_path):
+            raise IOError('folder ' + str(data_path) + ' seems empty...')
+        with Catalog.open(data_path) as catalog:
+            catalog.sync()
+            rows = catalog.select(orbit, direction, starting_date, ending_date)
+    else:
+        rows = catalog.select(orbit, direction, starting_date, ending_date)
+    
+    selected, duplicates = {}, 0
+    for row in rows:
+        current = selected.get(row['date'])
+        if current is None:
+            selected[row['date']] = row
+            continue
+        duplicates += 1
+        if txxx_mode in ['txxx', 'nontxxx']:
+            newer = row['mtime'] > current['mtime']
+        else:
+            newer = (row['txxx'], row['mtime']) > (current['txxx'], current['mtime'])
+        if newer:
+            selected[row['date']] = row
+    if duplicates > 0:
+        print("- Duplicates: %d scene(s) on already selected dates => keeping %s" % (duplicates, 'last modified' if
+              txxx_mode in ['txxx', 'nontxxx'] else '(1)txxxxxx (2)last modified'))
+    
+    if len(selected) == 0:
+        raise ValueError('unable to find data fitting the selected time period / orbit / direction / ...')
+    
+    return [(os.path.join(data_path, row['file']), dt.datetime.strptime(date, '%Y%m%d').date())
+            for date, row in sorted(selected.items())]
+
+# compute the rice map of a list of (path, date) scenes (see select_scenes) over [starting_date, ending_date]
+# - products are written in output_path/ricemaps, reprojected to dst_srs (None: native grid)
+# - thresholds: rice, trees, water thresholds (dB), sweep: list of such triples (or sweep string, see parse_sweep)
+# - max_memory: memory budget (bytes or string, see parse_memory)
+# - write=False keeps the products in memory only (not available in streaming mode)
+# - multiband_masks: write the 5 class masks of a rice map as one 5 bands 1 bit product (masks_...tif)
+# - cog: products with internal overviews (MODE for classes, AVERAGE for statistics), as cloud optimized geotiffs if
+#   ghost_area, else appended to the products as written (see cogGTiff)
+# - telemetry_path: record the statistics / morphology / write stages (see telemetry.session) in this folder, profile:
+#   cProfile each stage too. Within an active telemetry session, the stages are recorded in it
+# - coverage: AOI coverage mask raster of the scene grid (non zero inside the AOI), default output_path/coverage/
+#   <tile>.tif if it exists (see GetSentinel.save_coverage), False: none. The blocks and rows without pixel inside the
+#   AOI are neither read nor processed, the pixels outside the AOI are classified as no data
+# - windows: seasonal mode, list of (starting_date, ending_date) periods (or windows string, see parse_windows) instead
+#   of [starting_date, ending_date]. The dates of all windows are read once per block, the statistics of each window
+#   are computed from the same data cube, one product set per window (products suffixed with its period). Not
+#   available with the incremental update
+# returns a dict: windows, thresholds, class_pixels (pixels per class for each window and triple), skipped_pixels
+# (pixels neither read nor processed), files (written products) and, if not streaming, statistics (name => array, one
+# dict per window in seasonal mode) and ricemaps (one array per window and triple)
+def ricemap(scenes, starting_date, ending_date, output_path, intermediate=False, compressor='deflate', masks=False,
+            dst_srs='EPSG:4326', streaming=False, threads=NUMBER_OF_THREADS,
+            thresholds=(RICE_THRESHOLD_DB, urban_trees_threshold_dB, water_threshold_dB), max_memory=None,
+            prefetch=PREFETCH_BUFFERS, datacube=False, update=False, sweep=None, write=True, multiband_masks=False,
+            cog=False, ghost_area=True, telemetry_path=None, profile=False, coverage=None, windows=None):
+    if streaming and not write:
+        raise ValueError('streaming mode products can only be written')
+    if isinstance(max_memory, str):
+        max_memory = parse_memory(max_memory)
+    if isinstance(sweep, str):
+        sweep = parse_sweep(sweep)
+    if isinstance(windows, str):
+        windows = parse_windows(windows)
+    if windows and update:
+        raise ValueError('the incremental update does not support seasonal windows')
+    windows = [tuple(w) for w in windows] if windows else [(starting_date, ending_date)]
+    if compressor is not None:
+        parse_codec(compressor)
+    
+    # catch SIGINT (ctrl+c) signal, only possible from the main thread
+    handler = None
+    if threading.current_thread() is threading.main_thread():
+        handler = signal.signal(signal.SIGINT, signal_handler)
+    product = os.path.basename(scenes[0][0]).split('_')
+    labels = {'tile': product[1], 'direction': product[3], 'orbit': product[4]}
+    try:
+        with telemetry.session(telemetry_path, '_'.join(['ricemap'] + list(labels.values())), labels, profile):
+            return _ricemap(scenes, starting_date, ending_date, output_path, intermediate, compressor, masks, dst_srs,
+                            streaming, threads, thresholds, max_memory, max(1, prefetch), BLOCK_SIZE, datacube, update,
+                            sweep, write, multiband_masks, cog, ghost_area, coverage, windows)
+    finally:
+        shutdown()
+        if DISABLE_GARBAGE_COLLECTOR:
+            gc.collect()
+            gc.enable()
+        if handler is not None:
+            signal.signal(signal.SIGINT, handler)
+
+def _ricemap(scenes, starting_date, ending_date, output_path, intermediate, compressor, masks, dst_srs, streaming,
+             threads, thresholds, max_memory, buffers, block_size, datacube, update, sweep, write, multiband_masks, cog,
+             ghost_area, coverage, windows):
+    global THREAD_POOL, SHARED_MEMORY, SHARED_BUFFER, SHARED_BLOCK_SIZE, SHARED_TIME, SHARED_DTYPE, SHARED_LUT, \
+        SHARED_WINDOWS, RASTER_READER
+    
+    # gather some informations about products to prefix output data files (one suffix per window)
+    product = os.path.basename(scenes[0][0]).split('_')
+    output_suffix_short = '_' + product[1] + '_' + product[3] + '_' + product[4]
+    output_suffixes = [output_suffix_short + '_' + start + '_' + end + '.tif' for start, end in windows]
+    orbit, direction = product[4], product[3]
+    
+    # Sorting data in a chronological order
+    a = np.empty((len(scenes),2), dtype=object)
+    for i in range(len(scenes)):
+        a[i,0] = scenes[i][0]
+        a[i,1] = scenes[i][1]
+    list_of_raster_vh = a[np.argsort(a[:,1]),:]
+    
+    # only the dates within a window are read, each window is then a (t0, t1) range of the time scale
+    dates = np.array([d.strftime('%Y%m%d') for d in list_of_raster_vh[:, 1]])
+    inside = np.array([any(start <= d <= end for start, end in windows) for d in dates], dtype=bool)
+    list_of_raster_vh, dates = list_of_raster_vh[inside], dates[inside]
+    ranges = [(int(np.searchsorted(dates, start, 'left')), int(np.searchsorted(dates, end, 'right')))
+              for start, end in windows]
+    for (start, end), (t0, t1) in zip(windows, ranges):
+        if t1 <= t0:
+            raise ValueError('no scene within the window %s - %s'%(start, end))
+    dates = list(dates)
+    
+    # ------------------------------------------------------------------------------------------------------------------
+    # initialize processing
+    
+    process = psutil.Process(os.getpid())
+    
+    # output_path = os.path.join(output_path, product[1], 'ricemaps') # org
+
+    if coverage is None:
+        coverage = os.path.join(output_path, 'coverage', product[1] + '.tif')
+        coverage = coverage if os.path.exists(coverage) else False
+    coverage = coverage or None
+    key = scenes_key(os.path.dirname(list_of_raster_vh[0,0]), output_path, product[1], orbit, direction)
+    datacube_path = os.path.join(output_path, 'datacube', key)
+    state_path = os.path.join(output_path, 'state', key + '_' + starting_date)
+    output_path = os.path.join(output_path, 'ricemaps')
+
+    if write and not os.path.exists(output_path):
+        os.makedirs(output_path)
+    
+    if threads <= 0:
+        threads = 2
+    
+    # gathering informations from 1st date geotiff (to be replicated in output geotiff)
+    full_width, full_height, nodata, projection, transform, compression, blocksize, _, _, epsg = get_geotiff_infos(list_of_raster_vh[0,0])
+    depth = len(list_of_raster_vh)
+    full_shape = [full_height, full_width]
+    
+    # quantized scenes (uint16 codes, see georice.codecs) are loaded as is, half the memory of a float32 data cube, and
+    # decoded by the statistics kernel; the datacube and the incremental update work on float32 values
+    with rio.open(list_of_raster_vh[0,0]) as ds:
+        quantized = ds.dtypes[0] == QUANTIZED_DTYPE
+    cube_dtype = np.dtype(QUANTIZED_DTYPE if quantized and not (datacube or update) else np.float32)
+    
+    # AOI coverage mask, on the grid of the scenes
+    if coverage is not None:
+        coverage = rio.open(coverage)
+        if (coverage.width, coverage.height) != (full_width, full_height):
+            coverage.close()
+            raise ValueError('AOI coverage mask grid (%dx%d) does not match the scenes grid (%dx%d)'
+                             %(coverage.width, coverage.height, full_width, full_height))
+    
+    # fit the block size (and number of processing units) to the memory budget
+    base_memory = memory_usage(process)
+    budget = None
+    if max_memory is not None:
+        requested = threads
+        block_size, threads, number_of_chunks, budget = plan_blocks(max_memory, depth, threads, full_shape, streaming,
+                                                                    base_memory, buffers, cube_dtype,
+                                                                    coverage is not None, len(windows))
+        if threads < requested:
+            print("- Memory budget: processing units lowered from %d to %d"%(requested, threads))
+    
+    # check processing block size and set data shape
+    if block_size < TIFF_BLOCK_SIZE:
+        block_size = TIFF_BLOCK_SIZE
+    if budget is None:
+        number_of_chunks = data_chunks(block_size, threads)
+    x_pos, y_pos = 0, 0
+    width, height = block_size, block_size
+    
+    # handle output tiff options
+    if TIFF_BLOCK_SIZE >= 16:
+        geotiff_options = ['TILED=YES', 'BLOCKXSIZE='+str(TIFF_BLOCK_SIZE),'BLOCKYSIZE='+str(TIFF_BLOCK_SIZE)]
+    else:
+        geotiff_options = ['TILED=NO']
+    
+    # create time scale in Jd relative to day 1 of year 0
+    time_0 = np.array([int(date_to_jd_from_year_0(list_of_raster_vh[t,1])) for t in range(len(list_of_raster_vh))])
+    
+    print("- Time scale (julian days, since day 1 of year 0): %d dates, %d -> %d"%(len(time_0), time_0[0], time_0[-1]))
+    print("- Threads:", threads)
+    if len(windows) > 1:
+        print("- Seasonal windows: %s (%d dates read once)"%(', '.join('%s - %s: %d dates'%(start, end, t1 - t0)
+              for (start, end), (t0, t1) in zip(windows, ranges)), depth))
+    if quantized:
+        print("- Scenes: quantized (uint16 dB), %s data cube"%cube_dtype.name)
+    
+    # kernels compiled (or loaded from the on-disk cache) before any data is read, workers load theirs in init_worker
+    seconds, compiled, cached = warm_up(update, quantized=cube_dtype == QUANTIZED_DTYPE)
+    print("- Kernels: %.3fs (%d compiled, %d loaded from cache)"%(seconds, compiled, cached))
+    
+    # memory expected to be used, checked against the memory peak at the end of the run
+    expected = expected_memory(block_size, depth, threads, full_shape, streaming, base_memory, buffers, cube_dtype,
+                               coverage is not None, len(windows))
+    print("- Block size: %d (%d blocks)"%(block_size, (-(-full_width // block_size)) * (-(-full_height // block_size))))
+    if budget is None:
+        print("- Expected memory: %.3fG, %d chunks per block"%(expected / 1024**3, number_of_chunks))
+    else:
+        print("- Expected memory: %.3fG (budget %.3fG), %d chunks per block"%(expected / 1024**3, budget / 1024**3,
+                                                                            number_of_chunks))
+        if expected > budget:
+            print("  WARNING: the smallest block size does not fit in the memory budget"
+                  + ("" if streaming else ", consider the streaming mode (-s)"))
+    
+    # memory monitor thread
+    monitor = MemoryMonitor(process, 1)
+    monitor.start()
+    
+    # ------------------------------------------------------------------------------------------------------------------
+    
+    # BLOCK_SIZExBLOCK_SIZE blocks to process
+    x_blocks = list(range(0, full_width, block_size)) + [full_width]
+    y_blocks = list(range(0, full_height, block_size)) + [full_height]
+    nb_blocks_x, nb_blocks_y = len(x_blocks) - 1, len(y_blocks) - 1
+    
+    if DISABLE_GARBAGE_COLLECTOR:
+        gc.disable()
+    
+    # output products, the statistics of each window
+    stats_names = ['temporalMean', 'temporalMaxIncrease', 'temporalMin', 'temporalMax']
+    stats_files = [[os.path.join(output_path, name+suffix) for name in stats_names] for suffix in output_suffixes]
+    mask_names = ['mask_nodata', 'mask_rice', 'mask_trees', 'mask_water', 'mask_other']
+    # one rice map (and masks) per window and threshold triple, tagged with the thresholds in sweep mode
+    thresholds = sweep if sweep else [tuple(thresholds)]
+    tags = ['_tr%g_%g_%g'%t for t in thresholds] if sweep else ['']
+    sets = [(w, k) for w in range(len(windows)) for k in range(len(thresholds))]
+    ricemap_files = [os.path.join(output_path, 'ricemap'+tags[k]+output_suffixes[w]) for w, k in sets]
+    mask_files = [[os.path.join(output_path, name+tags[k]+output_suffixes[w]) for name in mask_names] if masks else []
+                  for w, k in sets]
+    if masks and multiband_masks:
+        mask_files = [[os.path.join(output_path, 'masks'+tags[k]+output_suffixes[w])] for w, k in sets]
+    class_pixels = np.zeros((len(sets), len(mask_names)), dtype=np.int64)
+    result = {'windows': windows, 'thresholds': thresholds, 'class_pixels': class_pixels}
+    
+    files = []
+    
+    # allocate dataset, the data cube and the block statistics live in shared memory (one slot per prefetch buffer)
+    # => workers read their lines and write their statistics without any copy
+    buffer_size = buffers * slot_size(block_size, depth, cube_dtype, len(windows))
+    SHARED_MEMORY = shared_memory.SharedMemory(create=True, size=buffer_size)
+    SHARED_BUFFER = np.ndarray(buffer_size, dtype=np.uint8, buffer=SHARED_MEMORY.buf)
+    SHARED_BLOCK_SIZE, SHARED_TIME, SHARED_DTYPE, SHARED_WINDOWS = block_size, time_0, cube_dtype, ranges
+    SHARED_LUT = quantized_lut() if cube_dtype == QUANTIZED_DTYPE else None
+    # products are written block by block in the native grid, then reprojected file to file if asked
+    # => in streaming mode statistics are always written (temporary files if intermediate products are not asked)
+    ricemaps_native = [f if dst_srs is None else tmpFile(f) for f in ricemap_files]
+    masks_native = [[f if dst_srs is None else tmpFile(f) for f in names] for names in mask_files]
+    stats_native = [[f if intermediate and dst_srs is None else tmpFile(f) for f in names] for names in stats_files]
+    if write:
+        writer = ProductWriter(full_shape, projection, transform, compressor, geotiff_options, threads)
+        if streaming or intermediate:
+            for f in sum(stats_native, []):
+                writer.create(f, np.float32)
+        for f in ricemaps_native:
+            writer.create(f, np.uint8, 0)
+        for names in masks_native:
+            for f in names:
+                writer.create(f, np.uint8, 0, ['NBITS=1'], mask_names if multiband_masks else None)
+    if not streaming:
+        # temporal mean, max increase, min and max of each window
+        temporal = np.zeros([4 * len(windows)] + full_shape, dtype=np.float32)
+    
+    # create processing units pool, once for the whole run
+    # => workers attach to the shared cube when they start, the pool is torn down at the end of the run or on ctrl+c
+    if threads > 1:
+        THREAD_POOL = pool_context().Pool(threads, initializer=init_worker,
+                                          initargs=(SHARED_MEMORY.name, buffer_size, block_size, time_0, cube_dtype,
+                                                    ranges))
+    else:
+        numba.set_num_threads(1)
+    
+    # input rasters reader (created after the pool, no reading threads are forked)
+    if datacube:
+        cube = Datacube.from_raster(datacube_path, list_of_raster_vh[0,0], TIFF_BLOCK_SIZE)
+        print("- Datacube: %s (%d dates)"%(datacube_path, len(cube.dates)))
+        for f, date in zip(list_of_raster_vh[:, 0], dates):
+            if date not in cube.dates:
+                cube.append(date, f)
+                print("  [vh] appended @ " + date + " (" + os.path.basename(f) + ")")
+            elif cube.replace(date, f):
+                print("  [vh] replaced @ " + date + " (" + os.path.basename(f) + ")")
+        RASTER_READER = DatacubeReader(cube, dates)
+    else:
+        RASTER_READER = RasterReader(list_of_raster_vh[:, 0])
+    blocks = [(x_blocks[x_block], y_blocks[y_block], x_blocks[x_block+1] - x_blocks[x_block], y_blocks[y_block+1] - y_blocks[y_block])
+              for x_block in range(nb_blocks_x) for y_block in range(nb_blocks_y)]
+    
+    # rows of the blocks to read and process: the runs of rows with pixels inside the AOI (all rows without coverage
+    # mask), blocks without any are skipped; the incremental update reads the whole rows of the blocks it processes
+    runs = {}
+    for x, y, w, h in blocks:
+        runs[(x, y)] = [(0, h)] if coverage is None else covered_runs(coverage.read(1, window=Window(x, y, w, h)) != 0)
+        if update and len(runs[(x, y)]) > 0:
+            runs[(x, y)] = [(0, h)]
+    skipped_pixels = sum(w * (h - sum(r1 - r0 for r0, r1 in runs[(x, y)])) for x, y, w, h in blocks)
+    result['skipped_pixels'] = skipped_pixels
+    if coverage is not None:
+        print("- AOI coverage: %s, %d/%d blocks skipped, %d pixels (%.1f%%) neither read nor processed"
+              %(coverage.name, sum(len(r) == 0 for r in runs.values()), len(blocks), skipped_pixels,
+                100. * skipped_pixels / (full_width * full_height)))
+        block_stats = np.empty((4 * len(windows), block_size, block_size), dtype=np.float32)
+    prefetcher = BlockPrefetcher(RASTER_READER, SHARED_BUFFER, block_size, depth,
+                                 [] if update else [b + (runs[b[:2]],) for b in blocks if len(runs[b[:2]]) > 0],
+                                 buffers, cube_dtype, len(windows))
+    
+    # running state of the incremental update, rebuilt if it does not fold the beginning of the selected dates
+    if update:
+        sources = [os.path.basename(f) for f in list_of_raster_vh[:, 0]]
+        state = RunningState.open(state_path, full_shape, dates, sources)
+        if state is None:
+            print("- Running state: %s (new)"%state_path)
+            state = RunningState.create(state_path, full_shape, time_0[0])
+        else:
+            print("- Running state: %s (%d dates folded)"%(state_path, len(state.dates)))
+        new_dates = list(range(len(state.dates), depth))
+        times = (time_0 - state.time_origin).astype(np.int16)
+        state.save(state.dates, state.sources, complete=False)
+        print("- Dates to fold:", len(new_dates))
+        recomputed_blocks = 0
+    
+    start_time = time.time()
+    
+    print()
+    print("Gathering data statistics for whole time scale", end=' ', flush=True)
+    
+    stage = telemetry.begin('statistics')
+    prefetcher.start()
+    for x_block in range(nb_blocks_x):
+        for y_block in range(nb_blocks_y):
+            
+            print('%d/%d'%(x_block*nb_blocks_y+y_block+1, nb_blocks_x*nb_blocks_y), end=' ', flush=True)
+            x_pos, y_pos = x_blocks[x_block], y_blocks[y_block]
+            width = x_blocks[x_block+1] - x_pos
+            height = y_blocks[y_block+1] - y_pos
+            block_runs = runs[(x_pos, y_pos)]
+            rows = sum(r1 - r0 for r0, r1 in block_runs)
+            lines = [(i*rows)//number_of_chunks for i in range(number_of_chunks)] + [rows]
+            
+            if len(block_runs) == 0:
+                # no pixel inside the AOI: nothing read nor processed, pixels left out of the running state
+                slot, recompute = None, False
+                S1_dataset_vh, S1_block_stats = None, block_stats[:, :height, :width]
+                S1_block_stats[:] = np.tile(EMPTY_STATISTICS, len(windows))[:, None, None]
+                if update:
+                    state.block(y_pos, y_pos + height, x_pos, x_pos + width)[-1][:] = True
+            elif update:
+                # fold the new dates into the running state and derive the statistics from it
+                # => the whole time series is only read if the block has pixels the state cannot follow
+                slot = 0
+                S1_dataset_vh, S1_block_stats = block_views(SHARED_BUFFER, block_size, depth, height, width, slot)
+                window = Window(x_pos, y_pos, width, height)
+                block_state = state.block(y_pos, y_pos + height, x_pos, x_pos + width)
+                if len(new_dates) > 0:
+                    RASTER_READER.read(window, S1_dataset_vh[:len(new_dates)], new_dates)
+                    fold_statistics(S1_dataset_vh[:len(new_dates)], times[new_dates], *block_state)
+                state_statistics(*block_state, *S1_block_stats)
+                recompute = block_state[-1].any()
+                if recompute:
+                    RASTER_READER.read(window, S1_dataset_vh)
+                    recomputed_blocks += 1
+                    # state of the block built again from its whole time series: its dirty pixels are followed by the
+                    # state again, unless their candidate lists still overflow or they have infinite values
+                    RunningState.clear(block_state)
+                    build_state(S1_dataset_vh, times, *block_state)
+                del block_state
+            else:
+                # vh data of the covered rows loaded by the prefetch thread, each date is read straight into its
+                # contiguous plane of the cube
+                slot = prefetcher.get()
+                S1_dataset_vh, S1_block_stats = block_views(SHARED_BUFFER, block_size, depth, rows, width, slot,
+                                                            cube_dtype, len(windows))
+                recompute = True
+            
+            # gather statistics (temporal min, max, mean, max_increase) over the time scale of each window
+            # => workers read their lines from the shared cube and write them into the shared block statistics
+            if recompute:
+                params = []
+                for i in range(number_of_chunks):
+                    params.append([slot, lines[i], lines[i+1], rows, width])
+                starmap(THREAD_POOL, block_statistics, params)
+            if coverage is not None and slot is not None:
+                # statistics of the covered rows back to their rows, the pixels outside the AOI as without data
+                covered = coverage.read(1, window=Window(x_pos, y_pos, width, height)) != 0
+                S1_block_stats = expand_statistics(S1_block_stats, block_runs, covered,
+                                                   block_stats[:, :height, :width])
+            if streaming:
+                writer.write(dict(zip(sum(stats_native, []), S1_block_stats)), x_pos, y_pos)
+            else:
+                c0, cn = x_pos, x_pos + width
+                l0, ln = y_pos, y_pos + height
+                temporal[:, l0:ln, c0:cn] = S1_block_stats
+            del S1_dataset_vh, S1_block_stats
+            if not update and slot is not None:
+                prefetcher.release(slot)
+            
+            # ------------------------------------------------------------------------------------------------------------------
+    
+    print()
+    if update:
+        state.save(dates, sources)
+        state.close()
+        print("- Incremental update: %d date(s) folded, %d/%d block(s) recomputed from the whole time series"%(len(new_dates), recomputed_blocks, nb_blocks_x*nb_blocks_y))
+    else:
+        print("- I/O stall: %.3fs (waiting for data), compute stall: %.3fs (read-ahead waiting for a free buffer)"%(prefetcher.io_stall, prefetcher.compute_stall))
+    if coverage is not None:
+        coverage.close()
+    telemetry.end(stage)
+    
+    stage = telemetry.begin('morphology')
+    if streaming:
+        print("Building rice map", end=' ', flush=True)
+        writer.close(sum(stats_native, []))
+        stats_datasets = [[rio.open(f) for f in names] for names in stats_native]
+        for x_block in range(nb_blocks_x):
+            for y_block in range(nb_blocks_y):
+                
+                print('%d/%d'%(x_block*nb_blocks_y+y_block+1, nb_blocks_x*nb_blocks_y), end=' ', flush=True)
+                x_pos, y_pos = x_blocks[x_block], y_blocks[y_block]
+                width = x_blocks[x_block+1] - x_pos
+                height = y_blocks[y_block+1] - y_pos
+                
+                # classify the block with a margin so that the morphological cleanup matches the whole scene one
+                x0, y0 = max(0, x_pos - MORPHOLOGY_HALO), max(0, y_pos - MORPHOLOGY_HALO)
+                x1, y1 = min(full_width, x_pos + width + MORPHOLOGY_HALO), min(full_height, y_pos + height + MORPHOLOGY_HALO)
+                window = Window(x0, y0, x1 - x0, y1 - y0)
+                stats = [[ds.read(1, window=window) for ds in datasets] for datasets in stats_datasets]
+                blocks = {}
+                for i, (w, k) in enumerate(sets):
+                    block_ricemap = rice_mapping(*stats[w], *thresholds[k], threads)[y_pos-y0:y_pos-y0+height, x_pos-x0:x_pos-x0+width]
+                    class_pixels[i] += np.bincount(block_ricemap.ravel(), minlength=len(mask_names))
+                    blocks.update(writer.class_blocks(block_ricemap, ricemaps_native[i], masks_native[i]))
+                writer.write(blocks, x_pos, y_pos)
+                del stats, blocks
+        for ds in sum(stats_datasets, []):
+            ds.close()
+        print()
+        telemetry.end(stage)
+        stage = telemetry.begin('write') if write else None
+    else:
+        statistics = [dict(zip(stats_names, temporal[4*w:4*w+4])) for w in range(len(windows))]
+        result['statistics'] = statistics if len(windows) > 1 else statistics[0]
+        result['ricemaps'] = []
+        for i, (w, k) in enumerate(sets):
+            print("Building rice map" + (" (%s - %s)"%windows[w] if len(windows) > 1 else "")
+                  + (" (thresholds %g,%g,%g dB)"%thresholds[k] if sweep else ""))
+            S1_dataset_ricemap = rice_mapping(*temporal[4*w:4*w+4], *thresholds[k], threads)
+            class_pixels[i] = np.bincount(S1_dataset_ricemap.ravel(), minlength=len(mask_names))
+            result['ricemaps'].append(S1_dataset_ricemap)
+            del S1_dataset_ricemap
+        telemetry.end(stage)
+        
+        if write:
+            print("Writing output product(s)")
+            stage = telemetry.begin('write')
+            # all products in one pass over strips of whole tiles, masks derived strip by strip
+            for y0 in range(0, full_height, TIFF_BLOCK_SIZE):
+                y1 = min(full_height, y0 + TIFF_BLOCK_SIZE)
+                blocks = {}
+                if intermediate:
+                    blocks.update(zip(sum(stats_native, []), temporal[:, y0:y1]))
+                for i in range(len(sets)):
+                    blocks.update(writer.class_blocks(result['ricemaps'][i][y0:y1], ricemaps_native[i], masks_native[i]))
+                writer.write(blocks, 0, y0)
+                del blocks
+    
+    if write:
+        writer.close()
+        files += ricemap_files + sum(mask_files, []) + (sum(stats_files, []) if intermediate else [])
+        if dst_srs is not None:
+            print("Reprojecting output product(s)")
+            descriptions = mask_names if multiband_masks else None
+            products = [(f, f_out, np.uint8, 0, [], None) for f, f_out in zip(ricemaps_native, ricemap_files)]
+            products += [(f, f_out, np.uint8, 0, ['NBITS=1'], descriptions)
+                         for f, f_out in zip(sum(masks_native, []), sum(mask_files, []))]
+            if intermediate:
+                products += [(f, f_out, np.float32, None, [], None)
+                             for f, f_out in zip(sum(stats_native, []), sum(stats_files, []))]
+            reprojection = Reprojection(full_shape, projection, transform, dst_srs)
+            try:
+                reprojection.warp(products, compressor, geotiff_options, threads)
+            finally:
+                reprojection.close()
+        # remove temporary files (native grid products and statistics only used to build the rice map)
+        for f in ricemaps_native + sum(masks_native, []) + sum(stats_native, []):
+            if f not in ricemap_files + sum(mask_files, []) + sum(stats_files, []) and os.path.exists(f):
+                os.remove(f)
+        if cog:
+            print("Building overviews" + (" (cloud optimized geotiff)" if ghost_area else ""))
+            products = [(f, np.uint8, 'MODE', []) for f in ricemap_files]
+            products += [(f, np.uint8, 'MODE', ['NBITS=1']) for f in sum(mask_files, [])]
+            if intermediate:
+                products += [(f, np.float32, 'AVERAGE', []) for f in sum(stats_files, [])]
+            cogProducts(products, compressor, geotiff_options, ghost_area, threads)
+        telemetry.end(stage)
+    
+    # class areas of each threshold triple (native grid), one summary per window
+    if sweep and write:
+        area = pixel_area_km2(projection, transform)
+        classes = [name[len('mask_'):] for name in mask_names]
+        for w, suffix in enumerate(output_suffixes):
+            summary_file = os.path.join(output_path, 'ricemap_sweep' + suffix[:-len('.tif')] + '.csv')
+            with open(summary_file, 'w') as f:
+                f.write(','.join(['rice_dB', 'trees_dB', 'water_dB', 'file'] + [c+'_pixels' for c in classes]
+                                 + ([c+'_km2' for c in classes] if area is not None else [])) + '\n')
+                for (window, k), file, pixels in zip(sets, ricemap_files, class_pixels):
+                    if window != w:
+                        continue
+                    f.write(','.join(['%g'%v for v in thresholds[k]] + [os.path.basename(file)]
+                                     + ['%d'%n for n in pixels]
+                                     + (['%.6f'%(n * area) for n in pixels] if area is not None else [])) + '\n')
+            files.append(summary_file)
+            print("Class area summary:", summary_file)
+    
+    print()
+    print("Rice classification completed... Δt = %.6s seconds" % (time.time() - start_time))
+    print('Memory peak: %.3fG'%monitor.get_peak_memory_gb())
+    if budget is not None:
+        print('Memory budget %s: %.3fG'%('respected' if monitor.get_peak_memory() <= budget else 'EXCEEDED', budget / 1024**3))
+    print()
+    monitor.stop()
+    
+    result['files'] = files
+    return result
@@ -1,5 +1,7 @@
 from subprocess import Popen, DEVNULL
 from .utils import load_config
+from . import telemetry
+from .catalog import Catalog
 import os
 import psutil
 import time
@@ -7,6 +9,11 @@ from osgeo import gdal
 from datetime import datetime
 
 
+# the filter works on linear backscatter, quantized scenes hold uint16 codes of dB values (see georice.codecs)
+QUANTIZED_ERROR = 'Speckle filtering of quantized scenes is not supported, download float32 scenes (config key ' \
+                  'quantized) or process them without filtering'
+
+
 class Filtering:
     """ This module runs multitemporal speckle filtering processor """
 
@@ -25,7 +32,10 @@ class Filtering:
 
         self.name = name
 
-        filelist_str = " ".join((scene.path for scene in self.get_scenes if scene.name.endswith('.tif')))
+        scenes = [scene.path for scene in self.get_scenes if scene.name.endswith('.tif')]
+        if any(gdal.Open(path).GetRasterBand(1).DataType == gdal.GDT_UInt16 for path in scenes):
+            raise ValueError(QUANTIZED_ERROR)
+        filelist_str = " ".join(scenes)
         year_outcore_str = '-'.join([min(self.outcore_year), max(self.outcore_year)])
 
         try:
@@ -34,9 +44,20 @@ class Filtering:
             print('error to create filtered')
             pass
 
-        self.compute_outcore(filelist_str, orbit_path, year_outcore_str)
+        with telemetry.stage('filtering'):
+            self.compute_outcore(filelist_str, orbit_path, year_outcore_str)
+
+            self.compute_filtered(filelist_str, orbit_path, year_outcore_str)
+
+            # index the filtered scenes written by OTB into the catalog of their folder (see georice.catalog)
+            with Catalog.open(self.folder_path(f'scenes{os.sep}filtered')) as catalog:
+                catalog.sync(force=True)
 
-        self.compute_filtered(filelist_str, orbit_path, year_outcore_str)
+    @staticmethod
+    def check_config():
+        """Raise a ValueError if the scenes downloaded with the current config cannot be filtered"""
+        if load_config().get('quantized', False):
+            raise ValueError(QUANTIZED_ERROR)
 
     def compute_outcore(self, filelist_str, orbit_path, year_outcore_str):
 
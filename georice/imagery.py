@@ -2,14 +2,20 @@ import concurrent.futures
 import os
 from datetime import datetime
 from urllib.parse import urlencode
-from rasterio import open as raster_open
+from rasterio import open as raster_open, Env
+from rasterio.shutil import copy as raster_copy
+from rasterio.enums import Resampling
 from rasterio.transform import Affine
 from rasterio.warp import calculate_default_transform
 from rasterio.features import rasterize
 from requests import get
-from sentinelhub import BBox, SentinelHubRequest, SHConfig, MimeType
+from sentinelhub import BBox, SentinelHubRequest, MimeType
 from itertools import repeat
 from .utils import load_config, load_sh
+from .codecs import rasterio_options, quantized_evalscript, QUANTIZED_DTYPE, QUANTIZED_NODATA, QUANTIZED_DB_MIN, \
+    QUANTIZED_DB_SCALE
+from .catalog import Catalog
+from . import telemetry
 from pyproj import CRS, Transformer
 from shapely.ops import transform
 from shapely.geometry import Polygon, MultiPolygon, shape
@@ -47,6 +53,16 @@ class GetSentinel:
     def polar_modes(self):
         return load_config().get('polar_modes')
 
+    @property
+    def scene_format(self):
+        """
+        (dtype, nodata) of the downloaded scenes: float32 backscatter, or with the config key quantized uint16 codes of
+        the backscatter in dB (see georice.codecs), half the size to download, store and load
+        """
+        if self.config.get('quantized', False):
+            return QUANTIZED_DTYPE, QUANTIZED_NODATA
+        return 'float32', self.nodata
+
     def __copy__(self):
         return deepcopy(self)
 
@@ -77,13 +93,14 @@ class GetSentinel:
         self.aoi.round_geom(-int(log10(self.resolution)))
         self.period = [datetime.strptime(time, '%Y%m%d') for time in period]
 
-        while True:
-            self._scenes += [Scene(scene) for scene in self.search_archive().get('features')]
-            if len(self._scenes) >= self.wsf_offset:
-                self.wsf_offset += 100
-            else:
-                self.wsf_offset = 0
-                break
+        with telemetry.stage('search'):
+            while True:
+                self._scenes += [Scene(scene) for scene in self.search_archive().get('features')]
+                if len(self._scenes) >= self.wsf_offset:
+                    self.wsf_offset += 100
+                else:
+                    self.wsf_offset = 0
+                    break
         self._scenes = list(filter(lambda x: x.polar == 'DV', self._scenes))
 
     def filter(self, inplace, *args, **kwargs):
@@ -112,25 +129,29 @@ class GetSentinel:
     def download(self, tile_name='Tile', part=''):
         self.set_tile_name(tile_name, part)
 
-        for scene in self._scenes:
-            debug = True
-            self.aoi.grid_length = (self.lx, self.ly)
-            nx, ny = self.aoi.grid_size
-            for mode in self.polar_modes:
-                scene.polar = mode
-                if debug:
-                    tiles = [self.download_tiles(scene, grid) for grid in self.aoi.iter()]
-                else:
-                    with concurrent.futures.ThreadPoolExecutor() as pool:
-                        results = pool.map(self.download_tiles, repeat(scene), [grid for grid in iter(self.aoi)])
-                        tiles = [res for res in results]
-
-                blocks = [tiles[i:i + nx] for i in range(0, len(tiles), nx)]
-                array = numpy.block(blocks)
-
-                name = self.scene_name(scene, self.tile_name)
-                self.save_raster(array, name)
-                del tiles, array
+        with telemetry.stage('download'):
+            coverage = False
+            for scene in self._scenes:
+                debug = True
+                self.aoi.grid_length = (self.lx, self.ly)
+                nx, ny = self.aoi.grid_size
+                for mode in self.polar_modes:
+                    scene.polar = mode
+                    if debug:
+                        tiles = [self.download_tiles(scene, grid) for grid in self.aoi.iter()]
+                    else:
+                        with concurrent.futures.ThreadPoolExecutor() as pool:
+                            results = pool.map(self.download_tiles, repeat(scene), [grid for grid in iter(self.aoi)])
+                            tiles = [res for res in results]
+
+                    blocks = [tiles[i:i + nx] for i in range(0, len(tiles), nx)]
+                    array = numpy.block(blocks)
+
+                    if not coverage:
+                        coverage = self.save_coverage(array.shape)
+                    name = self.scene_name(scene, self.tile_name)
+                    self.save_raster(array, name)
+                    del tiles, array
 
     @staticmethod
     def scene_name(scene, tile_name):
@@ -150,7 +171,7 @@ class GetSentinel:
                 transform = Affine(a=self.resolution, b=0, c=x0, d=0, e=-self.resolution, f=ye)
                 mask = rasterize([(diff, True)], out_shape=(y, x), transform=transform, fill=False,
                                  all_touched=True)
-                array = numpy.where(mask, self.nodata, array)
+                array = numpy.where(mask, self.scene_format[1], array)
         else:
             array = None
 
@@ -161,7 +182,8 @@ class GetSentinel:
 
     def nodata_tile(self, shape):
         x, y = shape
-        return numpy.ones(shape=(y, x)).astype('float32')*self.nodata
+        dtype, nodata = self.scene_format
+        return numpy.full((y, x), nodata, dtype=dtype)
 
     def request(self, scene, bbox, shape):
         x, y = shape
@@ -176,6 +198,8 @@ class GetSentinel:
                     function evaluatePixel(samples) {
                       return [samples.POLAR]
                     }'''.replace('POLAR', scene.polar)
+        if self.config.get('quantized', False):
+            evalscript = quantized_evalscript(scene.polar)
 
         request = SentinelHubRequest(
             evalscript=evalscript,
@@ -203,11 +227,12 @@ class GetSentinel:
             ],
             bbox=BBox(bbox, self.aoi.crs.to_epsg()),
             size=(x, y),
-            config=SHConfig()
+            config=self.SHConfig
         )
 
         array = request.get_data(max_threads=min(32, os.cpu_count() + 4))[0]
         if array is not None:
+            telemetry.count('download_bytes', array.nbytes)
             return array
         else:
             return None
@@ -217,7 +242,8 @@ class GetSentinel:
         :return: list o scenes properties for given input parameters
         :rtype: list
         """
-        main_url = '{}/{}?'.format('https://services.sentinel-hub.com/ogc/wfs', self.SHConfig.instance_id)
+        # service of the SHConfig (sh_base_url), i.e. a local stand-in (see georice.standin)
+        main_url = '{}/ogc/wfs/{}?'.format(self.SHConfig.sh_base_url.rstrip('/'), self.SHConfig.instance_id)
         params = {
             'REQUEST': 'GetFeature',
             'TYPENAMES': 'DSS3',
@@ -232,13 +258,15 @@ class GetSentinel:
         }
         url = main_url + urlencode(params)
         response = get(url)
+        telemetry.count('requests')
+        telemetry.count('download_bytes', len(response.content))
         if response.status_code == 200:
             return response.json()
         else:
             raise Exception(f'Connection to Sentinel Hub WSF failed. Reason: {response.status_code}')
 
-    def save_raster(self, array, name):
-        height, width = array.shape
+    def grid_profile(self, height, width):
+        """Raster profile (driver, size, crs, transform) of the scene grid of the AOI"""
         if self.aoi.crs.to_epsg() == self.epsg:
             x, y = self.aoi.upper_left
             transform = Affine(a=self.resolution, b=0, c=x, d=0, e=-self.resolution, f=y)
@@ -251,21 +279,81 @@ class GetSentinel:
             transform, width, height = calculate_default_transform(src, dst, width, height, left=left, bottom=bottom,
                                                                    right=right, top=top, dst_width=width,
                                                                    dst_height=height)
-        profile = {'driver': 'GTiff',
-                    'dtype': 'float32',
-                   'nodata': self.nodata,
-                   'width': width,
-                   'height': height,
-                   'count': 1,
-                   'crs': f'http://www.opengis.net/def/crs/EPSG/0/{self.epsg}',
-                   'transform': transform}
+        return {'driver': 'GTiff',
+                'width': width,
+                'height': height,
+                'count': 1,
+                'crs': f'http://www.opengis.net/def/crs/EPSG/0/{self.epsg}',
+                'transform': transform}
+
+    def save_coverage(self, shape):
+        """
+        Save the AOI coverage mask of the scene grid (1 inside the AOI geometry) as coverage/<tile name>.tif, the rice
+        map processing neither reads nor processes the blocks and rows outside the AOI (see georice.engine.ricemap)
+        """
+        height, width = shape
+        x, y = self.aoi.upper_left
+        transform = Affine(a=self.resolution, b=0, c=x, d=0, e=-self.resolution, f=y)
+        mask = rasterize([(self.aoi.geometry, 1)], out_shape=(height, width), transform=transform, fill=0,
+                         all_touched=True, dtype='uint8')
+        path = os.path.join(self.config.get("output"), self.fld_name, 'coverage')
+        os.makedirs(path, exist_ok=True)
+        codec = rasterio_options(self.config.get('codec') or 'lzw', 'uint8', nbits=1)
+        with raster_open(os.path.join(path, self.tile_name + '.tif'), "w", **self.grid_profile(height, width),
+                         dtype='uint8', nbits=1, **codec) as dest:
+            dest.write(mask, 1)
+        return True
+
+    def save_raster(self, array, name):
+        height, width = array.shape
+        dtype, nodata = self.scene_format
+        profile = dict(self.grid_profile(height, width), dtype=dtype, nodata=nodata)
 
         path = os.path.join(self.config.get("output"), self.fld_name, 'scenes')
         if not os.path.exists(path):
             os.makedirs(path, exist_ok=True)
 
-        with raster_open(os.path.join(path, name), "w", **profile, compress='lzw') as dest:
-            dest.write(array, 1)
+        # codec profile shared with the rice map products (config key codec, i.e. 'zstd:9' or 'lerc:0.0001')
+        codec = rasterio_options(self.config.get('codec') or 'lzw', profile['dtype'])
+        if not self.config.get('cog', False):
+            with raster_open(os.path.join(path, name), "w", **profile, **codec) as dest:
+                dest.write(array, 1)
+                self.describe(dest)
+        else:
+            self.save_cog(array, os.path.join(path, name), profile, codec)
+        # scene catalog of the folder (see georice.catalog), queried by the rice map scene selection
+        with Catalog.open(path) as catalog:
+            catalog.add(name, (height, width))
+
+    @staticmethod
+    def describe(dest):
+        """Band scale / offset (dB) of quantized scenes, for the tools reading them"""
+        if dest.dtypes[0] == QUANTIZED_DTYPE:
+            dest.scales = (1 / QUANTIZED_DB_SCALE,)
+            dest.offsets = (QUANTIZED_DB_MIN - 1 / QUANTIZED_DB_SCALE,)
+            dest.units = ('dB',)
+
+    def save_cog(self, array, file, profile, codec, block_size=512):
+        """
+        Save the scene as tiled GeoTIFF with internal overviews (average resampling, computed with all CPUs). With the
+        config key cog_ghost_area (default) it is rewritten as cloud optimized GeoTIFF: headers and overviews before
+        the full resolution tiles
+        """
+        options = dict(codec, tiled=True, blockxsize=block_size, blockysize=block_size)
+        levels = []
+        while max(array.shape) > block_size * (levels[-1] if levels else 1):
+            levels.append(2 * levels[-1] if levels else 2)
+        ghost_area = self.config.get('cog_ghost_area', True)
+        tmp_file = os.path.join(os.path.dirname(file), 'tmp_' + os.path.basename(file)) if ghost_area else file
+        with Env(GDAL_NUM_THREADS='ALL_CPUS'):
+            with raster_open(tmp_file, "w", **profile, **options) as dest:
+                dest.write(array, 1)
+                self.describe(dest)
+                if levels:
+                    dest.build_overviews(levels, Resampling.average)
+        if ghost_area:
+            raster_copy(tmp_file, file, driver='GTiff', copy_src_overviews=True, **options)
+            os.remove(tmp_file)
 
 
 class Geometry:
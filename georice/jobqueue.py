@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import pickle
+import socket
+import sqlite3
+import traceback
+from functools import partial
+from threading import Thread, Event
+from .utils import load_config, mosaic_parts, Dir
+
+
+class JobQueue:
+    """
+    Job queue shared by the worker processes of one or several nodes: a SQLite file (queue.sqlite) in a folder of a
+    shared storage with working POSIX locks (local disk, NFSv4, ...), the nodes having synchronized clocks.
+
+    A job is a pickled payload of a batch, its status goes pending => leased => done / failed. A worker leases the
+    oldest pending job for lease seconds and renews the lease while it runs it (see work); a lease that is not renewed
+    in time (worker crashed, node lost) expires, the job is pending again for another worker, up to MAX_ATTEMPTS
+    leases before it fails. A job of kind 'merge' is only leased once the other jobs of its batch are done (it fails
+    if one of them failed), their results are given to it.
+    """
+
+    FILE = 'queue.sqlite'
+    VERSION = 1
+    LEASE = 120.
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        # transactions are explicit and take the database write lock first (BEGIN IMMEDIATE), a deferred one would
+        # fail at once instead of waiting when another worker writes
+        self.connection = sqlite3.connect(os.path.join(folder, self.FILE), timeout=60, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        with self.transaction():
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                    'batch TEXT, name TEXT, kind TEXT, payload BLOB, status TEXT, worker TEXT, '
+                                    'lease_expiry REAL, attempts INTEGER, result TEXT, error TEXT, submitted REAL, '
+                                    'started REAL, finished REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS pending ON jobs (status, batch)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (self.VERSION,))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def transaction(self):
+        return _Transaction(self.connection)
+
+    def submit(self, batch, jobs, merge=None):
+        """Add the (name, kind, payload) jobs of a batch, and its merge job payload if any. Returns the job ids"""
+        jobs = list(jobs) + ([(batch, 'merge', merge)] if merge is not None else [])
+        now = time.time()
+        with self.transaction():
+            return [self.connection.execute('INSERT INTO jobs (batch, name, kind, payload, status, attempts, '
+                                            'submitted) VALUES (?, ?, ?, ?, ?, 0, ?)',
+                                            (batch, name, kind, pickle.dumps(payload), 'pending', now)).lastrowid
+                    for name, kind, payload in jobs]
+
+    def lease(self, worker, lease=LEASE):
+        """
+        Lease the next job to worker for lease seconds, None if no job can be leased now. The job is a dict: the job
+        row (payload unpickled), and for a merge job results, the (name, result) of the other jobs of the batch
+        """
+        now = time.time()
+        with self.transaction():
+            self._expire(now)
+            row = self.connection.execute(
+                "SELECT * FROM jobs AS j WHERE status = 'pending' AND (kind != 'merge' OR NOT EXISTS (SELECT 1 FROM "
+                "jobs AS p WHERE p.batch = j.batch AND p.kind != 'merge' AND p.status != 'done')) ORDER BY id "
+                "LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE jobs SET status = 'leased', worker = ?, lease_expiry = ?, attempts = "
+                                    "attempts + 1, started = ?, error = NULL WHERE id = ?",
+                                    (worker, now + lease, now, row['id']))
+            job = dict(row, worker=worker, attempts=row['attempts'] + 1, payload=pickle.loads(row['payload']))
+            if job['kind'] == 'merge':
+                job['results'] = [(r['name'], json.loads(r['result'])) for r in self.connection.execute(
+                    "SELECT name, result FROM jobs WHERE batch = ? AND kind != 'merge' ORDER BY id", (job['batch'],))]
+        return job
+
+    def _expire(self, now):
+        # leases not renewed in time: the job is pending again, or failed after MAX_ATTEMPTS leases
+        self.connection.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                                "finished = CASE WHEN attempts >= ? THEN ? END, error = 'lease of ' || worker || "
+                                "' expired', worker = NULL WHERE status = 'leased' AND lease_expiry < ?",
+                                (self.MAX_ATTEMPTS, self.MAX_ATTEMPTS, now, now))
+        # merge jobs of batches having a failed job
+        self.connection.execute("UPDATE jobs SET status = 'failed', error = 'job(s) of the batch failed', finished = "
+                                "? WHERE kind = 'merge' AND status = 'pending' AND EXISTS (SELECT 1 FROM jobs AS p "
+                                "WHERE p.batch = jobs.batch AND p.kind != 'merge' AND p.status = 'failed')", (now,))
+
+    def _update(self, job, sql, parameters):
+        # only while the lease of the job is the worker one (not expired and leased again)
+        with self.transaction():
+            return self.connection.execute(sql + " WHERE id = ? AND worker = ? AND attempts = ? AND status = "
+                                           "'leased'", parameters + (job['id'], job['worker'],
+                                                                     job['attempts'])).rowcount == 1
+
+    def renew(self, job, lease=LEASE):
+        """Extend the lease of a job, False if the lease was lost"""
+        return self._update(job, 'UPDATE jobs SET lease_expiry = ?', (time.time() + lease,))
+
+    def complete(self, job, result=None):
+        """Job done, with its result (JSON value). False if the lease was lost (the result is dropped)"""
+        return self._update(job, "UPDATE jobs SET status = 'done', result = ?, finished = ?",
+                            (json.dumps(result), time.time()))
+
+    def fail(self, job, error):
+        """Job failed with error (string). False if the lease was lost"""
+        return self._update(job, "UPDATE jobs SET status = 'failed', error = ?, finished = ?", (error, time.time()))
+
+    def jobs(self, batch=None):
+        """Rows of the jobs (without payload) of a batch, or of all batches"""
+        sql = 'SELECT id, batch, name, kind, status, worker, attempts, result, error, submitted, started, finished ' \
+              'FROM jobs'
+        with self.transaction():
+            self._expire(time.time())
+        if batch is None:
+            return [dict(r) for r in self.connection.execute(sql + ' ORDER BY id')]
+        return [dict(r) for r in self.connection.execute(sql + ' WHERE batch = ? ORDER BY id', (batch,))]
+
+    def finished(self, batch=None):
+        """True when no job (of the batch) is pending or leased"""
+        return all(job['status'] in ['done', 'failed'] for job in self.jobs(batch))
+
+    def wait(self, batch=None, polling_delay=5.):
+        """Wait until the jobs (of the batch) are finished, returns their rows"""
+        while not self.finished(batch):
+            time.sleep(polling_delay)
+        return self.jobs(batch)
+
+
+class _Transaction:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, kind, value, trace):
+        self.connection.execute('COMMIT' if kind is None else 'ROLLBACK')
+
+
+class _Heartbeat(Thread):
+    """Renews the lease of a job every lease / 4 seconds (own connection), lost is set if the lease was lost"""
+
+    def __init__(self, folder, job, lease):
+        Thread.__init__(self, daemon=True)
+        self.folder, self.job, self.lease = folder, job, lease
+        self.event = Event()
+        self.lost = False
+
+    def run(self):
+        with JobQueue(self.folder) as queue:
+            while not self.event.wait(self.lease / 4):
+                if not queue.renew(self.job, self.lease):
+                    self.lost = True
+                    print(f'- job {self.job["name"]}: lease lost')
+                    break
+
+    def stop(self):
+        self.event.set()
+        self.join()
+
+
+def worker_name():
+    """Name of this worker process: host:pid"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def work(folder=None, worker=None, lease=JobQueue.LEASE, polling_delay=5., handlers=None, sh_config=None):
+    """
+    Worker loop: lease the jobs of the queue of folder (default the configured output folder) and run them until no
+    job is pending or leased (a job leased by a crashed worker is pending again once its lease expired).
+    handlers - kind => function(job) returning the JSON result of a job, on top of the rice map ones (see
+               submit_ricemap), an exception fails the job
+    sh_config - Sentinel Hub configuration of the downloads, default the saved one
+    Returns the number of jobs done and failed by this worker.
+    """
+    folder = load_config()['output'] if folder is None else folder
+    worker = worker_name() if worker is None else worker
+    handlers = dict({'part': partial(process_part, sh_config=sh_config), 'merge': merge_parts}, **(handlers or {}))
+    done, failed = 0, 0
+    with JobQueue(folder) as queue:
+        while True:
+            job = queue.lease(worker, lease)
+            if job is None:
+                if queue.finished():
+                    break
+                time.sleep(polling_delay)
+                continue
+            print(f'- job {job["name"]} ({job["kind"]}, lease {job["attempts"]}): started by {worker}')
+            heartbeat = _Heartbeat(folder, job, lease)
+            heartbeat.start()
+            try:
+                result = handlers[job['kind']](job)
+            except Exception as exception:
+                traceback.print_exc()
+                heartbeat.stop()
+                queue.fail(job, repr(exception))
+                failed += 1
+                print(f'- job {job["name"]}: failed ({exception!r})')
+            else:
+                heartbeat.stop()
+                if queue.complete(job, result):
+                    done += 1
+                    print(f'- job {job["name"]}: done')
+    return done, failed
+
+
+def run_workers(workers, folder=None, **options):
+    """Run local worker processes (see work, options are its parameters) until the queue is finished"""
+    from .engine import pool_context
+
+    context = pool_context()
+    processes = [context.Process(target=work, args=(folder,), kwargs=options) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [process.exitcode for process in processes]
+
+
+def process_part(job, sh_config=None):
+    """
+    Rice map job of an AOI part (see submit_ricemap): download of its scenes, speckle filtering and rice map in the
+    tile folder of the part, the scenes are deleted afterwards. Returns the written products.
+    """
+    from .imagery import GetSentinel
+    from .filtering import Filtering
+    from .ricemap import Ricemap
+
+    payload = job['payload']
+    tile, options = payload['tile'], payload['options']
+    imagery = GetSentinel()
+    if sh_config is not None:
+        imagery.SHConfig = sh_config
+    imagery._scenes, imagery.epsg, imagery.period = payload['scenes'], payload['epsg'], payload['period_dates']
+    imagery.aoi = payload['aoi']
+    imagery.download(tile_name=tile)
+    folder = 'scenes'
+    if payload['filtering']:
+        Filtering().process(tile, payload['orbit_path'])
+        folder = f'scenes{os.sep}filtered'
+    result = Ricemap().ricemap_get(tile, payload['orbit_number'], payload['period'], payload['orbit_path'],
+                                   folder=folder, **options)
+    Dir(os.path.join(imagery.config['output'], tile, 'scenes')).delete()
+    return {'files': result['files']}
+
+
+def merge_parts(job):
+    """
+    Merge job of the AOI parts of a rice map (see submit_ricemap): each product of the parts is mosaicked into the
+    tile ricemaps folder (the part products are removed). Returns the written products.
+    """
+    payload = job['payload']
+    tiles = [tile for tile, _ in job['results']]
+    paths = [path for _, result in job['results'] for path in result['files']]
+    return {'files': mosaic_parts(paths, tiles, payload['name'],
+                                  os.path.join(payload['output'], payload['name'], 'ricemaps'))}
+
+
+def submit_ricemap(imagery, name, period, orbit_path=None, orbit_number=None, filtering=True, folder=None,
+                   **options):
+    """
+    Submit the rice map of the AOI of imagery (GetSentinel with its found scenes filtered) to the queue of folder
+    (default the configured output folder): one job per AOI part (as Georice.get_ricemap splits it, the whole AOI if
+    smaller than the config max_area), processed in the tile folder of the part, and if split, a merge job of the part
+    products into the tile ricemaps folder. options are Ricemap.ricemap_get parameters. Returns the batch name.
+    """
+    from .imagery import Geometry
+
+    config = load_config()
+    folder = config['output'] if folder is None else folder
+    common = {'scenes': imagery._scenes, 'epsg': imagery.epsg, 'period_dates': imagery.period, 'period': period,
+              'orbit_path': orbit_path, 'orbit_number': orbit_number, 'filtering': filtering, 'options': options}
+    if imagery.aoi.geometry.area >= config.get('max_area'):
+        geom = Geometry(imagery.aoi.geometry, imagery.aoi.crs, grid_leght=(10000, 10000))
+        parts = [(f'part{id}-{name}', Geometry(sub_aoi[0], imagery.aoi.crs)) for id, sub_aoi in enumerate(iter(geom))]
+    else:
+        parts = [(name, imagery.aoi)]
+    batch = f'{name}_{time.strftime("%Y%m%dT%H%M%S")}'
+    jobs = [(tile, 'part', dict(common, tile=tile, aoi=aoi)) for tile, aoi in parts]
+    merge = {'name': name, 'output': config['output']} if len(parts) > 1 else None
+    with JobQueue(folder) as queue:
+        queue.submit(batch, jobs, merge)
+    print(f'Batch {batch}: {len(parts)} part job(s){" and a merge job" if merge else ""} submitted to {folder}')
+    return batch
@@ -1,5 +1,5 @@
-import subprocess
 from .utils import load_config
+from . import engine, batch
 import os
 
 
@@ -8,25 +8,65 @@ class Ricemap:
     def __init__(self):
         config = load_config()
         self.output = config['output']
+        self.codec = config.get('codec')
 
     def ricemap_get(self, tile_name, orbit_number, period, direct, inter=False, lzw=False, mask=False, nr=False,
-                    part='', folder='scenes'):
+                    part='', folder='scenes', max_memory=None, datacube=False,
+                    update=False, sweep=None, multiband_masks=False, cog=False, codec=None, telemetry_path=None,
+                    profile=False, coverage=None, windows=None):
         """
-        Set ricemap commands.
+        Generate the rice map of the tile scenes.
         NOTE: starting_date / ending_date => YYYYMMDD, inclusive
+        max_memory - memory budget, bytes or string with K/M/G/T suffix i.e. '8G'
+        datacube - read the time series from the tile datacube (output/tile/datacube), missing dates are appended
+        update - incremental update, only the dates added since the last run of the same period start are read
+        sweep - threshold sweep, rice,trees,water triples (dB) separated by ';' with optional start:stop:step ranges
+                i.e. '4:6:0.5,-18,-18' => one rice map per triple and a class area summary
+        multiband_masks - with mask, write the 5 class masks as one 5 bands product (masks_...tif)
+        cog - write cloud optimized geotiffs with internal overviews
+        codec - codec profile of the products, 'name' or 'name:parameter' i.e. 'zstd:9' or 'lerc:0.001' (see
+                georice.codecs), default the config key codec, else DEFLATE (LZW with lzw)
+        telemetry_path - folder of the per stage performance telemetry (telemetry.jsonl and Prometheus textfile)
+        profile - with telemetry_path, cProfile each stage
+        coverage - AOI coverage mask of the scene grid, default the one saved by the download (output/tile/coverage),
+                   False to process the whole grid
+        windows - seasonal mode, (starting_date, ending_date) windows instead of period, or string i.e.
+                  '20200101:20200630,20200701:20201231' => the dates of all windows are read once, one product set per
+                  window
+        Returns the engine result (see georice.engine.ricemap)
         """
         scene_path = os.path.join(self.output, tile_name, folder)
         output_path = os.path.join(self.output, tile_name)
-        command = ['ricemap.py', scene_path, orbit_number, period[0], period[1], output_path]
-        if direct:
-            command.append('-d ' + direct)
-        if inter:
-            command.append('-i')
+        direct = direct.upper() if direct else 'DES'
+        if windows:
+            windows = engine.parse_windows(windows) if isinstance(windows, str) else windows
+            period = min(start for start, _ in windows), max(end for _, end in windows)
+        scenes = engine.select_scenes(scene_path, orbit_number, direct, period[0], period[1])
+        return engine.ricemap(scenes, period[0], period[1], output_path, intermediate=inter,
+                              compressor=self._codec(codec, lzw), masks=mask, dst_srs=None if nr else 'EPSG:4326',
+                              max_memory=max_memory, datacube=datacube, update=update, sweep=sweep,
+                              multiband_masks=multiband_masks, cog=cog, telemetry_path=telemetry_path,
+                              profile=profile, coverage=coverage, windows=windows)
+
+    def ricemap_all(self, tile_name, folder='scenes', max_jobs=None, cpus=None, max_memory=None, inter=False,
+                    lzw=False, mask=False, nr=False):
+        """
+        Generate the rice maps of all orbit direction / orbit number combinations found in the tile scenes, over the
+        whole period found. Combinations are run concurrently under a global budget:
+        max_jobs - maximum number of concurrent jobs
+        cpus - number of processing units shared by the running jobs, default all
+        max_memory - memory shared by the running jobs, bytes or string with K/M/G/T suffix i.e. '32G', default the
+                     available memory
+        Job logs are written in output/tile/logs. Returns the summary of each job (see batch.run_jobs)
+        """
+        scene_path = os.path.join(self.output, tile_name, folder)
+        output_path = os.path.join(self.output, tile_name)
+        jobs = batch.plan_jobs(scene_path, output_path)
+        return batch.run_jobs(jobs, max_jobs, cpus, max_memory, intermediate=inter,
+                              compressor=self._codec(None, lzw), masks=mask,
+                              dst_srs=None if nr else 'EPSG:4326')
+
+    def _codec(self, codec, lzw):
         if lzw:
-            command.append('-lzw')
-        if mask:
-            command.append('-m')
-        if nr:
-            command.append('-nr')
-        command.append(part)
-        subprocess.run(' '.join(command), shell=True)
+            return 'lzw'
+        return codec or self.codec or 'deflate'
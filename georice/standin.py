@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import zlib
+import numpy as np
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from urllib.parse import urlparse, parse_qs
+from pyproj import CRS, Transformer
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+from .codecs import quantize
+
+
+# backscatter (dB, VH) of the synthetic classes at the start and at the end of the season, VV is VV_OFFSET_DB above
+CLASSES_DB = [(-22., -13.), (-11., -11.), (-24., -24.), (-19., -17.)]
+VV_OFFSET_DB = 6.
+# side of the square class patches (meters)
+PATCH_SIZE = 640.
+# Sentinel-1A absolute orbit of relative orbit 1, orbits per 12 days repeat cycle
+ORBIT_0 = 73
+ORBITS_PER_CYCLE = 175
+
+
+class StandIn:
+    """
+    Local stand-in of the Sentinel Hub services used by GetSentinel, for repeatable measures of the download path:
+    - WFS (GET /ogc/wfs/<instance_id>): feature pages (FEATURE_OFFSET, MAXFEATURES) of synthetic Sentinel-1A DV
+      scenes every revisit days within TIME, of the relative orbit and direction, whose footprint covers BBOX
+    - OAuth (POST /oauth/token): client credentials token
+    - Process API (POST /api/v1/process): float32 GeoTIFF of the requested bbox / size, synthetic backscatter of the
+      requested polarisation (class patches, season, speckle), seeded by the request so tiles are repeatable; uint16
+      codes (see georice.codecs) for a UINT16 evalscript
+    Network conditions: latency (+ uniform jitter) before each answer, bandwidth (bytes / s, None = unlimited) of the
+    response body, throttle_rate of the Process API requests answered 429 (Retry-After retry_after ms) and
+    failure_rate answered 503, the WFS gets them too with wfs_errors (GetSentinel.search_archive does not retry).
+    Counters of the answers: requests, throttled, failed, bytes. The server is plain HTTP on localhost, configure
+    points an SHConfig to it.
+    """
+
+    def __init__(self, orbit=18, direction='DESCENDING', revisit=12, latency=0.05, jitter=0., bandwidth=None,
+                 throttle_rate=0., retry_after=1000, failure_rate=0., wfs_errors=False, seed=0, port=0):
+        self.orbit, self.direction, self.revisit = int(orbit), direction, revisit
+        self.latency, self.jitter, self.bandwidth = latency, jitter, bandwidth
+        self.throttle_rate, self.retry_after, self.failure_rate = throttle_rate, retry_after, failure_rate
+        self.wfs_errors = wfs_errors
+        self.rng = np.random.default_rng(seed)
+        self.seed = seed
+        self.lock = Lock()
+        self.counters = dict.fromkeys(['requests', 'throttled', 'failed', 'bytes'], 0)
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server.server_address)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def configure(self, config):
+        """Point an SHConfig to the stand-in (service and token urls, placeholder credentials where none are set)"""
+        config.sh_base_url = self.url
+        config.sh_token_url = self.url + '/oauth/token'
+        for credential in ['sh_client_id', 'sh_client_secret', 'instance_id']:
+            if getattr(config, credential) in ['', None]:
+                setattr(config, credential, 'standin')
+        # the token is fetched over plain http
+        os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+        return config
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def draw(self, errors):
+        """status of the next answer: 429, 503 or 200"""
+        with self.lock:
+            wait = self.latency + self.jitter * self.rng.random()
+            draw = self.rng.random() if errors else 1.
+        time.sleep(wait)
+        if draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.failure_rate:
+            return 503
+        return 200
+
+    def features(self, bbox, srs, period):
+        """WFS features of the scenes acquired in period (start, end datetimes) covering bbox (srs coordinates)"""
+        x0, y0, x1, y1 = bbox
+        margin = max(x1 - x0, y1 - y0)
+        footprint = [[x0 - margin, y0 - margin], [x1 + margin, y0 - margin], [x1 + margin, y1 + margin],
+                     [x0 - margin, y1 + margin], [x0 - margin, y0 - margin]]
+        start, end = period
+        features = []
+        day = datetime(start.year, start.month, start.day, 22, 59, 35)
+        cycle = 0
+        while day <= end:
+            if day >= start:
+                absolute = ORBIT_0 - 1 + self.orbit + ORBITS_PER_CYCLE * (170 + cycle)
+                name = '_'.join(['S1A', 'IW', 'GRDH', '1SDV', day.strftime('%Y%m%dT%H%M%S'),
+                                 (day + timedelta(seconds=25)).strftime('%Y%m%dT%H%M%S'), f'{absolute:06d}',
+                                 f'{absolute * 7 % 0xFFFFFF:06X}', f'{cycle % 0xFFFF:04X}'])
+                features.append({'type': 'Feature',
+                                 'geometry': {'type': 'Polygon', 'coordinates': [footprint],
+                                              'crs': {'type': 'name', 'properties': {'name': srs}}},
+                                 'properties': {'id': name, 'date': day.strftime('%Y-%m-%d'),
+                                                'time': day.strftime('%H:%M:%S'),
+                                                'orbitDirection': self.direction, 'polarization': 'DV',
+                                                'crs': srs}})
+            day += timedelta(days=self.revisit)
+            cycle += 1
+        return features
+
+    def tile(self, bbox, crs, shape, time_range, polar, quantized=False):
+        """
+        float32 GeoTIFF (bytes) of the synthetic backscatter on the bbox grid (shape: width, height), uint16 codes if
+        quantized
+        """
+        width, height = shape
+        x0, y0, x1, y1 = bbox
+        x = x0 + (np.arange(width) + 0.5) * (x1 - x0) / width
+        y = y1 - (np.arange(height) + 0.5) * (y1 - y0) / height
+        xx, yy = np.meshgrid(x, y)
+        if CRS.from_user_input(crs).is_geographic:
+            xx, yy = Transformer.from_crs(crs, 3857, always_xy=True).transform(xx, yy)
+        # class of each patch, a hash of the patch indices stable across tiles
+        cx, cy = np.floor(xx / PATCH_SIZE).astype(np.int64), np.floor(yy / PATCH_SIZE).astype(np.int64)
+        classes = ((cx * 73856093) ^ (cy * 19349663)) % len(CLASSES_DB)
+        date = datetime.strptime(time_range[:10], '%Y-%m-%d')
+        season = max(0., 2. * (date.timetuple().tm_yday - 1) / 365. - 1.)
+        start = np.array([db[0] for db in CLASSES_DB])[classes]
+        stop = np.array([db[1] for db in CLASSES_DB])[classes]
+        db = start + (stop - start) * season + (VV_OFFSET_DB if polar == 'VV' else 0.)
+        seed = zlib.crc32(json.dumps([bbox, time_range, polar, self.seed]).encode())
+        data = (10 ** (db / 10) * np.random.default_rng(seed).gamma(50., 1 / 50., db.shape)).astype(np.float32)
+        if quantized:
+            data = quantize(data)
+        with MemoryFile() as memory:
+            with memory.open(driver='GTiff', width=width, height=height, count=1, dtype=data.dtype.name, crs=crs,
+                             transform=from_bounds(x0, y0, x1, y1, width, height)) as dataset:
+                dataset.write(data, 1)
+            return memory.read()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self, status, body=b'', content_type='application/json', headers=None):
+        standin = self.server.standin
+        standin.count('requests')
+        if status == 429:
+            standin.count('throttled')
+            headers = dict(headers or {}, **{'Retry-After': str(standin.retry_after)})
+            body = b'{"status": 429, "reason": "Too Many Requests"}'
+        elif status >= 500:
+            standin.count('failed')
+            body = b'{"status": 503, "reason": "Service Unavailable"}'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if standin.bandwidth:
+            time.sleep(len(body) / standin.bandwidth)
+        self.wfile.write(body)
+        standin.count('bytes', len(body))
+
+    def do_GET(self):
+        standin = self.server.standin
+        url = urlparse(self.path)
+        if not url.path.startswith('/ogc/wfs'):
+            return self.answer(404, b'{}')
+        status = standin.draw(standin.wfs_errors)
+        if status != 200:
+            return self.answer(status)
+        query = {key.upper(): values[0] for key, values in parse_qs(url.query).items()}
+        bbox = [float(v) for v in query['BBOX'].split(',')]
+        period = [datetime.fromisoformat(t) for t in query['TIME'].split('/')]
+        features = standin.features(bbox, query.get('SRSNAME', 'EPSG:4326'), period)
+        offset, count = int(query.get('FEATURE_OFFSET', 0)), int(query.get('MAXFEATURES', 100))
+        page = {'type': 'FeatureCollection', 'features': features[offset:offset + count]}
+        self.answer(200, json.dumps(page).encode())
+
+    def do_POST(self):
+        standin = self.server.standin
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/oauth/token'):
+            token = {'access_token': 'standin', 'token_type': 'Bearer', 'expires_in': 3600,
+                     'expires_at': time.time() + 3600}
+            return self.answer(200, json.dumps(token).encode())
+        if not self.path.startswith('/api/v1/process'):
+            return self.answer(404, b'{}')
+        status = standin.draw(True)
+        if status != 200:
+            return self.answer(status)
+        request = json.loads(body)
+        bounds = request['input']['bounds']
+        output = request['output']
+        polar = 'VV' if 'samples.VV' in request['evalscript'] else 'VH'
+        time_range = request['input']['data'][0]['dataFilter']['timeRange']['from']
+        data = standin.tile(bounds['bbox'], bounds['properties']['crs'], (output['width'], output['height']),
+                            time_range, polar, 'SampleType.UINT16' in request['evalscript'])
+        self.answer(200, data, 'image/tiff')
+
+
+if __name__ == '__main__':
+    with StandIn(port=int(os.environ.get('STANDIN_PORT', 8000))) as standin:
+        print(f'Sentinel Hub stand-in at {standin.url}, point SHConfig sh_base_url to it and sh_token_url to '
+              f'{standin.url}/oauth/token')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
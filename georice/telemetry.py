@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import cProfile
+import logging
+import psutil
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Thread, Event, Lock
+
+
+STAGES = ['search', 'download', 'filtering', 'statistics', 'morphology', 'write']
+# counters of each stage record, besides the measured ones
+COUNTERS = ['requests', 'retries', 'download_bytes']
+METRICS = [('wall_seconds', 'wall_s', 'Wall time of the stage'),
+           ('cpu_seconds', 'cpu_s', 'CPU time of the stage (process and child processes)'),
+           ('peak_rss_bytes', 'peak_rss', 'Peak resident memory during the stage (process and child processes)'),
+           ('peak_pss_bytes', 'peak_pss', 'Peak proportional memory during the stage (process and child processes)'),
+           ('read_bytes', 'read_bytes', 'Bytes read during the stage'),
+           ('written_bytes', 'written_bytes', 'Bytes written during the stage'),
+           ('requests', 'requests', 'HTTP requests sent during the stage'),
+           ('retries', 'retries', 'HTTP requests sent again (rate limit, temporary errors) during the stage'),
+           ('download_bytes', 'download_bytes', 'Bytes downloaded during the stage')]
+
+ACTIVE = None
+
+
+def _usage(process):
+    """cpu seconds, bytes read, bytes written of the process and its child processes"""
+    cpu, read, written = 0., 0, 0
+    processes = [process]
+    try:
+        processes += process.children(recursive=True)
+    except psutil.Error:
+        pass
+    for proc in processes:
+        try:
+            times = proc.cpu_times()
+            cpu += times.user + times.system + times.children_user + times.children_system
+            io = proc.io_counters()
+            read += getattr(io, 'read_chars', io.read_bytes)
+            written += getattr(io, 'write_chars', io.write_bytes)
+        except (psutil.Error, AttributeError, NotImplementedError):
+            continue
+    return cpu, read, written
+
+
+def _memory(process, pss=True):
+    """resident and proportional (None if not available) memory of the process and its child processes"""
+    rss, proportional = 0, 0 if pss else None
+    processes = [process]
+    try:
+        processes += process.children(recursive=True)
+    except psutil.Error:
+        pass
+    for proc in processes:
+        try:
+            if proportional is not None:
+                info = proc.memory_full_info()
+                rss += info.rss
+                proportional += getattr(info, 'pss', 0)
+            else:
+                rss += proc.memory_info().rss
+        except (psutil.AccessDenied, AttributeError, NotImplementedError):
+            proportional = None
+        except psutil.Error:
+            continue
+    return rss, proportional
+
+
+class _RequestCounter(logging.Filter):
+    """
+    Counts the HTTP requests of the sentinelhub download client (debug records 'Sending ...' for each attempt,
+    'Successful ...' for each success), the records below the previous logger level are dropped as they would be
+    without the filter
+    """
+    # filters only apply to the records of their own logger
+    LOGGER = 'sentinelhub.download.sentinelhub_client'
+
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+        self.logger = logging.getLogger(self.LOGGER)
+        self.level = self.logger.level
+        self.effective_level = self.logger.getEffectiveLevel()
+
+    def attach(self):
+        self.logger.addFilter(self)
+        self.logger.setLevel(logging.DEBUG)
+
+    def detach(self):
+        self.logger.removeFilter(self)
+        self.logger.setLevel(self.level)
+
+    def filter(self, record):
+        message = str(record.msg)
+        if message.startswith('Sending'):
+            self.session.count('requests')
+            self.session.count('retries')
+        elif message.startswith('Successful'):
+            self.session.count('retries', -1)
+        return record.levelno >= self.effective_level
+
+
+class Session:
+    """
+    Per stage performance records of a run (see session): wall time, CPU time, peak RSS / PSS, bytes read and written
+    (process and child processes), and the counters of COUNTERS. A stage may be entered several times, each time
+    makes a record; stages may be nested, the counters go to the innermost one.
+    """
+
+    def __init__(self, path=None, name='georice', labels=None, profile=False, polling_delay=0.2):
+        self.path = path
+        self.name = name
+        self.run = datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.labels = dict(labels or {})
+        self.profile = profile
+        self.polling_delay = polling_delay
+        self.process = psutil.Process()
+        self.records = []
+        self.open = []
+        self.lock = Lock()
+        self.event = Event()
+        self.pss = _memory(self.process)[1] is not None
+        self.sampler = Thread(target=self._sample, daemon=True)
+        self.requests = _RequestCounter(self)
+
+    def start(self):
+        self.requests.attach()
+        self.sampler.start()
+        return self
+
+    def _sample(self):
+        while not self.event.wait(self.polling_delay):
+            with self.lock:
+                if len(self.open) == 0:
+                    continue
+            rss, pss = _memory(self.process, self.pss)
+            with self.lock:
+                for record in self.open:
+                    record['peak_rss'] = max(record['peak_rss'], rss)
+                    if pss is not None:
+                        record['peak_pss'] = max(record['peak_pss'] or 0, pss)
+
+    def begin(self, stage):
+        rss, pss = _memory(self.process, self.pss)
+        cpu, read, written = _usage(self.process)
+        record = dict({'run': self.run, 'stage': stage, 'start': time.time(), 'wall_s': time.perf_counter(),
+                       'cpu_s': cpu, 'peak_rss': rss, 'peak_pss': pss, 'read_bytes': read, 'written_bytes': written},
+                      **{counter: 0 for counter in COUNTERS})
+        # one profiler at a time, the outermost stage gets it
+        if self.profile and not any('_profiler' in r for r in self.open):
+            record['_profiler'] = cProfile.Profile()
+            record['_profiler'].enable()
+        with self.lock:
+            self.open.append(record)
+        return record
+
+    def end(self, record):
+        with self.lock:
+            if not any(r is record for r in self.open):
+                return
+        profiler = record.pop('_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+        cpu, read, written = _usage(self.process)
+        with self.lock:
+            self.open = [r for r in self.open if r is not record]
+            record['wall_s'] = time.perf_counter() - record['wall_s']
+            record['cpu_s'] = cpu - record['cpu_s']
+            record['read_bytes'] = read - record['read_bytes']
+            record['written_bytes'] = written - record['written_bytes']
+            record.update(self.labels)
+            self.records.append(record)
+        if profiler is not None and self.path is not None:
+            index = sum(r['stage'] == record['stage'] for r in self.records)
+            profiler.dump_stats(os.path.join(self.path, f'{self.name}_{self.run}_{record["stage"]}_{index}.prof'))
+
+    def count(self, counter, value=1):
+        with self.lock:
+            if len(self.open) > 0:
+                self.open[-1][counter] = self.open[-1].get(counter, 0) + value
+
+    def stop(self):
+        self.event.set()
+        self.sampler.join()
+        self.requests.detach()
+        for record in list(reversed(self.open)):
+            self.end(record)
+        if self.path is not None:
+            self.write_jsonl(os.path.join(self.path, 'telemetry.jsonl'))
+            self.write_prometheus(os.path.join(self.path, f'{self.name}.prom'))
+
+    def write_jsonl(self, path):
+        """Append the stage records as JSON lines"""
+        with open(path, 'a') as jsonl:
+            for record in self.records:
+                jsonl.write(json.dumps(record) + '\n')
+
+    def write_prometheus(self, path):
+        """Write the stage totals of the run as Prometheus textfile (node exporter textfile collector)"""
+        lines = []
+        for metric, key, description in METRICS:
+            lines += [f'# HELP georice_stage_{metric} {description}', f'# TYPE georice_stage_{metric} gauge']
+            for stage in dict.fromkeys(record['stage'] for record in self.records):
+                values = [r[key] for r in self.records if r['stage'] == stage and r[key] is not None]
+                if len(values) == 0:
+                    continue
+                value = max(values) if key.startswith('peak') else sum(values)
+                labels = ','.join(f'{k}="{v}"' for k, v in dict(self.labels, name=self.name, stage=stage).items())
+                lines.append(f'georice_stage_{metric}{{{labels}}} {value}')
+        # written next to the target and renamed, so the collector never reads a partial file
+        with open(path + '.tmp', 'w') as prom:
+            prom.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def session(path=None, name='georice', labels=None, profile=False):
+    """
+    Record the stages of the code run within (see Session). With path (folder), the records are appended to
+    path/telemetry.jsonl and the stage totals written to path/<name>.prom; with profile, each stage is profiled
+    (cProfile) into path/<name>_<run>_<stage>_<n>.prof. Within an active session, the active one is used.
+    Returns the session (records attribute).
+    """
+    global ACTIVE
+    if ACTIVE is not None:
+        yield ACTIVE
+        return
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+    ACTIVE = Session(path, name, labels, profile).start()
+    try:
+        yield ACTIVE
+    finally:
+        active, ACTIVE = ACTIVE, None
+        active.stop()
+
+
+@contextmanager
+def stage(name):
+    """Record the code run within as a stage of the active session, nothing without an active session"""
+    active = ACTIVE
+    if active is None:
+        yield
+        return
+    record = active.begin(name)
+    try:
+        yield
+    finally:
+        active.end(record)
+
+
+def begin(name):
+    """Start a stage of the active session (see stage), returns the handle for end"""
+    active = ACTIVE
+    return None if active is None else (active, active.begin(name))
+
+
+def end(handle):
+    """End a stage started with begin"""
+    if handle is not None:
+        handle[0].end(handle[1])
+
+
+def count(counter, value=1):
+    """Add value to a counter of the innermost stage of the active session"""
+    active = ACTIVE
+    if active is not None:
+        active.count(counter, value)
@@ -66,7 +66,9 @@ def save_config(update):
             raise Exception(f'Key "{key}" is not defined ind config file')
         else:
             if key == 'output':
-                os.makedirs(value, exist_ok=True)
+                # 'default' is resolved to the working directory by Georice
+                if value != 'default':
+                    os.makedirs(value, exist_ok=True)
                 config.update({key: value})
             else:
                 config.update({key: value})
@@ -92,8 +94,8 @@ def reset_config():
         json.dump(SETTING, cfg_file)
 
 
-def mosaic(images_paths):
-    output = images_paths[0].replace('part0-', '')
+def mosaic(images_paths, output=None):
+    output = images_paths[0].replace('part0-', '') if output is None else output
     files_to_mosaic = [rio_open(path) for path in images_paths]
     mosaic, out_trans = merge(files_to_mosaic)
     out_profile = files_to_mosaic[0].profile.copy()
@@ -106,6 +108,25 @@ def mosaic(images_paths):
         os.remove(path)
 
 
+def mosaic_parts(images_paths, tiles, name, folder):
+    """
+    Mosaic the products of the AOI parts (tiles: tile names of the parts) into folder, one mosaic per product named with
+    name instead of the part tile name, the part products are removed. Returns the mosaics.
+    """
+    products = {}
+    for path in images_paths:
+        base = os.path.basename(path)
+        for tile in tiles:
+            if base.endswith('.tif') and f'_{tile}_' in base:
+                products.setdefault(base.replace(f'_{tile}_', f'_{name}_', 1), []).append(path)
+    os.makedirs(folder, exist_ok=True)
+    outputs = []
+    for product, paths in sorted(products.items()):
+        outputs.append(os.path.join(folder, product))
+        mosaic(paths, outputs[-1])
+    return outputs
+
+
 class Dir:
     def __init__(self, path):
         self._path = path
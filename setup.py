@@ -24,8 +24,7 @@ setup(
         'pyproj',
         'gdal',
         'psutil',
-        'numba',
-        'scikit-image'],
+        'numba'],
     zip_safe=False,
     include_package_data=True,
     classifiers=[
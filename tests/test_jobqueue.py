@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import signal
+import unittest
+import tempfile
+from georice.jobqueue import JobQueue, run_workers
+
+
+def part(job):
+    # the 1st lease of the 'crash' job kills its worker in the middle of the job
+    if job['payload'] == 'crash' and job['attempts'] == 1:
+        os.kill(os.getpid(), signal.SIGKILL)
+    time.sleep(0.2)
+    return {'part': job['name'], 'attempts': job['attempts']}
+
+
+def merge(job):
+    return {'results': job['results']}
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_lease(self):
+        with JobQueue(self.folder.name) as queue:
+            queue.submit('batch', [('part0', 'part', None)], merge={})
+            job = queue.lease('worker0', lease=0.1)
+            self.assertEqual(job['name'], 'part0')
+            # the merge job waits for the parts
+            self.assertIsNone(queue.lease('worker1', lease=0.1))
+            # expired lease: the job is leased again, the result of the first worker is dropped
+            time.sleep(0.2)
+            again = queue.lease('worker1', lease=10)
+            self.assertEqual((again['id'], again['attempts']), (job['id'], 2))
+            self.assertFalse(queue.renew(job))
+            self.assertFalse(queue.complete(job, 'stale'))
+            self.assertTrue(queue.complete(again, 'done'))
+            self.assertEqual(queue.lease('worker1')['results'], [('part0', 'done')])
+
+    def test_max_attempts(self):
+        with JobQueue(self.folder.name) as queue:
+            queue.submit('batch', [('part0', 'part', None)], merge={})
+            for _ in range(JobQueue.MAX_ATTEMPTS):
+                self.assertIsNotNone(queue.lease('worker', lease=0.01))
+                time.sleep(0.05)
+            self.assertIsNone(queue.lease('worker'))
+            self.assertEqual([job['status'] for job in queue.jobs('batch')], ['failed', 'failed'])
+            self.assertTrue(queue.finished())
+
+    def test_worker_crash(self):
+        parts = [('part%d' % i, 'part', 'crash' if i == 1 else None) for i in range(4)]
+        with JobQueue(self.folder.name) as queue:
+            queue.submit('batch', parts, merge={})
+        exitcodes = run_workers(3, self.folder.name, lease=1., polling_delay=0.1,
+                                handlers={'part': part, 'merge': merge})
+        self.assertIn(-signal.SIGKILL, exitcodes)
+        with JobQueue(self.folder.name) as queue:
+            jobs = queue.jobs('batch')
+        self.assertEqual([job['status'] for job in jobs], ['done'] * 5)
+        # the job of the killed worker was leased again, the merge job got the result of every part
+        self.assertEqual(jobs[1]['attempts'], 2)
+        self.assertEqual(json.loads(jobs[-1]['result'])['results'],
+                         [[name, {'part': name, 'attempts': 2 if name == 'part1' else 1}] for name, _, _ in parts])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import numpy as np
+from unittest import mock
+from georice import engine
+
+try:
+    from skimage.morphology import remove_small_objects, remove_small_holes
+except ImportError:
+    remove_small_objects = remove_small_holes = None
+
+
+def skimage_clean(ma, value, threshold):
+    # components smaller than threshold removed / filled, 8-connectivity (max_size: scikit-image >= 0.26)
+    method = remove_small_objects if value else remove_small_holes
+    try:
+        return method(ma, max_size=threshold - 1, connectivity=2)
+    except TypeError:
+        return method(ma, threshold, connectivity=2)
+
+
+@unittest.skipIf(remove_small_objects is None, 'scikit-image is not installed')
+class TestMorphology(unittest.TestCase):
+
+    def setUp(self):
+        self.random = np.random.default_rng(0)
+
+    def random_mask(self, shape):
+        # noise and blobs: small and large components, some of them crossing the tile borders
+        density = self.random.uniform(0.2, 0.8)
+        ma = self.random.random(shape) < density
+        for _ in range(self.random.integers(0, 6)):
+            y, x = self.random.integers(0, shape[0]), self.random.integers(0, shape[1])
+            h, w = self.random.integers(1, 30, 2)
+            ma[y:y+h, x:x+w] = self.random.random() < 0.5
+        return ma
+
+    def test_remove_small_components(self):
+        for _ in range(60):
+            ma = self.random_mask(tuple(self.random.integers(1, 120, 2)))
+            threshold = int(self.random.integers(1, 40))
+            for value in [True, False]:
+                expected = skimage_clean(ma, value, threshold)
+                for tile_size in [1, 3, 16, 37, 128]:
+                    out = engine.remove_small_components(ma, value, threshold, np.empty_like(ma), tile_size, 2)
+                    np.testing.assert_array_equal(out, expected, 'value %s, threshold %d, tile size %d, shape %s'
+                                                  % (value, threshold, tile_size, ma.shape))
+
+    def test_clean_mask(self):
+        ma = self.random_mask((200, 200))
+        expected = skimage_clean(skimage_clean(ma, True, engine.OBJECTS_THRESHOLD), False, engine.HOLES_THRESHOLD)
+        for tile_size in [16, 50, 1024]:
+            with mock.patch.object(engine, 'MORPHOLOGY_TILE_SIZE', tile_size):
+                out = engine.clean_mask(ma.copy(), engine.OBJECTS_THRESHOLD, engine.HOLES_THRESHOLD, threads=2)
+            np.testing.assert_array_equal(out, expected, 'tile size %d' % tile_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import unittest
+import tempfile
+import numpy as np
+import rasterio as rio
+from osgeo import osr
+from georice import engine
+
+
+class TestReprojection(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.random = np.random.default_rng(0)
+        # 10 m UTM 48N grid
+        self.shape = [1500, 1800]
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(32648)
+        self.projection = srs.ExportToWkt()
+        self.transform = [500000., 10., 0., 1200000., 0., -10.]
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.folder.name, name)
+
+    def test_warp(self):
+        # native products: classes (nodata 0), 1 bit mask, statistics with nodata
+        classes = self.random.integers(0, 5, self.shape).astype(np.uint8)
+        mask = (classes == 1).astype(np.uint8)
+        stats = self.random.random(self.shape).astype(np.float32)
+        stats[self.random.random(self.shape) < 0.1] = -np.inf
+        products = [('classes.tif', classes, np.uint8, 0, []), ('mask.tif', mask, np.uint8, 0, ['NBITS=1']),
+                    ('stats.tif', stats, np.float32, None, [])]
+        for name, data, dtype, nodata, options in products:
+            engine.saveToGTiff(data, self.path('native_' + name), self.projection, self.transform, dtype=dtype,
+                               nodata=nodata, compressor='deflate', extra_options=options)
+
+        reprojection = engine.Reprojection(self.shape, self.projection, self.transform, 'EPSG:4326')
+        try:
+            reprojection.warp([(self.path('native_' + name), self.path(name), dtype, nodata, options, None)
+                               for name, _, dtype, nodata, options in products], 'deflate', [], threads=2)
+        finally:
+            reprojection.close()
+
+        # same grid and pixels as a gdal.Warp of each product
+        for name, _, dtype, _, options in products:
+            engine.warpGTiff(self.path('native_' + name), self.path('gdal_' + name), 'EPSG:4326', dtype, 'deflate',
+                             extra_options=options)
+            with rio.open(self.path(name)) as warped, rio.open(self.path('gdal_' + name)) as expected:
+                self.assertEqual(warped.shape, expected.shape)
+                self.assertEqual(warped.transform, expected.transform)
+                self.assertEqual(warped.crs, expected.crs)
+                np.testing.assert_array_equal(warped.read(), expected.read(), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
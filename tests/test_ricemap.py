@@ -0,0 +1,29 @@
+import os
+import sys
+import unittest
+import subprocess
+from georice.codecs import CODECS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'bin', 'ricemap.py')
+
+
+class TestRicemapScript(unittest.TestCase):
+
+    def run_script(self, *args):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+        return subprocess.run([sys.executable, SCRIPT, *args], capture_output=True, text=True, env=env, timeout=300)
+
+    def test_usage(self):
+        # missing parameters: the usage is printed (and every name it refers to resolved)
+        for args in [(), ('data_path', '018')]:
+            result = self.run_script(*args)
+            self.assertEqual(result.returncode, 1, result.stderr)
+            self.assertNotIn('Traceback', result.stderr)
+            self.assertIn('starting_date', result.stdout)
+            self.assertIn('names: %s' % ', '.join(CODECS), result.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
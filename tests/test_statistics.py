@@ -0,0 +1,136 @@
+import os
+import unittest
+import tempfile
+import datetime as dt
+import numpy as np
+import rasterio as rio
+from unittest import mock
+from rasterio.transform import from_origin
+from georice import engine
+
+
+def statistics(vh, time_0):
+    out = np.zeros((4,) + vh.shape[1:], dtype=np.float32)
+    engine.global_statistics(np.ascontiguousarray(vh), time_0, *out)
+    return out
+
+
+def state_statistics(fields):
+    out = np.zeros((4,) + fields[0].shape, dtype=np.float32)
+    engine.state_statistics(*fields, *out)
+    return out
+
+
+class TestIncrementalStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.random = np.random.default_rng(0)
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def random_cube(self, depth, height, width, trend=0.):
+        # noisy backscatter with values below -29dB (ignored) and nodata
+        vh = (self.random.random((depth, height, width)) * 0.1 + trend * np.arange(depth)[:, None, None])
+        vh = np.abs(vh).astype(np.float32)
+        vh[self.random.random(vh.shape) < 0.15] = 0
+        vh[self.random.random(vh.shape) < 0.05] = 0.001
+        vh[self.random.random(vh.shape) < 0.05] = np.nan
+        time_0 = 737000 + np.cumsum(self.random.integers(1, 15, depth))
+        return vh, time_0
+
+    def fold(self, vh, time_0, steps, name='state'):
+        # fold the dates in chunks ending at each step, statistics of the state after each fold
+        state = engine.RunningState.create(os.path.join(self.folder.name, name), vh.shape[1:], time_0[0])
+        times = (time_0 - state.time_origin).astype(np.int16)
+        fields = state.block(0, vh.shape[1], 0, vh.shape[2])
+        for t0, t1 in zip([0] + steps, steps + [len(vh)]):
+            engine.fold_statistics(np.ascontiguousarray(vh[t0:t1]), times[t0:t1], *fields)
+            yield t1, fields
+
+    def test_fold_statistics(self):
+        for depth, trend in [(30, 0.), (60, 0.002), (60, -0.002), (3, 0.)]:
+            vh, time_0 = self.random_cube(depth, 40, 50, trend)
+            steps = sorted(set(self.random.integers(1, depth, self.random.integers(1, depth)).tolist()))
+            for t1, fields in self.fold(vh, time_0, steps, 'state_%d_%g' % (depth, trend)):
+                dirty = fields[-1]
+                self.assertLess(dirty.mean(), 0.05)
+                np.testing.assert_array_equal(state_statistics(fields)[:, ~dirty],
+                                              statistics(vh[:t1], time_0[:t1])[:, ~dirty])
+
+    def test_fold_dirty(self):
+        vh, time_0 = self.random_cube(60, 4, 4)
+        # decreasing series: more records than the state capacity; infinite value
+        vh[:, 0, 0] = np.linspace(1, 0.01, len(vh))
+        vh[10, 1, 1] = np.inf
+        _, fields = list(self.fold(vh, time_0, [20, 40]))[-1]
+        self.assertTrue(fields[-1][0, 0])
+        self.assertTrue(fields[-1][1, 1])
+        dirty = fields[-1]
+        np.testing.assert_array_equal(state_statistics(fields)[:, ~dirty], statistics(vh, time_0)[:, ~dirty])
+
+    def test_build_state(self):
+        vh, time_0 = self.random_cube(60, 30, 30)
+        # records overflowing the state capacity along the time series, not at its end
+        vh[:30, 0, 0] = np.linspace(1, 0.1, 30)
+        vh[30:, 0, 0] = 0.5
+        vh[10, 1, 1] = np.inf
+        state = engine.RunningState.create(os.path.join(self.folder.name, 'state'), vh.shape[1:], time_0[0])
+        times = (time_0 - state.time_origin).astype(np.int16)
+        fields = state.block(0, 30, 0, 30)
+        engine.fold_statistics(np.ascontiguousarray(vh[:45]), times[:45], *fields)
+        self.assertTrue(fields[-1][0, 0])
+        # built again from the whole time series: only the infinite value remains dirty
+        engine.RunningState.clear(fields)
+        engine.build_state(np.ascontiguousarray(vh[:45]), times[:45], *fields)
+        self.assertFalse(fields[-1][0, 0])
+        self.assertTrue(fields[-1][1, 1])
+        dirty = fields[-1]
+        np.testing.assert_array_equal(state_statistics(fields)[:, ~dirty], statistics(vh[:45], time_0[:45])[:, ~dirty])
+        # the built state follows the next dates
+        engine.fold_statistics(np.ascontiguousarray(vh[45:]), times[45:], *fields)
+        dirty = fields[-1]
+        self.assertLess(dirty.mean(), 0.05)
+        np.testing.assert_array_equal(state_statistics(fields)[:, ~dirty], statistics(vh, time_0)[:, ~dirty])
+
+    def write_scenes(self, vh, dates):
+        folder = os.path.join(self.folder.name, 'scenes')
+        os.makedirs(folder, exist_ok=True)
+        profile = {'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'height': vh.shape[1], 'width': vh.shape[2],
+                   'crs': 'EPSG:32648', 'transform': from_origin(500000, 1500000, 20, 20)}
+        for plane, date in zip(vh, dates):
+            with rio.open(os.path.join(folder, 'S1_x_VH_DES_018_%s.tif' % date.strftime('%Y%m%d')), 'w', **profile) as f:
+                f.write(plane, 1)
+        return folder
+
+    def test_update(self):
+        # incremental update (blocks with overflowed / infinite pixels recomputed) vs full computation
+        vh, _ = self.random_cube(40, 70, 50)
+        # records overflowing the state capacity from the 25th date, fitting again in the state of the 40 dates
+        vh[:30, 5, 5] = np.linspace(1, 0.1, 30)
+        vh[30:, 5, 5] = 0.5
+        vh[3, 40, 40] = np.inf
+        dates = [dt.date(2020, 1, 1) + dt.timedelta(days=6 * t) for t in range(len(vh))]
+        folder = self.write_scenes(vh, dates)
+        output = os.path.join(self.folder.name, 'output')
+        with mock.patch.object(engine, 'TIFF_BLOCK_SIZE', 32), mock.patch.object(engine, 'BLOCK_SIZE', 32):
+            for end in [20, 32, 33, 40]:
+                period = '20200101', dates[end - 1].strftime('%Y%m%d')
+                scenes = engine.select_scenes(folder, '018', 'DES', *period)
+                options = dict(dst_srs=None, threads=1, write=False, coverage=False)
+                updated = engine.ricemap(scenes, *period, output, update=True, **options)['statistics']
+                expected = engine.ricemap(scenes, *period, output, **options)['statistics']
+                for name in expected:
+                    np.testing.assert_array_equal(updated[name], expected[name], name)
+            state = engine.RunningState(os.path.join(output, 'state', os.listdir(os.path.join(output, 'state'))[0]))
+            self.assertEqual(state.sources, [os.path.basename(f) for f, _ in scenes])
+            # only the block of the infinite value is still recomputed by the next updates
+            dirty = np.asarray(state.fields[-1])
+            self.assertTrue(dirty[40, 40])
+            self.assertFalse(dirty[5, 5])
+            self.assertEqual(dirty.sum(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()